@@ -1,10 +1,10 @@
 import sys
 import logging
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTreeWidget, QTreeWidgetItem, QVBoxLayout, QWidget, QTextEdit, QPushButton, QDialog
+from PyQt5.QtWidgets import QApplication, QMainWindow, QTreeView, QVBoxLayout, QWidget, QTextEdit, QPushButton, QDialog
 from PyQt5.QtGui import QColor
-from PyQt5.QtCore import QTimer, pyqtSignal, Qt
+from PyQt5.QtCore import pyqtSignal, Qt, QAbstractTableModel, QModelIndex
+from threading import Thread
 import socketio
-import requests
 import json
 import subprocess
 import time
@@ -12,6 +12,8 @@ import time
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+SERVER_URL = "http://54.85.104.167:5000"  # Public server IP
+
 class CLIWindow(QDialog):
     def __init__(self, parent):
         super().__init__(parent)
@@ -51,8 +53,229 @@ class CLIWindow(QDialog):
             self.cli_output.append(f"> {command}\n{output}")
             self.cli_input.clear()
 
+class TerminalTableModel(QAbstractTableModel):
+    # One row per terminal: the server's view in its order, then expected terminals the server
+    # doesn't know about. rows maps each key to its row so a change only touches (and repaints)
+    # that row, and expected is a set so telling expected from unknown terminals is one lookup.
+    HEADERS = ["Store", "Terminal", "IP", "ISP"]
+    CONNECTED_COLOR = QColor(144, 238, 144)  # Light green
+    DISCONNECTED_COLOR = QColor(240, 128, 128)  # Light coral
+    STALE_COLOR = QColor(211, 211, 211)  # Light gray: last known state from before a server restart
+    MAX_RANGES = 8
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.keys = []
+        self.rows = {}
+        self.records = {}  # key -> info from the server; expected terminals it doesn't list have none
+        self.expected = set()
+        self.expected_order = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        key = self.keys[index.row()]
+        info = self.records.get(key)
+        if role == Qt.DisplayRole:
+            column = index.column()
+            if column < 2:
+                store, _, terminal = key.rpartition(',')
+                return store if column == 0 else terminal
+            if info is None:
+                return 'N/A'
+            return str(info.get('ip' if column == 2 else 'isp') or 'N/A')
+        if role == Qt.BackgroundRole and index.column() == 0:
+            if info is None:
+                return self.DISCONNECTED_COLOR
+            if info.get('stale'):
+                return self.STALE_COLOR
+            return self.CONNECTED_COLOR if info.get('status') == 'connected' else self.DISCONNECTED_COLOR
+        return None
+
+    def set_expected(self, expected):
+        self.expected_order = [f"{store},{terminal}" for store, terminals in expected.items() for terminal in terminals]
+        self.expected = set(self.expected_order)
+        self.append_rows([key for key in self.expected_order if key not in self.rows])
+
+    def reset(self, terminals):
+        # Replaces the view with a full one. Rows are only rebuilt if the set of terminals changed;
+        # otherwise just the rows whose record differs are reported as changed.
+        keys = list(terminals)
+        keys.extend(key for key in self.expected_order if key not in terminals)
+        if keys != self.keys:
+            self.beginResetModel()
+            self.keys = keys
+            self.rows = {key: row for row, key in enumerate(keys)}
+            self.records = dict(terminals)
+            self.endResetModel()
+            return
+        records = self.records
+        changed = [self.rows[key] for key, info in terminals.items() if records.get(key) != info]
+        self.records = dict(terminals)
+        self.rows_changed(changed)
+
+    def apply_changes(self, changes):
+        # {key: info} from terminal_changed; None removes a terminal from the server's view
+        changed = []
+        added = []
+        removed = []
+        for key, info in changes.items():
+            row = self.rows.get(key)
+            if info is None:
+                if self.records.pop(key, None) is not None and row is not None:
+                    # An expected terminal stays, as a placeholder
+                    (changed if key in self.expected else removed).append(row)
+                continue
+            self.records[key] = info
+            if row is None:
+                added.append(key)
+            else:
+                changed.append(row)
+        self.rows_changed(changed)
+        self.remove_rows(removed)
+        self.append_rows(added)
+
+    def rows_changed(self, rows):
+        # One dataChanged per run of consecutive rows. Each emit costs a view update, so rows
+        # scattered across many runs are reported as one range; the view only repaints what's visible.
+        if not rows:
+            return
+        rows = sorted(rows)
+        if len(rows) > self.MAX_RANGES:
+            self.dataChanged.emit(self.index(rows[0], 0), self.index(rows[-1], len(self.HEADERS) - 1))
+            return
+        start = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i] != rows[i - 1] + 1:
+                self.dataChanged.emit(self.index(rows[start], 0), self.index(rows[i - 1], len(self.HEADERS) - 1))
+                start = i
+
+    def append_rows(self, keys):
+        if not keys:
+            return
+        first = len(self.keys)
+        self.beginInsertRows(QModelIndex(), first, first + len(keys) - 1)
+        for row, key in enumerate(keys, first):
+            self.keys.append(key)
+            self.rows[key] = row
+        self.endInsertRows()
+
+    def remove_rows(self, rows):
+        if not rows:
+            return
+        for row in sorted(rows, reverse=True):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.rows[self.keys.pop(row)]
+            self.endRemoveRows()
+        for row in range(min(rows), len(self.keys)):
+            self.rows[self.keys[row]] = row
+
+    def unknown(self):
+        # Terminals that reported but aren't in the expected list
+        return [key for key in self.keys if key not in self.expected and key in self.records]
+
+    def flush_unknown(self):
+        unknown = [self.rows[key] for key in self.unknown() if self.records[key].get('ip') not in (None, 'N/A')]
+        for key in (self.keys[row] for row in unknown):
+            del self.records[key]
+        self.remove_rows(unknown)
+        return len(unknown)
+
+
+class StatusFeed:
+    # Keeps a mirror of the server's view of the fleet over Socket.IO. Connecting and every event
+    # handler run on the client's background threads; results reach the GUI through the callbacks
+    # (Qt signal emits, which are queued onto the GUI thread). A snapshot is only requested on
+    # (re)connect and when a gap in the change sequence shows events were missed.
+    def __init__(self, url, on_view, on_changes, on_state, retry_delay=5):
+        self.url = url
+        self.on_view = on_view  # A full view, when the set of terminals changed
+        self.on_changes = on_changes  # {key: info or None}
+        self.on_state = on_state  # Connection state text for the status bar
+        self.retry_delay = retry_delay
+        self.terminals = {}  # Only touched on the socket thread; the GUI gets copies
+        self.last_seq = None
+        self.resync_pending = False
+        self.sio = socketio.Client()  # Reconnects by itself once the first connect succeeded
+        self.sio.on('connect', self.on_connect)
+        self.sio.on('disconnect', self.on_disconnect)
+        self.sio.on('status_snapshot', self.on_status_snapshot)
+        self.sio.on('terminal_changed', self.on_terminal_changed)
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        # Retry the first connect until the server answers
+        while True:
+            self.on_state(f"Connecting to {self.url}...")
+            try:
+                self.sio.connect(self.url, transports=['websocket'])
+                return
+            except socketio.exceptions.ConnectionError as e:
+                logging.error(f"Could not connect to {self.url}: {e}")
+                self.on_state(f"Could not connect to {self.url}, retrying in {self.retry_delay} s")
+                time.sleep(self.retry_delay)
+
+    def on_connect(self):
+        # Ask for the changes missed while disconnected (or a full snapshot on first connect)
+        self.on_state(f"Connected to {self.url}")
+        self.sio.emit('request_snapshot', {'since': self.last_seq})
+
+    def on_disconnect(self):
+        self.on_state(f"Disconnected from {self.url}, reconnecting...")
+
+    def on_status_snapshot(self, snapshot):
+        logging.debug("Received status snapshot")
+        terminals = snapshot['terminals']
+        self.last_seq = snapshot['seq']
+        self.resync_pending = False
+        if list(terminals) != list(self.terminals):
+            self.terminals = terminals
+            # A copy: the mirror keeps changing on this thread while the GUI reads the view
+            self.on_view(dict(terminals))
+            return
+        # Same terminals in the same order: only send the rows whose record changed
+        changes = {key: info for key, info in terminals.items() if self.terminals[key] != info}
+        self.terminals = terminals
+        if changes:
+            self.on_changes(changes)
+
+    def on_terminal_changed(self, event):
+        if self.last_seq is None or event['seq'] <= self.last_seq:
+            return
+        if event['seq'] != self.last_seq + 1:
+            if not self.resync_pending:
+                logging.debug(f"Missed changes after {self.last_seq}, requesting resync")
+                self.resync_pending = True
+                self.sio.emit('request_snapshot', {'since': self.last_seq})
+            return
+        for key, info in event['changes'].items():
+            if info is None:
+                self.terminals.pop(key, None)
+            else:
+                self.terminals[key] = info
+        self.last_seq = event['seq']
+        self.resync_pending = False
+        self.on_changes(event['changes'])
+
+
 class TerminalStatusApp(QMainWindow):
-    update_signal = pyqtSignal(dict)
+    # object, not dict: a dict argument is converted to a QVariantMap and back on every emit
+    update_signal = pyqtSignal(object)  # A full view of the fleet
+    changes_signal = pyqtSignal(object)  # {key: info or None} from a terminal_changed event
+    connection_signal = pyqtSignal(str)
 
     def __init__(self):
         super().__init__()
@@ -64,10 +287,12 @@ class TerminalStatusApp(QMainWindow):
         self.setCentralWidget(self.main_widget)
         self.layout = QVBoxLayout(self.main_widget)
 
-        # Create the tree widget
-        self.tree = QTreeWidget()
-        self.tree.setColumnCount(4)
-        self.tree.setHeaderLabels(["Store", "Terminal", "IP", "ISP"])
+        # Terminal list: a view over the model, which only repaints rows that changed
+        self.model = TerminalTableModel(self)
+        self.tree = QTreeView()
+        self.tree.setRootIsDecorated(False)
+        self.tree.setUniformRowHeights(True)
+        self.tree.setModel(self.model)
         self.layout.addWidget(self.tree)
 
         # CLI Button
@@ -75,94 +300,31 @@ class TerminalStatusApp(QMainWindow):
         self.cli_button.clicked.connect(self.open_cli_window)
         self.layout.addWidget(self.cli_button)
 
-        # Set up SocketIO client
-        self.sio = socketio.Client()
-        self.sio.on('update_status', self.on_update_status)
-        self.sio.connect("http://54.85.104.167:5000")  # Updated to public server IP
-
         self.load_expected_terminals()
-        self.update_status()
-
-        # Set up a timer to update the status every 15 seconds (reduce polling frequency)
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.update_status)
-        self.timer.start(15000)
 
-        # Initialize a list to store unknown connections
-        self.unknown_connections = []
-        self.previous_states = {}
-
-        # Connect the update signal to the update_tree method
+        # Status updates arrive on the feed's threads, so the window shows up (and stays
+        # responsive) however slow the server is
         self.update_signal.connect(self.update_tree)
+        self.changes_signal.connect(self.apply_changes)
+        self.connection_signal.connect(self.statusBar().showMessage)
+        self.feed = StatusFeed(SERVER_URL, self.update_signal.emit, self.changes_signal.emit, self.connection_signal.emit)
+        self.feed.start()
 
     def load_expected_terminals(self):
         with open('expected_terminals.json') as f:
             self.expected_terminals = json.load(f)
+        self.model.set_expected(self.expected_terminals)
 
-    def on_update_status(self, data):
-        logging.debug("Received update status")
-        self.update_signal.emit(data)
-
-    def update_tree(self, connected_terminals):
-        logging.debug("Updating tree")
-        self.connected_terminals = connected_terminals
-        self.tree.clear()
-        self.unknown_connections = []  # Reset unknown connections list
-
-        # Add connected terminals
-        for key, info in self.connected_terminals.items():
-            if ',' in key:
-                store, terminal = key.split(',')
-                ip = info.get('ip', 'N/A')
-                isp = info.get('isp', 'N/A')
-                status = info.get('status', 'disconnected')
-
-                item = QTreeWidgetItem([store, terminal, ip, isp])
-                if status == 'connected':
-                    item.setBackground(0, QColor(144, 238, 144))  # Light green background
-                else:
-                    item.setBackground(0, QColor(240, 128, 128))  # Light coral background
-                self.tree.addTopLevelItem(item)
-
-                # Track unknown connections
-                if (store, terminal) not in [(k.split(',')[0], k.split(',')[1]) for k in self.expected_terminals.keys() if ',' in k]:
-                    self.unknown_connections.append((store, terminal))
-            else:
-                logging.warning(f"Skipping invalid key: {key}")
-
-        # Add expected terminals that are not connected
-        for store, terminals in self.expected_terminals.items():
-            for terminal in terminals:
-                if (store, terminal) not in [(k.split(',')[0], k.split(',')[1]) for k in self.connected_terminals.keys() if ',' in k]:
-                    item = QTreeWidgetItem([store, terminal, 'N/A', 'N/A'])
-                    item.setBackground(0, QColor(240, 128, 128))  # Light coral background
-                    self.tree.addTopLevelItem(item)
-
-    def update_status(self):
-        try:
-            response = requests.get("http://54.85.104.167:5000/status")  # Updated to public server IP
-            if response.status_code == 200:
-                self.connected_terminals = response.json()
-                self.update_signal.emit(self.connected_terminals)
-            else:
-                logging.error(f"Error fetching status: {response.status_code}")
-                self.connected_terminals = {}
-        except Exception as e:
-            logging.error(f"Error fetching status: {e}")
-            self.connected_terminals = {}
+    def update_tree(self, terminals):
+        # A full view (snapshot); the model only touches the rows that differ
+        self.model.reset(terminals)
+
+    def apply_changes(self, changes):
+        self.model.apply_changes(changes)
 
     def flush_unknown_connections(self):
-        expected_keys = [(store, terminal) for store, terminals in self.expected_terminals.items() for terminal in terminals]
-        for i in range(self.tree.topLevelItemCount() - 1, -1, -1):
-            item = self.tree.topLevelItem(i)
-            store = item.text(0)
-            terminal = item.text(1)
-            if (store, terminal) not in expected_keys and item.text(2) != 'N/A':
-                self.tree.takeTopLevelItem(i)
-                if (store, terminal) in self.previous_states:
-                    del self.previous_states[(store, terminal)]
-        self.unknown_connections = []  # Clear unknown connections list
-        logging.debug("Flushed unknown connections")
+        flushed = self.model.flush_unknown()
+        logging.debug(f"Flushed {flushed} unknown connections")
 
     def open_cli_window(self):
         self.cli_window = CLIWindow(self)
@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from deltapatch import make_patch, apply_patch, worthwhile
+
+# Measures delta patches between pairs of builds: bytes a terminal would download with and
+# without a patch, how long the server takes to make it and how long the agent takes to apply it,
+# and whether the server would offer it. Give it terminal.exe builds of consecutive versions.
+# Usage: python bench_delta.py old.exe new.exe [old2.exe new2.exe ...] [--json results.json]
+
+
+def bench_pair(base_path, target_path):
+    with open(base_path, 'rb') as f:
+        base = f.read()
+    with open(target_path, 'rb') as f:
+        target = f.read()
+    started = time.perf_counter()
+    patch = make_patch(base, target)
+    diff_seconds = time.perf_counter() - started
+    with tempfile.TemporaryDirectory() as workdir:
+        output_path = os.path.join(workdir, 'terminal_new.exe')
+        started = time.perf_counter()
+        apply_patch(base_path, patch, output_path)
+        apply_seconds = time.perf_counter() - started
+        with open(output_path, 'rb') as f:
+            verified = f.read() == target
+    return {
+        'base': base_path,
+        'target': target_path,
+        'full_bytes': len(target),
+        'patch_bytes': len(patch),
+        'saved_percent': round(100 * (1 - len(patch) / len(target)), 1) if target else 0.0,
+        'diff_seconds': round(diff_seconds, 3),
+        'apply_seconds': round(apply_seconds, 3),
+        'verified': verified,
+        'offered': worthwhile(len(patch), len(target)),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark terminal.exe delta patches")
+    parser.add_argument('files', nargs='+', help="pairs of base and target builds")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+    if len(args.files) % 2:
+        parser.error("files must come in base/target pairs")
+    results = [bench_pair(args.files[i], args.files[i + 1]) for i in range(0, len(args.files), 2)]
+    for result in results:
+        print(f"{result['base']} -> {result['target']}: full {result['full_bytes']} B, patch {result['patch_bytes']} B "
+              f"({result['saved_percent']}% saved), diff {result['diff_seconds']} s, apply {result['apply_seconds']} s, "
+              f"{'ok' if result['verified'] else 'MISMATCH'}, {'offered' if result['offered'] else 'not offered'}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,91 @@
+import json
+import logging
+import time
+from collections import deque
+from threading import Condition, Lock
+
+
+class Broadcaster:
+    # Sits between state changes and socketio.emit. Request handlers only add the changed keys
+    # to the pending set; the broadcast thread wakes on the first change, waits out the window
+    # so everything arriving meanwhile is merged by key, then emits one sequenced terminal_changed.
+    # The entries are read with view(keys) at emit time, not taken from the publisher: two
+    # publishes of one key can arrive in the opposite order to the registry updates behind them.
+    def __init__(self, socketio, view, window=0.25, history_size=500, room=None, metrics=None):
+        self.socketio = socketio
+        self.view = view  # keys -> {key: current entry, None if no longer shown}
+        self.metrics = metrics
+        self.window = window
+        self.room = room
+        self.pending = set()
+        self.condition = Condition()
+        self.running = True
+        # seq and history are only touched under emit_lock, which also keeps emits in sequence order
+        self.emit_lock = Lock()
+        self.seq = 0
+        self.history = deque(maxlen=history_size)
+        self.changes_published = 0
+        self.changes_coalesced = 0
+        self.messages_emitted = 0
+
+    def publish(self, changes):
+        # changes: the "store,terminal" keys that changed (a changes dict works too)
+        with self.condition:
+            self.changes_published += 1
+            if self.pending:
+                self.changes_coalesced += 1
+            self.pending.update(changes)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+            self.socketio.sleep(self.window)
+            with self.condition:
+                keys, self.pending = self.pending, set()
+            try:
+                self.emit(keys)
+            except Exception as e:
+                # Dashboards see the gap in seq and resync; the thread must outlive it
+                logging.error(f"Error broadcasting {len(keys)} changes: {e}")
+
+    def emit(self, keys):
+        with self.emit_lock:
+            changes = self.view(keys)
+            self.seq += 1
+            self.history.append((self.seq, changes))
+            self.messages_emitted += 1
+            message = {'seq': self.seq, 'changes': changes}
+            started = time.perf_counter()
+            self.socketio.emit('terminal_changed', message, to=self.room)
+            if self.metrics and self.metrics.enabled:
+                self.metrics.observe('emit_seconds', time.perf_counter() - started, ('terminal_changed',))
+                self.metrics.observe('emit_payload_bytes', len(json.dumps(message)), ('terminal_changed',))
+
+    def changes_since(self, since):
+        # Missed events after `since`, or None if the history no longer reaches back that far.
+        # Callers must hold emit_lock so nothing is emitted between the replay and live events.
+        if since is None or since > self.seq:
+            return None
+        if since < self.seq and (not self.history or self.history[0][0] > since + 1):
+            return None
+        return [(seq, changes) for seq, changes in self.history if seq > since]
+
+    def stats(self):
+        with self.condition:
+            return {
+                'seq': self.seq,
+                'changes_published': self.changes_published,
+                'changes_coalesced': self.changes_coalesced,
+                'messages_emitted': self.messages_emitted,
+                'pending': len(self.pending),
+            }
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
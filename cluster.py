@@ -0,0 +1,528 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import time
+import uuid
+from multiprocessing.connection import Listener, Client
+from threading import Thread, Lock, local
+import socketio
+from registry import TerminalRegistry, TerminalRecord, Status, terminal_key
+from rollout import RolloutController
+
+# Pieces for running the server as several worker processes on one port: a local message bus
+# (the broker runs in the parent process), a Socket.IO client manager on top of it so events
+# reach sockets held by any worker, and a terminal registry and rollout shared through a SQLite file.
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+class Broker:
+    # Local stand-in for a message queue server. Every message published on a channel is
+    # forwarded to each other connection subscribed to it.
+    def __init__(self, address, authkey):
+        self.listener = Listener(parse_address(address), authkey=authkey)
+        self.lock = Lock()
+        self.subscribers = {}  # channel -> set of connections
+        self.send_locks = {}  # connection -> lock, connections are written from several threads
+
+    def run(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.send_locks[connection] = Lock()
+            Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        try:
+            while True:
+                kind, channel, payload = connection.recv()
+                if kind == 'subscribe':
+                    with self.lock:
+                        self.subscribers.setdefault(channel, set()).add(connection)
+                    continue
+                with self.lock:
+                    targets = [(target, self.send_locks[target]) for target in self.subscribers.get(channel, ()) if target is not connection]
+                for target, send_lock in targets:
+                    try:
+                        with send_lock:
+                            target.send((channel, payload))
+                    except OSError:
+                        pass  # Its own serve thread notices and cleans up
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                for subscribers in self.subscribers.values():
+                    subscribers.discard(connection)
+                self.send_locks.pop(connection, None)
+            connection.close()
+
+    def stop(self):
+        self.listener.close()
+
+
+class Bus:
+    # One connection per process to the broker. Handlers run on the connection's reader thread.
+    # The connection is made on first use, so a Bus created before forking works in every child.
+    def __init__(self, address, authkey):
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self.lock = Lock()
+        self.handlers = {}
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                return self.connection
+            delay = 0.1
+            while True:
+                try:
+                    connection = Client(self.address, authkey=self.authkey)
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(delay)  # The parent may not be accepting yet
+                    delay = min(delay * 2, 2)
+            if self.pid != os.getpid():
+                self.handlers = {}  # Subscriptions made in the parent don't carry over
+            self.connection = connection
+            self.pid = os.getpid()
+            Thread(target=self.listen, args=(connection,), daemon=True).start()
+            return connection
+
+    def publish(self, channel, payload=None):
+        connection = self.connect()
+        with self.lock:
+            connection.send(('publish', channel, payload))
+
+    def subscribe(self, channel, handler):
+        connection = self.connect()
+        with self.lock:
+            self.handlers.setdefault(channel, []).append(handler)
+            connection.send(('subscribe', channel, None))
+
+    def listen(self, connection):
+        while True:
+            try:
+                channel, payload = connection.recv()
+            except (EOFError, OSError):
+                logging.error("Lost connection to the message bus")
+                return
+            for handler in self.handlers.get(channel, ()):
+                try:
+                    handler(payload)
+                except Exception as e:
+                    logging.error(f"Error handling {channel} message: {e}")
+
+
+class BusManager(socketio.PubSubManager):
+    # Socket.IO client manager that shares emits, rooms and disconnects between workers over the Bus
+    name = 'bus'
+
+    def __init__(self, bus, channel='socketio', write_only=False, logger=None):
+        self.pid = None
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.bus = bus
+
+    # Messages from this process are recognised by host_id, so every forked worker needs its own
+    @property
+    def host_id(self):
+        if self.pid != os.getpid():
+            self.host_id = uuid.uuid4().hex
+        return self._host_id
+
+    @host_id.setter
+    def host_id(self, value):
+        self._host_id = value
+        self.pid = os.getpid()
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, data)
+
+    def _listen(self):
+        messages = queue.Queue()
+        self.bus.subscribe(self.channel, messages.put)
+        while True:
+            yield messages.get()
+
+
+class SharedRegistry(TerminalRegistry):
+    # A TerminalRegistry whose source of truth is a SQLite file (WAL mode) shared by every process.
+    # Writes go straight to the database, numbered with one global sequence; each process keeps
+    # the in-memory registry as a cache and pulls in rows newer than the last sequence it has seen.
+    # With auto_sync, reads first catch up (at most every sync_interval seconds).
+    # A keep-alive that changes nothing is not written at all: its heartbeat is noted with
+    # note_beat and handed to the parent in batches (take_beats), so only real changes take
+    # the database's write lock.
+    def __init__(self, path, shard_count=16, auto_sync=True, sync_interval=0.1, expire_after=None):
+        super().__init__(shard_count=shard_count)
+        self.path = path
+        self.auto_sync = auto_sync
+        self.sync_interval = sync_interval
+        self.expire_after = expire_after  # mark_disconnected skips terminals that beat more recently
+        self.local = local()
+        self.sync_lock = Lock()
+        self.synced_seq = 0
+        self.synced_at = 0
+        self.expected_seq = 0
+        self.beats_lock = Lock()
+        self.pending_beats = {}  # key -> last heartbeat, not yet handed to the parent
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def close(self):
+        # Call before forking; SQLite connections must not be used across a fork
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+        self.local.connection = None
+
+    def reset(self):
+        # Start from an empty database; the parent does this once before starting workers
+        connection = self.connection()
+        connection.executescript('''
+            DROP TABLE IF EXISTS records;
+            DROP TABLE IF EXISTS state;
+            CREATE TABLE records (key TEXT PRIMARY KEY, store_id TEXT, terminal_id TEXT, record TEXT, seq INTEGER, last_heartbeat REAL);
+            CREATE INDEX records_seq ON records (seq);
+            CREATE TABLE state (name TEXT PRIMARY KEY, value);
+            INSERT INTO state (name, value) VALUES ('seq', 0), ('expected_seq', 0), ('expected', NULL);
+        ''')
+
+    def transaction(self, work):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = work(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    @staticmethod
+    def next_seq(connection):
+        return connection.execute("UPDATE state SET value = value + 1 WHERE name = 'seq' RETURNING value").fetchone()[0]
+
+    @staticmethod
+    def read_record(connection, key, store_id, terminal_id):
+        row = connection.execute('SELECT record, last_heartbeat FROM records WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        record = TerminalRecord.from_dict(store_id, terminal_id, json.loads(row[0]))
+        record.last_heartbeat = row[1]  # Not part of the serialized record
+        return record
+
+    @staticmethod
+    def write_record(connection, record, seq):
+        connection.execute('INSERT OR REPLACE INTO records (key, store_id, terminal_id, record, seq, last_heartbeat) VALUES (?, ?, ?, ?, ?, ?)',
+                           (record.key, record.store_id, record.terminal_id, record.to_json(), seq, record.last_heartbeat))
+
+    def report(self, store_id, terminal_id, fields):
+        key = terminal_key(store_id, terminal_id)
+        cached = super().get(key)
+        if cached is not None and not cached.would_change(fields):
+            # Nothing to write by the synced cache. A change another process made in the last
+            # sync_interval can be missed; the parent revives a terminal whose beat it gets after
+            # marking it disconnected, and anything else is caught by the terminal's next report.
+            return cached, {}
+
+        def work(connection):
+            record = self.read_record(connection, key, store_id, terminal_id)
+            if record is None:
+                record = TerminalRecord(store_id, terminal_id)
+                record.update(fields)
+                changed = True
+            else:
+                changed = record.update(fields)
+            if changed:
+                self.write_record(connection, record, self.next_seq(connection))
+            else:
+                connection.execute('UPDATE records SET last_heartbeat = ? WHERE key = ?', (record.last_heartbeat, key))
+            return record, changed
+
+        record, changed = self.transaction(work)
+        return record, {key: record.to_dict()} if changed else {}
+
+    def mark_disconnected(self, keys):
+        now = time.time()
+
+        def work(connection):
+            changed = []
+            for key in keys:
+                store_id, _, terminal_id = key.rpartition(',')
+                record = self.read_record(connection, key, store_id, terminal_id)
+                if record is None:
+                    continue
+                if self.expire_after is not None and record.last_heartbeat is not None and now - record.last_heartbeat < self.expire_after:
+                    continue  # Beat through another worker since the deadline was set
+                if record.set_status(Status.DISCONNECTED):
+                    self.write_record(connection, record, self.next_seq(connection))
+                    changed.append(record)
+            return changed
+
+        changes = {}
+        for record in self.transaction(work):
+            # Apply locally too, so the next sync finds nothing new for these records
+            self.shard_for(record.key).put(record.key, record)
+            changes[record.key] = record.to_dict()
+        return changes
+
+    def load_expected(self, expected):
+        def work(connection):
+            seq = self.next_seq(connection)
+            connection.execute("UPDATE state SET value = ? WHERE name = 'expected'", (json.dumps(expected),))
+            connection.execute("UPDATE state SET value = ? WHERE name = 'expected_seq'", (seq,))
+            return seq
+
+        seq = self.transaction(work)
+        with self.sync_lock:
+            self.expected_seq = max(self.expected_seq, seq)
+            return super().load_expected(expected)
+
+    def restore(self, records):
+        def work(connection):
+            restored = []
+            for store_id, terminal_id, fields in records:
+                record = TerminalRecord.from_dict(store_id, terminal_id, fields)
+                record.stale = True
+                if connection.execute('SELECT 1 FROM records WHERE key = ?', (record.key,)).fetchone() is None:
+                    self.write_record(connection, record, self.next_seq(connection))
+                    restored.append(record.key)
+            return restored
+
+        restored = self.transaction(work)
+        self.sync()
+        return restored
+
+    def sync(self):
+        # Pulls in everything written since the last sync; returns the changes to the view
+        with self.sync_lock:
+            connection = self.connection()
+            connection.execute('BEGIN')
+            try:
+                rows = connection.execute('SELECT key, store_id, terminal_id, record, seq FROM records WHERE seq > ? ORDER BY seq', (self.synced_seq,)).fetchall()
+                expected_seq, expected = connection.execute("SELECT (SELECT value FROM state WHERE name = 'expected_seq'), (SELECT value FROM state WHERE name = 'expected')").fetchone()
+                seq = connection.execute("SELECT value FROM state WHERE name = 'seq'").fetchone()[0]
+            finally:
+                connection.execute('COMMIT')
+            changes = {}
+            if expected_seq > self.expected_seq:
+                changes.update(super().load_expected(json.loads(expected)))
+                self.expected_seq = expected_seq
+            for key, store_id, terminal_id, data, _ in rows:
+                record = TerminalRecord.from_dict(store_id, terminal_id, json.loads(data))
+                if self.shard_for(key).put(key, record):
+                    changes[key] = record.to_dict()
+            self.add_to_layout([row[0] for row in rows])
+            self.synced_seq = seq
+            self.synced_at = time.time()
+            return changes
+
+    def note_beat(self, key, last_heartbeat):
+        with self.beats_lock:
+            self.pending_beats[key] = last_heartbeat
+
+    def take_beats(self):
+        # [(key, last heartbeat)] for terminals that reported since the last call
+        with self.beats_lock:
+            beats, self.pending_beats = self.pending_beats, {}
+        return list(beats.items())
+
+    def refresh(self):
+        if self.auto_sync and time.time() - self.synced_at >= self.sync_interval:
+            self.sync()
+
+    def get(self, key):
+        self.refresh()
+        return super().get(key)
+
+    def statuses(self):
+        self.refresh()
+        return super().statuses()
+
+    def snapshot(self):
+        self.refresh()
+        return super().snapshot()
+
+    def snapshot_json(self):
+        # The ETag version is the global sequence, so every worker tags the same state the same way.
+        # Read it before the body, so a body is never older than its tag.
+        self.refresh()
+        seq = self.synced_seq
+        _, body = super().snapshot_json()
+        return seq, body
+
+
+class SharedRolloutController(RolloutController):
+    # A RolloutController kept in the shared registry's SQLite file, so the per-store download limit
+    # and the waves hold for the whole fleet rather than per worker. The rollout itself is one row,
+    # each terminal it has handed the version to, seen on it or failed one row in rollout_terminals.
+    # version_for only reads, except when it admits a terminal (the store's count is checked again
+    # under the write lock) or a terminal first reports the new version. Everything else loads the
+    # whole rollout, runs the in-memory logic and writes back what changed; evaluate belongs in one
+    # process (the parent). Until reset() it works in memory only, like RolloutController.
+    def __init__(self, registry, version, **kwargs):
+        self.shared = False
+        self.update_lock = Lock()
+        super().__init__(registry, version, **kwargs)
+
+    def reset(self):
+        # Start the shared rollout from this one; the parent does this once before starting workers
+        with self.update_lock:
+            self.registry.connection().executescript('''
+                DROP TABLE IF EXISTS rollout;
+                DROP TABLE IF EXISTS rollout_terminals;
+                CREATE TABLE rollout (id INTEGER PRIMARY KEY CHECK (id = 1), version TEXT, wave INTEGER, state TEXT, pause_reason TEXT, attempted INTEGER);
+                CREATE TABLE rollout_terminals (key TEXT PRIMARY KEY, store_id TEXT, handed_at REAL, updated_at REAL, failed INTEGER NOT NULL DEFAULT 0);
+                CREATE INDEX rollout_terminals_in_flight ON rollout_terminals (store_id) WHERE handed_at IS NOT NULL;
+                INSERT INTO rollout (id) VALUES (1);
+            ''')
+            saved = self.rows(RolloutController.export(self))
+            self.registry.transaction(lambda connection: self.save(connection, None, saved))
+            self.shared = True
+
+    @staticmethod
+    def rows(saved):
+        # An export() as the rollout row and {key: (store, handed_at, updated_at, failed)}
+        rows = {key: (key.rpartition(',')[0], None, updated_at, 0) for key, updated_at in saved['updated_at'].items()}
+        for store_id, keys in saved['in_flight'].items():
+            for key, handed_at in keys.items():
+                rows[key] = (store_id, handed_at, rows.get(key, (None, None, None, 0))[2], 0)
+        for key in saved['failed']:
+            store_id, handed_at, updated_at, _ = rows.get(key, (key.rpartition(',')[0], None, None, 0))
+            rows[key] = (store_id, handed_at, updated_at, 1)
+        return (saved['version'], saved['wave'], saved['state'], saved['pause_reason'], saved['attempted']), rows
+
+    def load(self, connection):
+        version, wave, state, pause_reason, attempted = connection.execute('SELECT version, wave, state, pause_reason, attempted FROM rollout WHERE id = 1').fetchone()
+        saved = {'version': version, 'wave': wave, 'state': state, 'pause_reason': pause_reason, 'attempted': attempted,
+                 'in_flight': {}, 'updated_at': {}, 'failed': []}
+        for key, store_id, handed_at, updated_at, failed in connection.execute('SELECT key, store_id, handed_at, updated_at, failed FROM rollout_terminals'):
+            if handed_at is not None:
+                saved['in_flight'].setdefault(store_id, {})[key] = handed_at
+            if updated_at is not None:
+                saved['updated_at'][key] = updated_at
+            if failed:
+                saved['failed'].append(key)
+        last_evaluated = self.last_evaluated
+        super().restore(saved)
+        self.last_evaluated = last_evaluated
+
+    @staticmethod
+    def save(connection, before, after):
+        # Writes what differs between two rows() results (before is None for an empty database)
+        rollout, rows = after
+        previous_rollout, previous_rows = before or (None, {})
+        if rollout != previous_rollout:
+            connection.execute('UPDATE rollout SET version = ?, wave = ?, state = ?, pause_reason = ?, attempted = ? WHERE id = 1', rollout)
+        connection.executemany('DELETE FROM rollout_terminals WHERE key = ?', [(key,) for key in previous_rows if key not in rows])
+        connection.executemany('INSERT OR REPLACE INTO rollout_terminals (key, store_id, handed_at, updated_at, failed) VALUES (?, ?, ?, ?, ?)',
+                               [(key,) + row for key, row in rows.items() if previous_rows.get(key) != row])
+
+    def update_shared(self, change):
+        # Runs change() on the latest shared state and writes back whatever it changed
+        if not self.shared:
+            return change()
+
+        def work(connection):
+            self.load(connection)
+            before = self.rows(RolloutController.export(self))
+            result = change()
+            self.save(connection, before, self.rows(RolloutController.export(self)))
+            return result
+
+        with self.update_lock:
+            return self.registry.transaction(work)
+
+    def read_shared(self, read):
+        if not self.shared:
+            return read()
+        with self.update_lock:
+            connection = self.registry.connection()
+            connection.execute('BEGIN')
+            try:
+                self.load(connection)
+            finally:
+                connection.execute('COMMIT')
+            return read()
+
+    def start(self, version):
+        self.update_shared(lambda: RolloutController.start(self, version))
+
+    def pause(self, reason='paused by operator'):
+        self.update_shared(lambda: RolloutController.pause(self, reason))
+
+    def resume(self):
+        self.update_shared(lambda: RolloutController.resume(self))
+
+    def restore(self, saved):
+        self.update_shared(lambda: RolloutController.restore(self, saved))
+
+    def evaluate(self, now=None):
+        now = now if now is not None else time.time()
+        if self.shared:
+            if now - self.last_evaluated < self.evaluate_interval:
+                return
+            if self.registry.connection().execute('SELECT state FROM rollout WHERE id = 1').fetchone()[0] != 'rolling':
+                return
+        statuses = self.registry.statuses()  # Read first; a sync can't run inside the write transaction
+        self.update_shared(lambda: RolloutController.evaluate(self, now, statuses))
+
+    def export(self):
+        return self.read_shared(super().export)
+
+    def status(self):
+        return self.read_shared(super().status)
+
+    def version_for(self, key, store_id, reported_version, now=None):
+        if not self.shared:
+            return super().version_for(key, store_id, reported_version, now)
+        now = now if now is not None else time.time()
+        connection = self.registry.connection()
+        row = connection.execute('SELECT version, wave, state, handed_at, updated_at, failed FROM rollout LEFT JOIN rollout_terminals ON key = ? WHERE id = 1', (key,)).fetchone()
+        version, wave, state, handed_at, updated_at, failed = row
+        if reported_version == version:
+            if updated_at is None:
+                self.registry.transaction(lambda connection: connection.execute(
+                    'INSERT INTO rollout_terminals (key, store_id, updated_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET handed_at = NULL, updated_at = coalesce(updated_at, excluded.updated_at)', (key, store_id, now)))
+            return version
+        if handed_at is not None:
+            return version
+        admitted = state == 'complete' or self.rank(key, version) < self.waves[wave]
+        if state == 'paused' or failed or not admitted:
+            return reported_version
+        count_in_flight = 'SELECT count(*) FROM rollout_terminals WHERE store_id = ? AND handed_at IS NOT NULL'
+        if connection.execute(count_in_flight, (store_id,)).fetchone()[0] >= self.max_downloads_per_store:
+            return reported_version  # Checked before taking the write lock; terminals of a busy store ask on every beat
+
+        def work(connection):
+            # Again under the write lock: another worker may have admitted a terminal, or the rollout changed
+            if connection.execute('SELECT version, state FROM rollout WHERE id = 1').fetchone() != (version, state):
+                return False
+            if connection.execute(count_in_flight, (store_id,)).fetchone()[0] >= self.max_downloads_per_store:
+                return False
+            connection.execute('INSERT INTO rollout_terminals (key, store_id, handed_at) VALUES (?, ?, ?) '
+                               'ON CONFLICT (key) DO UPDATE SET handed_at = excluded.handed_at', (key, store_id, now))
+            connection.execute('UPDATE rollout SET attempted = attempted + 1 WHERE id = 1')
+            return True
+
+        return version if self.registry.transaction(work) else reported_version
@@ -0,0 +1,118 @@
+import hashlib
+import lzma
+import struct
+from itertools import accumulate
+
+# Binary delta between two builds of terminal.exe. The base file is cut into fixed-size blocks
+# indexed by an rsync-style rolling checksum; the target is scanned byte by byte for blocks
+# that also appear in the base, and matches are extended as far as the bytes agree. The patch
+# is a list of COPY (range of the base) and INSERT (literal bytes) operations, lzma-compressed.
+
+MAGIC = b'IPSDELTA1'
+BLOCK_SIZE = 512
+HEADER = struct.Struct('<Q32sQ32s')  # base size, base sha256, target size, target sha256
+COPY = struct.Struct('<cQI')
+INSERT = struct.Struct('<cI')
+MAX_PATCH_RATIO = 0.8  # A patch must be under this share of the full build to be offered at all
+
+
+def weak_checksum(block):
+    # a = sum of bytes, b = sum of the running sums (rsync's second checksum), both mod 2**16
+    return (sum(block) & 0xffff) | ((sum(accumulate(block)) & 0xffff) << 16)
+
+
+def make_patch(base, target, block_size=BLOCK_SIZE):
+    blocks = {}
+    for offset in range(0, len(base) - block_size + 1, block_size):
+        blocks.setdefault(weak_checksum(base[offset:offset + block_size]), []).append(offset)
+
+    ops = []
+    literal_start = 0
+    position = 0
+    end = len(target) - block_size
+    a = b = None
+    while position <= end:
+        if a is None:
+            window = target[position:position + block_size]
+            a = sum(window) & 0xffff
+            b = sum(accumulate(window)) & 0xffff
+        match = None
+        for offset in blocks.get(a | (b << 16), ()):
+            if base[offset:offset + block_size] == target[position:position + block_size]:
+                match = offset
+                break
+        if match is None:
+            # Roll the window one byte forward
+            out_byte = target[position]
+            in_byte = target[position + block_size] if position < end else 0
+            a = (a - out_byte + in_byte) & 0xffff
+            b = (b - block_size * out_byte + a) & 0xffff
+            position += 1
+            continue
+        if literal_start < position:
+            ops.append(('I', literal_start, position))
+        # Extend the match block by block, then byte by byte
+        length = block_size
+        while match + length + block_size <= len(base) and position + length + block_size <= len(target) and \
+                base[match + length:match + length + block_size] == target[position + length:position + length + block_size]:
+            length += block_size
+        while match + length < len(base) and position + length < len(target) and base[match + length] == target[position + length]:
+            length += 1
+        if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == match and ops[-1][3] == position:
+            ops[-1] = ('C', ops[-1][1], ops[-1][2] + length, ops[-1][3])
+        else:
+            ops.append(('C', match, length, position))
+        position += length
+        literal_start = position
+        a = b = None
+    if literal_start < len(target):
+        ops.append(('I', literal_start, len(target)))
+
+    chunks = [MAGIC, HEADER.pack(len(base), hashlib.sha256(base).digest(), len(target), hashlib.sha256(target).digest())]
+    for op in ops:
+        if op[0] == 'C':
+            chunks.append(COPY.pack(b'C', op[1], op[2]))
+        else:
+            chunks.append(INSERT.pack(b'I', op[2] - op[1]))
+            chunks.append(target[op[1]:op[2]])
+    return lzma.compress(b''.join(chunks))
+
+
+def worthwhile(patch_size, target_size):
+    # With few matching blocks (a packed or rebuilt-from-scratch exe) the patch is about as big
+    # as the build, and downloading the build itself is simpler
+    return patch_size < MAX_PATCH_RATIO * target_size
+
+
+def read_header(data):
+    if not data.startswith(MAGIC):
+        raise ValueError("Not a delta patch")
+    base_size, base_sha256, target_size, target_sha256 = HEADER.unpack_from(data, len(MAGIC))
+    return base_size, base_sha256.hex(), target_size, target_sha256.hex()
+
+
+def apply_patch(base_path, patch, output_path):
+    # Rebuilds the target from base_path and the (compressed) patch into output_path.
+    # Raises ValueError if the base isn't the build the patch was made from.
+    data = lzma.decompress(patch)
+    base_size, base_sha256, target_size, _ = read_header(data)
+    position = len(MAGIC) + HEADER.size
+    with open(base_path, 'rb') as base, open(output_path, 'wb') as output:
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: base.read(1024 * 1024), b''):
+            sha256.update(chunk)
+        if base.tell() != base_size or sha256.hexdigest() != base_sha256:
+            raise ValueError("Patch was made for a different base build")
+        while position < len(data):
+            if data[position:position + 1] == b'C':
+                _, offset, length = COPY.unpack_from(data, position)
+                position += COPY.size
+                base.seek(offset)
+                output.write(base.read(length))
+            else:
+                _, length = INSERT.unpack_from(data, position)
+                position += INSERT.size
+                output.write(data[position:position + length])
+                position += length
+        if output.tell() != target_size:
+            raise ValueError("Patched file has the wrong size")
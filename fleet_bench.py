@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+import psutil
+import requests
+import socketio
+
+# Load test for server.py: simulates a fleet of terminals and a few dashboards in one asyncio process.
+# Every virtual terminal follows the terminal.py protocol (websocket Socket.IO connection with its ids
+# in the auth payload, a full /update on connect and whenever its state changes, keep-alives paced by
+# the heartbeat_timeout in the reply, log batches to /logs/batch, speedtest_results in answer to
+# speedtest_command). Dashboards log in, join the status feed and send speedtest commands.
+# Reports /update and /logs/batch latency, the delay from a terminal's /update to the change reaching
+# each dashboard (one sample per dashboard), command round trips, sequence gaps, terminals wrongly
+# marked disconnected while they were beating, and the server's CPU and RSS. --json writes the
+# results for diffing between commits, --compare prints the change against an earlier results file.
+# Usage: python fleet_bench.py [--terminals 1000] [--dashboards 5] [--seconds 60] [--json results.json]
+#        python fleet_bench.py --url http://server:80 --server-pid 1234  (an already running server)
+
+USERNAME = 'admin'
+PASSWORD = 'A5348513'
+MIN_HEARTBEAT_INTERVAL = 5  # Same pacing as terminal.py
+MAX_HEARTBEAT_INTERVAL = 60
+
+
+def percentiles(values, scale=1000):
+    # Milliseconds by default; empty lists give None so a missing metric is obvious in the diff
+    if not values:
+        return {'count': 0, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(int(len(values) * fraction), len(values) - 1)] * scale, 2)
+    return {'count': len(values), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(values[-1] * scale, 2)}
+
+
+class Stats:
+    def __init__(self):
+        self.update_latency = []
+        self.log_latency = []
+        self.fanout_delay = []
+        self.command_round_trip = []
+        self.errors = {}
+        self.false_disconnects = set()  # (key, seq), so a flap seen by every dashboard counts once
+        self.seq_gaps = 0
+        self.updates = 0
+        self.log_entries = 0
+        self.sent = {}  # (key, memory_usage) -> time the full status was sent
+        self.commands = {}  # key -> time the speedtest command was sent
+        self.measuring = False
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class VirtualTerminal:
+    def __init__(self, store_id, terminal_id, bench):
+        self.store_id = store_id
+        self.terminal_id = terminal_id
+        self.key = f"{store_id},{terminal_id}"
+        self.bench = bench
+        self.sio = socketio.AsyncClient(reconnection=False, http_session=bench.socket_http)
+        self.memory_usage = round(random.uniform(20, 60), 1)
+        self.interval = 10
+        self.sio.on('speedtest_command', self.on_speedtest_command)
+
+    async def connect(self):
+        await self.sio.connect(self.bench.url, auth={'store_id': self.store_id, 'terminal_id': self.terminal_id},
+                               transports=['websocket'], wait_timeout=10)
+        await self.send_status()
+
+    async def on_speedtest_command(self, data):
+        if data['store_id'] == self.store_id and data['terminal_id'] in (self.terminal_id, '*'):
+            await self.sio.emit('speedtest_results', {'store_id': self.store_id, 'terminal_id': self.terminal_id,
+                                                      'download_speed': 100.0, 'upload_speed': 20.0})
+
+    async def post(self, path, payload, latencies):
+        stats = self.bench.stats
+        started = time.perf_counter()
+        try:
+            async with self.bench.http.post(f"{self.bench.url}{path}", json=payload) as response:
+                reply = await response.json()
+                if response.status != 200:
+                    stats.error(f"{path} {response.status}")
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            stats.error(f"{path} {type(e).__name__}")
+            return None
+        if stats.measuring:
+            latencies.append(time.perf_counter() - started)
+        return reply
+
+    async def send_status(self):
+        # A full status; memory usage is the marker dashboards use to time the change's fan-out
+        self.memory_usage = round(self.memory_usage + random.choice((-1, 1)) * random.uniform(5, 10), 1)
+        self.bench.stats.sent[(self.key, self.memory_usage)] = time.perf_counter()
+        reply = await self.post('/update', {
+            'store_id': self.store_id, 'terminal_id': self.terminal_id, 'status': 'connected',
+            'ip': f"10.{hash(self.store_id) % 250}.0.{self.terminal_id}", 'isp': 'BenchNet',
+            'app_status': 'Running', 'memory_usage': self.memory_usage, 'logon_status': False,
+            'download_speed': None, 'upload_speed': None, 'version': '1.0'
+        }, self.bench.stats.update_latency)
+        self.pace(reply)
+
+    async def send_keepalive(self):
+        reply = await self.post('/update', {'store_id': self.store_id, 'terminal_id': self.terminal_id},
+                                self.bench.stats.update_latency)
+        self.pace(reply)
+        if reply and reply.get('full_status'):
+            await self.send_status()
+
+    def pace(self, reply):
+        if reply and reply.get('heartbeat_timeout'):
+            self.interval = min(max(reply['heartbeat_timeout'] / 3, MIN_HEARTBEAT_INTERVAL), MAX_HEARTBEAT_INTERVAL)
+        if reply:
+            self.bench.stats.updates += 1
+
+    async def send_logs(self):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        entry = {'store_id': self.store_id, 'terminal_id': self.terminal_id, 'log_entry': f"{timestamp} - App status: bench.exe Running\n"}
+        if await self.post('/logs/batch', {'entries': [entry]}, self.bench.stats.log_latency):
+            self.bench.stats.log_entries += 1
+
+    async def run(self, stop):
+        # Start at a random point of the interval so the fleet's beats are spread out like a real one
+        await asyncio.sleep(random.uniform(0, self.interval))
+        while not stop.is_set():
+            if random.random() < self.bench.change_rate:
+                await self.send_status()
+            else:
+                await self.send_keepalive()
+            if random.random() < self.bench.log_rate:
+                await self.send_logs()
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+class Dashboard:
+    def __init__(self, bench, cookie):
+        self.bench = bench
+        self.cookie = cookie
+        self.seq = None
+        self.sio = socketio.AsyncClient(reconnection=False, http_session=bench.dashboard_http)
+        self.sio.on('status_snapshot', self.on_snapshot)
+        self.sio.on('terminal_changed', self.on_changed)
+        self.sio.on('speedtest_results', self.on_speedtest_results)
+
+    async def connect(self):
+        await self.sio.connect(self.bench.url, headers={'Cookie': self.cookie}, transports=['websocket'], wait_timeout=10)
+
+    async def on_snapshot(self, data):
+        self.seq = data['seq']
+
+    async def on_changed(self, data):
+        stats = self.bench.stats
+        received = time.perf_counter()
+        if self.seq is not None and data['seq'] != self.seq + 1:
+            stats.seq_gaps += 1
+            await self.sio.emit('request_snapshot', {'since': self.seq})
+        self.seq = data['seq']
+        if not stats.measuring:
+            return
+        for key, record in data['changes'].items():
+            if record is None:
+                continue
+            if record['status'] == 'disconnected' and key in self.bench.beating:
+                stats.false_disconnects.add((key, data['seq']))
+            sent = stats.sent.get((key, record.get('memory_usage')))
+            if sent is not None:
+                stats.fanout_delay.append(received - sent)
+
+    async def on_speedtest_results(self, data):
+        sent = self.bench.stats.commands.pop(f"{data['store_id']},{data['terminal_id']}", None)
+        if sent is not None and self.bench.stats.measuring:
+            self.bench.stats.command_round_trip.append(time.perf_counter() - sent)
+
+    async def run(self, stop, terminals):
+        # A speedtest command now and then, the way an operator would click the button
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), self.bench.command_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            terminal = random.choice(terminals)
+            self.bench.stats.commands[terminal.key] = time.perf_counter()
+            await self.sio.emit('perform_speedtest', terminal.key)
+
+
+class FleetBench:
+    def __init__(self, url, args):
+        self.url = url
+        self.args = args
+        self.change_rate = args.change_rate
+        self.log_rate = args.log_rate
+        self.command_interval = args.command_interval
+        self.stats = Stats()
+        self.beating = set()  # Keys of terminals that are running their heartbeat loop
+        self.http = None
+        self.socket_http = None
+        self.dashboard_http = None
+
+    async def login(self):
+        async with self.http.post(f"{self.url}/login", data={'username': USERNAME, 'password': PASSWORD}, allow_redirects=False) as response:
+            if response.status not in (200, 302):
+                raise RuntimeError(f"Login failed: {response.status}")
+            cookie = response.cookies.get('session')
+        if cookie is None:
+            raise RuntimeError("Login did not return a session cookie")
+        return f"session={cookie.value}"
+
+    async def run(self, server):
+        args = self.args
+        connector = aiohttp.TCPConnector(limit=args.http_connections)
+        timeout = aiohttp.ClientTimeout(total=30)
+        # Terminals don't log in, so the session cookie is only handed to the dashboards explicitly
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, cookie_jar=aiohttp.DummyCookieJar()) as self.http:
+            cookie = await self.login()
+            # Every websocket holds a connection for good, so the sockets get their own unlimited pool
+            self.socket_http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), cookie_jar=aiohttp.DummyCookieJar())
+            # The websocket handshake takes its cookies from the session's jar, which by default
+            # holds none for an IP address like 127.0.0.1
+            self.dashboard_http = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+            stores = (args.terminals + args.terminals_per_store - 1) // args.terminals_per_store
+            fleet = [(f"Bench{s}", str(t)) for s in range(stores) for t in range(args.terminals_per_store)][:args.terminals]
+            expected = {}
+            for store_id, terminal_id in fleet:
+                expected.setdefault(store_id, []).append(terminal_id)
+            async with self.http.post(f"{self.url}/load_expected_terminals", json=expected, headers={'Cookie': cookie}) as response:
+                response.raise_for_status()
+
+            dashboards = [Dashboard(self, cookie) for _ in range(args.dashboards)]
+            await asyncio.gather(*(dashboard.connect() for dashboard in dashboards))
+            terminals = [VirtualTerminal(store_id, terminal_id, self) for store_id, terminal_id in fleet]
+            started = time.perf_counter()
+            gate = asyncio.Semaphore(args.connect_concurrency)
+
+            async def connect(terminal):
+                async with gate:
+                    try:
+                        await terminal.connect()
+                        self.beating.add(terminal.key)
+                    except (socketio.exceptions.ConnectionError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        self.stats.error(f"connect {type(e).__name__}")
+            await asyncio.gather(*(connect(terminal) for terminal in terminals))
+            connect_seconds = time.perf_counter() - started
+            connected = [terminal for terminal in terminals if terminal.key in self.beating]
+
+            stop = asyncio.Event()
+            tasks = [asyncio.create_task(terminal.run(stop)) for terminal in connected]
+            tasks += [asyncio.create_task(dashboard.run(stop, connected)) for dashboard in dashboards if connected]
+            # Let the first round of beats settle before measuring
+            await asyncio.sleep(args.warmup)
+            cpu_before = server.cpu_times() if server else None
+            measured_from = time.perf_counter()
+            updates_before, logs_before = self.stats.updates, self.stats.log_entries
+            self.stats.measuring = True
+            await asyncio.sleep(args.seconds)
+            self.stats.measuring = False
+            measured = time.perf_counter() - measured_from
+            server_stats = {}
+            if server:
+                cpu_after = server.cpu_times()
+                busy = (cpu_after.user + cpu_after.system) - (cpu_before.user + cpu_before.system)
+                memory = server.memory_info().rss
+                for child in server.children(recursive=True):
+                    memory += child.memory_info().rss  # Workers in multi-process mode
+                server_stats = {'cpu_percent': round(100 * busy / measured, 1), 'rss_mb': round(memory / 2 ** 20, 1)}
+            stop.set()
+            self.beating.clear()
+            await asyncio.gather(*tasks)
+            await asyncio.gather(*(client.sio.disconnect() for client in connected + dashboards), return_exceptions=True)
+            await self.socket_http.close()
+            await self.dashboard_http.close()
+
+        stats = self.stats
+        return {
+            'config': {
+                'terminals': args.terminals, 'dashboards': args.dashboards, 'seconds': args.seconds,
+                'change_rate': args.change_rate, 'log_rate': args.log_rate, 'async_mode': args.async_mode,
+                'workers': args.workers, 'commit': git_commit()
+            },
+            'connected_terminals': len(connected),
+            'connect_seconds': round(connect_seconds, 2),
+            'updates_per_second': round((stats.updates - updates_before) / measured, 1),
+            'log_entries_per_second': round((stats.log_entries - logs_before) / measured, 1),
+            'update_latency_ms': percentiles(stats.update_latency),
+            'log_latency_ms': percentiles(stats.log_latency),
+            'fanout_delay_ms': percentiles(stats.fanout_delay),
+            'command_round_trip_ms': percentiles(stats.command_round_trip),
+            'false_disconnects': len(stats.false_disconnects),
+            'seq_gaps': stats.seq_gaps,
+            'errors': stats.errors,
+            'server': server_stats,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f"{url}/check_update", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+def start_server(args):
+    # Runs server.py from a scratch directory so its log and state files don't land in the checkout
+    env = dict(os.environ, SERVER_ASYNC=args.async_mode, SERVER_WORKERS=str(args.workers), SERVER_PORT=str(args.port),
+               STATE_DB='bench_state.db', SHARED_STATE_DB='bench_shared.db', BUS_ADDRESS=f"127.0.0.1:{args.port + 1}")
+    workdir = tempfile.mkdtemp()
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return server, workdir
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict) and name != 'errors':
+            flat.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{name}"] = value
+    return flat
+
+
+def compare(previous, results):
+    before, after = flatten(previous), flatten(results)
+    for name in sorted(set(before) | set(after)):
+        old, new = before.get(name), after.get(name)
+        if old == new:
+            continue
+        change = f" ({(new - old) / old * 100:+.1f}%)" if old and new is not None else ''
+        print(f"  {name}: {old} -> {new}{change}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate a terminal fleet and dashboards against server.py")
+    parser.add_argument('--terminals', type=int, default=1000)
+    parser.add_argument('--terminals-per-store', type=int, default=10)
+    parser.add_argument('--dashboards', type=int, default=5)
+    parser.add_argument('--seconds', type=float, default=60, help="measured duration, after the warm-up")
+    parser.add_argument('--warmup', type=float, default=10)
+    parser.add_argument('--change-rate', type=float, default=0.1, help="share of beats that are full status changes")
+    parser.add_argument('--log-rate', type=float, default=0.05, help="share of beats followed by a log batch")
+    parser.add_argument('--command-interval', type=float, default=5, help="seconds between each dashboard's speedtest commands")
+    parser.add_argument('--connect-concurrency', type=int, default=50)
+    parser.add_argument('--http-connections', type=int, default=200)
+    parser.add_argument('--url', help="benchmark a running server instead of starting server.py")
+    parser.add_argument('--server-pid', type=int, help="pid of the server behind --url, for CPU and RSS")
+    parser.add_argument('--async-mode', default='threading', help="SERVER_ASYNC for the started server")
+    parser.add_argument('--workers', type=int, default=1, help="SERVER_WORKERS for the started server")
+    parser.add_argument('--port', type=int, default=18790)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="print the change against an earlier --json file")
+    args = parser.parse_args()
+
+    process, workdir = None, None
+    if args.url:
+        url = args.url.rstrip('/')
+    else:
+        url = f"http://127.0.0.1:{args.port}"
+        process, workdir = start_server(args)
+    try:
+        wait_for_server(url)
+        pid = args.server_pid or (process.pid if process else None)
+        results = asyncio.run(FleetBench(url, args).run(psutil.Process(pid) if pid else None))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            print(f"Change from {args.compare}:")
+            compare(json.load(f), results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,89 @@
+import heapq
+import logging
+import time
+from threading import Condition
+
+
+class HeartbeatMonitor:
+    # Keeps one expiry deadline per terminal in a min-heap and sleeps until the earliest one.
+    # Every heartbeat pushes a fresh (deadline, key) entry; superseded entries are skipped
+    # when popped, so each wake-up only costs as much as the number of expirations.
+    def __init__(self, timeout, on_expired, metrics=None, retry_delay=1):
+        self.timeout = timeout
+        self.retry_delay = retry_delay  # Seconds before expiring a batch again after on_expired failed
+        self.metrics = metrics
+        self.on_expired = on_expired
+        self.deadlines = {}
+        self.heap = []
+        self.condition = Condition()
+        self.running = True
+
+    def beat(self, key, now=None):
+        deadline = (now if now is not None else time.time()) + self.timeout
+        with self.condition:
+            previous = self.deadlines.get(key)
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+            # Drop superseded entries once they make up most of the heap
+            if len(self.heap) > 4 * len(self.deadlines) + 64:
+                self.heap = [(d, k) for k, d in self.deadlines.items()]
+                heapq.heapify(self.heap)
+            if self.heap[0] == (deadline, key):
+                self.condition.notify()
+        if self.metrics and previous is not None:
+            # Time since this terminal's previous beat; close to the timeout means it nearly flapped
+            self.metrics.observe('heartbeat_gap_seconds', deadline - previous)
+
+    def forget(self, key):
+        with self.condition:
+            self.deadlines.pop(key, None)
+
+    def pop_expired(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                expired.append(key)
+                if self.metrics:
+                    self.metrics.observe('heartbeat_expiry_lag_seconds', now - deadline)
+        return expired
+
+    def run(self):
+        with self.condition:
+            while self.running:
+                expired = self.pop_expired(time.time())
+                if expired:
+                    # Everything that expired together is reported as one batch, outside the lock
+                    self.condition.release()
+                    started = time.perf_counter()
+                    failed = False
+                    try:
+                        self.on_expired(expired)
+                    except Exception as e:
+                        # e.g. the shared registry was locked; the thread must outlive it or nothing expires again
+                        logging.error(f"Error expiring {len(expired)} terminals: {e}")
+                        failed = True
+                    finally:
+                        if self.metrics:
+                            self.metrics.observe('heartbeat_expire_seconds', time.perf_counter() - started)
+                        self.condition.acquire()
+                    if failed:
+                        self.retry(expired)
+                    continue
+                wait = self.heap[0][0] - time.time() if self.heap else None
+                if wait is None or wait > 0:
+                    self.condition.wait(wait)
+
+    def retry(self, keys):
+        # Expire again shortly, unless a terminal beat while on_expired was failing
+        deadline = time.time() + self.retry_delay
+        for key in keys:
+            if key not in self.deadlines:
+                self.deadlines[key] = deadline
+                heapq.heappush(self.heap, (deadline, key))
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -0,0 +1,336 @@
+import json
+import logging
+import mmap
+import os
+import queue
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+
+class LogSegment:
+    # One log file (server_logs.txt or a rotated server_logs.txt.N) plus its in-memory index:
+    # the byte offset, time and receive time of every record, and the record numbers per store
+    # and per store/terminal. The same data is appended to a sidecar .idx file so a restart only
+    # has to read the index, not the log. A record's time is when the terminal logged it, which
+    # for entries held back during an outage is earlier than its place in the file; max_lag is
+    # how much earlier at most, so time filters bisect the receive times and check the rest.
+    def __init__(self, path, generation):
+        self.path = path
+        self.generation = generation
+        self.offsets = array('q')
+        self.timestamps = array('d')
+        self.received = array('d')
+        self.max_lag = 0
+        self.by_store = {}
+        self.by_terminal = {}
+        self.size = 0
+
+    @property
+    def index_path(self):
+        return f"{self.path}.idx"
+
+    def add(self, offset, length, ts, store_id, terminal_id, received=None):
+        record = len(self.offsets)
+        self.offsets.append(offset)
+        self.timestamps.append(ts)
+        received = ts if received is None else received
+        # Keep the receive times sorted even if the clock steps back a little
+        self.received.append(max(received, self.received[-1]) if self.received else received)
+        self.max_lag = max(self.max_lag, self.received[-1] - ts)
+        self.by_store.setdefault(store_id, array('l')).append(record)
+        self.by_terminal.setdefault(f"{store_id},{terminal_id}", array('l')).append(record)
+        self.size = offset + length
+
+    def end(self, record):
+        return self.offsets[record + 1] if record + 1 < len(self.offsets) else self.size
+
+    def select(self, store_id, terminal_id, since, until, start):
+        # Record numbers >= start matching the filters, in file order
+        lo = max(start, bisect_left(self.received, since) if since is not None else 0)
+        hi = bisect_right(self.received, until + self.max_lag) if until is not None else len(self.offsets)
+        if store_id is None:
+            records = range(lo, hi)
+        else:
+            if terminal_id is None:
+                records = self.by_store.get(store_id, ())
+            else:
+                records = self.by_terminal.get(f"{store_id},{terminal_id}", ())
+            records = records[bisect_left(records, lo):bisect_left(records, hi)]
+        if self.max_lag and (since is not None or until is not None):
+            # Some records were logged before they were received; the range above holds them all
+            timestamps = self.timestamps
+            records = [record for record in records if (since is None or timestamps[record] >= since) and (until is None or timestamps[record] <= until)]
+        return records
+
+    @classmethod
+    def load(cls, path, generation):
+        # Read the sidecar index, then index whatever the log has beyond it (e.g. after a crash)
+        segment = cls(path, generation)
+        try:
+            with open(segment.index_path) as index:
+                header = json.loads(index.readline() or '{}')
+                segment.generation = header.get('generation', generation)
+                for line in index:
+                    try:
+                        offset, length, ts, store_id, terminal_id, *received = json.loads(line)
+                    except ValueError:
+                        break
+                    segment.add(offset, length, ts, store_id, terminal_id, *received)
+        except FileNotFoundError:
+            pass
+        segment.catch_up()
+        return segment
+
+    def catch_up(self):
+        # Index whole records written to the log beyond what is indexed so far
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as log:
+            log.seek(self.size)
+            offset = self.size
+            for line in log:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                    self.add(offset, len(line), record['ts'], record['store_id'], record['terminal_id'], record.get('received'))
+                except (ValueError, KeyError, TypeError):
+                    pass
+                offset += len(line)
+            self.size = offset
+
+    @staticmethod
+    def read_generation(path):
+        try:
+            with open(f"{path}.idx") as index:
+                return json.loads(index.readline() or '{}').get('generation')
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+class LogStore:
+    # Owns the open log file on a single writer thread. Request handlers only enqueue entries;
+    # the writer drains everything that is waiting, writes it in one go and rotates the file
+    # (server_logs.txt.1, .2, ...) once it passes max_bytes. Records are newline-delimited JSON,
+    # indexed per store/terminal and by time so /logs can read just the matching byte ranges.
+    # The queue holds at most max_queue entries; past that, writes are refused rather than piling
+    # up behind a writer that can't keep up (or can't write at all, e.g. with the disk full).
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5, buffer_size=64 * 1024, max_queue=100000, metrics=None):
+        self.path = path
+        self.metrics = metrics
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = Lock()
+        self.segments = []
+        self.file = None
+        self.index_file = None
+        self.entries_written = 0
+        self.bytes_written = 0
+        self.entries_dropped = 0  # Refused because the queue was full, or lost to a failed write
+
+    def write(self, store_id, terminal_id, log_entry, logged_at=None):
+        return self.write_many([(store_id, terminal_id, log_entry, logged_at)])
+
+    def write_many(self, entries):
+        # (store_id, terminal_id, log_entry, logged_at); logged_at is when the terminal logged it
+        # (unix time), or None for now. Returns False if the queue was full and entries were dropped.
+        now = time.time()
+        entries = list(entries)
+        if self.queue.maxsize and self.queue.maxsize - self.queue.qsize() < len(entries):
+            # All or nothing, so a sender that retries doesn't store the first part twice
+            self.entries_dropped += len(entries)
+            logging.error(f"Log queue full, refused {len(entries)} entries")
+            return False
+        for queued, (store_id, terminal_id, log_entry, logged_at) in enumerate(entries):
+            try:
+                self.queue.put_nowait((now, store_id, terminal_id, log_entry, logged_at))
+            except queue.Full:
+                self.entries_dropped += len(entries) - queued
+                logging.error(f"Log queue full, dropped {len(entries) - queued} entries")
+                return False
+        return True
+
+    def segment_path(self, age):
+        return self.path if age == 0 else f"{self.path}.{age}"
+
+    def open(self):
+        # Logs written before records were indexed can't be served by /logs, keep them aside
+        if os.path.exists(self.path) and not os.path.exists(f"{self.path}.idx") and not os.path.exists(f"{self.path}.legacy"):
+            os.replace(self.path, f"{self.path}.legacy")
+        self.load_segments()
+        self.open_current()
+
+    def load_segments(self):
+        current = LogSegment.load(self.path, 0)
+        segments = [current]
+        for age in range(1, self.backup_count + 1):
+            path = self.segment_path(age)
+            if os.path.exists(f"{path}.idx"):
+                segments.insert(0, LogSegment.load(path, current.generation - age))
+        with self.lock:
+            self.segments = segments
+
+    def refresh(self):
+        # For processes that only read a log another process writes: index what was written
+        # since the last call, or reload every segment if the log has rotated since
+        with self.lock:
+            current = self.segments[-1] if self.segments else None
+            if current is not None and LogSegment.read_generation(self.path) == current.generation:
+                current.catch_up()
+                return
+        self.load_segments()
+
+    def open_current(self):
+        current = self.segments[-1]
+        self.file = open(current.path, 'ab', buffering=self.buffer_size)
+        # Drop a torn last line, if any, so new records start on a fresh line
+        if self.file.tell() != current.size:
+            self.file.truncate(current.size)
+            self.file.seek(current.size)
+        new_index = not os.path.exists(current.index_path)
+        self.index_file = open(current.index_path, 'a')
+        if new_index:
+            self.index_file.write(json.dumps({'generation': current.generation}) + '\n')
+            self.index_file.flush()
+
+    def rotate(self):
+        self.file.close()
+        self.index_file.close()
+        with self.lock:
+            # Every segment moves one step older; the oldest falls off once there are backup_count
+            kept = self.segments[-self.backup_count:] if self.backup_count else []
+            for segment in self.segments:
+                if segment not in kept:
+                    for path in (segment.path, segment.index_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+            for age, segment in zip(range(len(kept), 0, -1), kept):
+                path = self.segment_path(age)
+                os.replace(segment.path, path)
+                if os.path.exists(segment.index_path):
+                    os.replace(segment.index_path, f"{path}.idx")
+                segment.path = path
+            self.segments = kept + [LogSegment(self.path, self.segments[-1].generation + 1)]
+        self.open_current()
+
+    def run(self):
+        self.open()
+        try:
+            while True:
+                entry = self.queue.get()
+                if entry is None:
+                    return
+                batch = [entry]
+                # Take everything else that is already waiting so it goes out in one write
+                while True:
+                    try:
+                        entry = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        self.write_safely(batch)
+                        return
+                    batch.append(entry)
+                self.write_safely(batch)
+        finally:
+            self.close()
+
+    def write_safely(self, batch):
+        # This is the only writer thread, so an error (disk full, a failed rotation) must not end it
+        try:
+            self.write_batch(batch)
+        except Exception as e:
+            self.entries_dropped += len(batch)
+            logging.error(f"Error writing {len(batch)} log entries, dropped them: {e}")
+            # Start again from what is on disk: re-index the log and cut off any torn record
+            try:
+                self.close()
+                self.open()
+            except Exception as e:
+                logging.error(f"Error reopening {self.path}: {e}")
+
+    def close(self):
+        for file in (self.file, self.index_file):
+            if file is not None:
+                try:
+                    file.close()
+                except OSError:
+                    pass  # Flushing a full disk
+        self.file = self.index_file = None
+
+    def write_batch(self, batch):
+        started = time.perf_counter()
+        segment = self.segments[-1]
+        offset = segment.size
+        records = []
+        for received, store_id, terminal_id, log_entry, logged_at in batch:
+            record = {'ts': received, 'store_id': store_id, 'terminal_id': terminal_id, 'entry': (log_entry or '').rstrip('\n')}
+            # The terminal's clock can't put an entry after we got it
+            if isinstance(logged_at, (int, float)) and logged_at < received:
+                record['ts'], record['received'] = logged_at, received
+            data = (json.dumps(record) + '\n').encode('utf-8')
+            records.append((offset, data, record['ts'], store_id, terminal_id, received))
+            offset += len(data)
+        self.file.write(b''.join(record[1] for record in records))
+        self.file.flush()
+        self.index_file.write(''.join(json.dumps([start, len(data), ts, store_id, terminal_id] + ([received] if received != ts else [])) + '\n'
+                                      for start, data, ts, store_id, terminal_id, received in records))
+        self.index_file.flush()
+        # Only index records once they are on disk, so readers never map past the end of the file
+        for start, data, ts, store_id, terminal_id, received in records:
+            segment.add(start, len(data), ts, store_id, terminal_id, received)
+        self.entries_written += len(records)
+        self.bytes_written += offset - records[0][0]  # offset is the end of the batch
+        if segment.size >= self.max_bytes:
+            self.rotate()
+        if self.metrics:
+            self.metrics.observe('log_write_seconds', time.perf_counter() - started)
+            self.metrics.observe('log_batch_entries', len(records))
+
+    def query(self, store_id=None, terminal_id=None, since=None, until=None, cursor=None, limit=500):
+        # Returns (files, next_cursor). files is a list of (open file, [(start, end), ...]) byte ranges
+        # holding the matching records in order; next_cursor is None on the last page.
+        # A cursor is "<generation>:<record>" of the first record of the next page.
+        start_generation, start_record = (int(part) for part in cursor.split(':')) if cursor else (None, 0)
+        if self.file is None:
+            self.refresh()  # Another process writes this log
+        files = []
+        remaining = limit
+        with self.lock:
+            for segment in self.segments:
+                if start_generation is not None and segment.generation < start_generation:
+                    continue
+                first = start_record if segment.generation == start_generation else 0
+                records = segment.select(store_id, terminal_id, since, until, first)
+                if remaining == 0:
+                    if len(records):
+                        return files, f"{segment.generation}:{records[0]}"
+                    continue
+                page = records[:remaining]
+                remaining -= len(page)
+                spans = []
+                for record in page:
+                    start, end = segment.offsets[record], segment.end(record)
+                    if spans and spans[-1][1] == start:
+                        spans[-1] = (spans[-1][0], end)  # Neighbouring records are read as one range
+                    else:
+                        spans.append((start, end))
+                if spans:
+                    files.append((open(segment.path, 'rb'), spans))
+                if remaining == 0 and len(records) > len(page):
+                    return files, f"{segment.generation}:{records[len(page)]}"
+        return files, None
+
+    def stream(self, files):
+        # Yields the selected byte ranges straight from a read-only mapping of each log file
+        for file, spans in files:
+            with file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for start, end in spans:
+                    yield view[start:end]
+
+    def stop(self):
+        self.queue.put(None)
@@ -0,0 +1,135 @@
+import bisect
+from threading import Lock
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return f"{{{','.join(pairs)}}}" if pairs else ''
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, label_values=()):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def export(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self, others=()):
+        # others: exports of the same counter from other processes, added in
+        values = self.export()
+        for other in others:
+            for label_values, value in other.items():
+                values[label_values] = values.get(label_values, 0) + value
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    # Cumulative buckets are only summed up when rendered; observe just bumps one slot
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [count per bucket (last is +Inf), sum]
+        self.lock = Lock()
+
+    def observe(self, value, label_values=()):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += value
+
+    def export(self):
+        with self.lock:
+            return {label_values: [list(counts), total] for label_values, (counts, total) in self.series.items()}
+
+    def render(self, others=()):
+        series = self.export()
+        for other in others:
+            for label_values, (counts, total) in other.items():
+                mine = series.setdefault(label_values, [[0] * len(counts), 0.0])
+                mine[0] = [a + b for a, b in zip(mine[0], counts)]
+                mine[1] += total
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class Metrics:
+    # In-process metrics served by /metrics in the Prometheus text format. Hot paths call
+    # observe/inc by metric name; counters a component already keeps for itself (and gauges like
+    # terminal counts) are registered as collectors and only read when /metrics is scraped.
+    # A disabled instance drops every observation and renders nothing.
+    def __init__(self, enabled=True, prefix='ips_'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.metrics = {}
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        self.metrics[name] = Counter(self.prefix + name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.metrics[name] = Histogram(self.prefix + name, help, labels, buckets)
+
+    def collector(self, collect):
+        # collect() returns [(name, type, help, [(label dict, value)])], type 'gauge' or 'counter'
+        self.collectors.append(collect)
+
+    def observe(self, name, value, label_values=()):
+        if self.enabled:
+            self.metrics[name].observe(value, label_values)
+
+    def inc(self, name, amount=1, label_values=()):
+        if self.enabled:
+            self.metrics[name].inc(amount, label_values)
+
+    def export(self):
+        # Counter and histogram values, picklable, for another process to render with its own
+        return {name: metric.export() for name, metric in self.metrics.items()}
+
+    def render(self, others=()):
+        # others: exports from other processes, summed into the counters and histograms.
+        # Collectors are only run here.
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.render([other[name] for other in others if name in other]))
+        for collect in self.collectors:
+            for name, kind, help, samples in collect():
+                name = self.prefix + name
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels.keys(), labels.values())} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
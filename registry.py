@@ -0,0 +1,372 @@
+import json
+import sys
+import time
+from enum import Enum
+from threading import Lock
+
+
+class Status(Enum):
+    CONNECTED = 'connected'
+    DISCONNECTED = 'disconnected'
+
+
+class AppStatus(Enum):
+    RUNNING = 'Running'
+    NOT_RUNNING = 'Not running'
+
+
+# Shared placeholder for expected terminals that have never reported. It is handed out
+# for every missing terminal, so it must never be mutated.
+DISCONNECTED_PLACEHOLDER = {'ip': 'N/A', 'isp': 'N/A', 'status': 'disconnected', 'app_status': 'Not running', 'memory_usage': 'N/A'}
+DISCONNECTED_PLACEHOLDER_JSON = json.dumps(DISCONNECTED_PLACEHOLDER)
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def terminal_key(store_id, terminal_id):
+    return sys.intern(f"{store_id},{terminal_id}")
+
+
+class TerminalRecord:
+    # Live state of one terminal, updated in place on every report. Identifiers and strings many
+    # terminals share (ISP, version) are interned, statuses are enum members and memory usage is
+    # a plain float (None until reported). The record's JSON is cached until a visible field changes.
+    # A record restored from the state store is stale until the terminal reports again.
+    __slots__ = ('store_id', 'terminal_id', 'key', 'ip', 'isp', 'status', 'last_heartbeat',
+                 'app_status', 'memory_usage', 'version', 'stale', '_json')
+
+    def __init__(self, store_id, terminal_id):
+        self.store_id = intern(store_id)
+        self.terminal_id = intern(terminal_id)
+        self.key = terminal_key(store_id, terminal_id)
+        self.ip = None
+        self.isp = None
+        self.status = Status.CONNECTED
+        self.last_heartbeat = None
+        self.app_status = AppStatus.NOT_RUNNING
+        self.memory_usage = None
+        self.version = None
+        self.stale = False
+        self._json = None
+
+    @staticmethod
+    def normalize(field, value):
+        # A reported value in the form the record keeps it
+        if field == 'status':
+            return Status.DISCONNECTED if value == 'disconnected' else Status.CONNECTED
+        if field == 'app_status':
+            return AppStatus.RUNNING if value == 'Running' else AppStatus.NOT_RUNNING
+        if field == 'memory_usage':
+            return float(value) if isinstance(value, (int, float)) else None
+        return intern(value)
+
+    def would_change(self, fields):
+        # Whether update(fields) would change anything besides the heartbeat, without applying it
+        return self.stale or any(getattr(self, field) != self.normalize(field, value)
+                                 for field, value in fields.items() if field != 'last_heartbeat')
+
+    def update(self, fields):
+        # Applies a full or partial report; returns True if anything besides the heartbeat changed
+        changed = self.stale
+        self.stale = False
+        for field, value in fields.items():
+            if field == 'last_heartbeat':
+                self.last_heartbeat = value
+                continue
+            value = self.normalize(field, value)
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+        if changed:
+            self._json = None
+        return changed
+
+    def set_status(self, status):
+        if self.status is status and not self.stale:
+            return False
+        self.status = status
+        self.stale = False
+        self._json = None
+        return True
+
+    def to_dict(self):
+        # The heartbeat time is left out: it moves on every keep-alive without changing what
+        # dashboards show, and leaving it in would make to_dict and the cached to_json disagree
+        record = {
+            'ip': self.ip,
+            'isp': self.isp,
+            'status': self.status.value,
+            'app_status': self.app_status.value,
+            'memory_usage': 'N/A' if self.memory_usage is None else self.memory_usage,
+            'version': self.version
+        }
+        if self.stale:
+            record['stale'] = True
+        return record
+
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self.to_dict())
+        return self._json
+
+    @classmethod
+    def from_dict(cls, store_id, terminal_id, data):
+        # Rebuilds a record from its serialized form (to_dict), e.g. one saved by another process
+        record = cls(store_id, terminal_id)
+        record.update({field: value for field, value in data.items() if field != 'stale'})
+        record.stale = bool(data.get('stale'))
+        return record
+
+
+def serialize(record):
+    # Dashboard shape of a view entry; None stands for an expected terminal that never reported
+    return DISCONNECTED_PLACEHOLDER if record is None else record.to_dict()
+
+
+class RegistryShard:
+    # The records of the stores that hash to this shard, guarded by one lock. Records are only
+    # read or written under it, so a reader never sees half of a report.
+    def __init__(self):
+        self.lock = Lock()
+        self.records = {}
+        self.version = 0
+        self._fragments = {}
+        self._fragments_version = None
+
+    def report(self, store_id, terminal_id, key, fields):
+        # Returns the record and its serialized state if the visible state changed, else None
+        with self.lock:
+            record = self.records.get(key)
+            if record is None:
+                record = TerminalRecord(store_id, terminal_id)
+                self.records[key] = record
+                record.update(fields)
+                changed = True
+            else:
+                changed = record.update(fields)
+            if not changed:
+                return record, None
+            self.version += 1
+            return record, record.to_dict()
+
+    def mark_disconnected(self, keys, changes):
+        with self.lock:
+            for key in keys:
+                record = self.records.get(key)
+                if record is not None and record.set_status(Status.DISCONNECTED):
+                    changes[key] = record.to_dict()
+                    self.version += 1
+
+    def restore(self, store_id, terminal_id, key, fields):
+        # Puts back a record saved before a restart, unless the terminal has already reported since
+        with self.lock:
+            if key in self.records:
+                return False
+            record = TerminalRecord.from_dict(store_id, terminal_id, fields)
+            record.stale = True
+            self.records[key] = record
+            self.version += 1
+            return True
+
+    def put(self, key, record):
+        # Replaces the record for key; returns True if its serialized state differs from before
+        with self.lock:
+            previous = self.records.get(key)
+            self.records[key] = record
+            if previous is not None and previous.to_json() == record.to_json():
+                return False
+            self.version += 1
+            return True
+
+    def export(self):
+        with self.lock:
+            return [(record.store_id, record.terminal_id, record.to_dict()) for record in self.records.values()]
+
+    def serialize(self, keys):
+        with self.lock:
+            return {key: serialize(self.records.get(key)) for key in keys}
+
+    def snapshot(self):
+        with self.lock:
+            return self.version, {key: record.to_dict() for key, record in self.records.items()}
+
+    def fragments(self):
+        # {key: JSON of the record}, rebuilt when the shard has changed since the last call
+        with self.lock:
+            if self._fragments_version != self.version:
+                self._fragments = {key: record.to_json() for key, record in self.records.items()}
+                self._fragments_version = self.version
+            return self.version, self._fragments
+
+    def statuses(self):
+        with self.lock:
+            return [(key, record.status) for key, record in self.records.items()]
+
+
+class TerminalRegistry:
+    # Owns the expected terminal list and the live records. Records are striped over shards by
+    # store so reports from different stores don't contend for one lock, and readers hold one
+    # shard lock at a time, so they never block writers to the rest of the fleet. The view order
+    # (expected terminals first, then unknown ones in the order they first reported) is a list
+    # that only changes under layout_lock when a new unknown terminal appears or the expected
+    # list is reloaded. Changes are returned as {key: serialized record}, None for removed keys.
+    def __init__(self, shard_count=16):
+        self.shards = [RegistryShard() for _ in range(shard_count)]
+        self.layout_lock = Lock()
+        self.expected = {}
+        self.layout = []
+        self.layout_keys = set()
+        self.layout_version = 0
+        self.epoch = int(time.time())
+        self.json_lock = Lock()
+        self._json = None
+        self._json_versions = None
+
+    def shard_index(self, key):
+        return hash(key.rpartition(',')[0]) % len(self.shards)
+
+    def shard_for(self, key):
+        return self.shards[self.shard_index(key)]
+
+    @property
+    def version(self):
+        return self.layout_version + sum(shard.version for shard in self.shards)
+
+    def live_keys(self):
+        keys = []
+        for shard in self.shards:
+            with shard.lock:
+                keys.extend(shard.records)
+        return keys
+
+    def load_expected(self, expected):
+        # Returns the changes to the combined view; None marks a key that is no longer shown
+        with self.layout_lock:
+            layout = {}
+            for store, terminals in expected.items():
+                for terminal in terminals:
+                    layout[terminal_key(store, terminal)] = True
+            # Unknown terminals that reported keep their order after the expected ones
+            live_keys = self.live_keys()
+            live = set(live_keys)
+            for key in self.layout:
+                if key in live:
+                    layout.setdefault(key, True)
+            for key in live_keys:
+                layout.setdefault(key, True)
+            layout_keys = set(layout)
+            layout = list(layout)
+            added = [key for key in layout if key not in self.layout_keys]
+            removed = [key for key in self.layout if key not in layout_keys]
+            self.expected = expected
+            self.layout = layout
+            self.layout_keys = layout_keys
+            changes = {}
+            for key in added:
+                changes.update(self.shard_for(key).serialize([key]))
+            changes.update({key: None for key in removed})
+            if changes:
+                self.layout_version += 1
+            return changes
+
+    def report(self, store_id, terminal_id, fields):
+        # Merges a full or partial report into the terminal's record. Returns the record and
+        # {key: serialized record} if the visible state changed; the heartbeat alone does not count.
+        key = terminal_key(store_id, terminal_id)
+        record, serialized = self.shard_for(key).report(store_id, terminal_id, key, fields)
+        self.add_to_layout([key])
+        return record, {key: serialized} if serialized is not None else {}
+
+    def add_to_layout(self, keys):
+        # Appends terminals that aren't shown yet after the ones that are
+        if all(key in self.layout_keys for key in keys):
+            return
+        with self.layout_lock:
+            added = [key for key in keys if key not in self.layout_keys]
+            self.layout.extend(added)
+            self.layout_keys.update(added)
+            if added:
+                self.layout_version += 1
+
+    def restore(self, records):
+        # Restores (store_id, terminal_id, fields) saved by the state store, marked stale.
+        # Returns the keys that were restored.
+        restored = []
+        for store_id, terminal_id, fields in records:
+            key = terminal_key(store_id, terminal_id)
+            if self.shard_for(key).restore(store_id, terminal_id, key, fields):
+                restored.append(key)
+        self.add_to_layout(restored)
+        return restored
+
+    def export(self):
+        # [(store_id, terminal_id, serialized record)] for every terminal that has reported
+        records = []
+        for shard in self.shards:
+            records.extend(shard.export())
+        return records
+
+    def mark_disconnected(self, keys):
+        by_shard = {}
+        for key in keys:
+            by_shard.setdefault(self.shard_index(key), []).append(key)
+        changes = {}
+        for index, shard_keys in by_shard.items():
+            self.shards[index].mark_disconnected(shard_keys, changes)
+        return changes
+
+    def view(self, keys):
+        # {key: view entry as it is now} for the given keys, None for keys no longer shown
+        by_shard = {}
+        changes = {}
+        for key in keys:
+            if key in self.layout_keys:
+                by_shard.setdefault(self.shard_index(key), []).append(key)
+            else:
+                changes[key] = None
+        for index, shard_keys in by_shard.items():
+            changes.update(self.shards[index].serialize(shard_keys))
+        return changes
+
+    def get(self, key):
+        return self.shard_for(key).records.get(key)
+
+    def statuses(self):
+        # [(key, Status)] for every terminal that has reported
+        statuses = []
+        for shard in self.shards:
+            statuses.extend(shard.statuses())
+        return statuses
+
+    def snapshot(self):
+        with self.layout_lock:
+            layout = list(self.layout)
+        records = {}
+        for shard in self.shards:
+            records.update(shard.snapshot()[1])
+        return {key: records.get(key, DISCONNECTED_PLACEHOLDER) for key in layout}
+
+    def snapshot_json(self):
+        # Serialized combined view, rebuilt only when the layout or a shard has changed since the
+        # last call. Shards cache their records' JSON, so a rebuild only re-encodes what changed.
+        with self.json_lock:
+            versions = (self.layout_version,) + tuple(shard.version for shard in self.shards)
+            if self._json_versions != versions:
+                with self.layout_lock:
+                    layout = list(self.layout)
+                    layout_version = self.layout_version
+                fragments = {}
+                versions = [layout_version]
+                for shard in self.shards:
+                    version, shard_fragments = shard.fragments()
+                    versions.append(version)
+                    fragments.update(shard_fragments)
+                body = ','.join(f"{json.dumps(key)}:{fragments.get(key, DISCONNECTED_PLACEHOLDER_JSON)}" for key in layout)
+                self._json = f"{{{body}}}".encode('utf-8')
+                self._json_versions = tuple(versions)
+            return sum(self._json_versions), self._json
+
+    def etag(self, version):
+        return f"{self.epoch}-{version}"
@@ -0,0 +1,150 @@
+import hashlib
+import time
+from threading import Lock
+from registry import Status
+
+
+class RolloutController:
+    # Decides which terminals are told about the current terminal version. Terminals are ordered
+    # by a hash of their key (stable per version, spread across stores) and admitted in waves
+    # covering a growing fraction of the fleet. Within a wave at most max_downloads_per_store
+    # terminals of one store are updating at once. The next wave opens once every connected
+    # terminal in the current one reports the new version and has stayed connected on it for
+    # soak_time. If too many admitted terminals don't come back on the new version within
+    # download_timeout, or drop off shortly after updating, the rollout pauses.
+    def __init__(self, registry, version, waves=(0.05, 0.25, 0.5, 1.0), max_downloads_per_store=1,
+                 download_timeout=900, soak_time=120, max_failure_ratio=0.2, evaluate_interval=5):
+        self.registry = registry
+        self.waves = waves
+        self.max_downloads_per_store = max_downloads_per_store
+        self.download_timeout = download_timeout
+        self.soak_time = soak_time
+        self.max_failure_ratio = max_failure_ratio
+        self.evaluate_interval = evaluate_interval
+        self.lock = Lock()
+        self.start(version)
+
+    def start(self, version):
+        with self.lock:
+            self.version = version
+            self.wave = 0
+            self.state = 'rolling'
+            self.pause_reason = None
+            self.in_flight = {}  # store -> {key: time the new version was handed out}
+            self.updated_at = {}  # key -> first time it reported the new version
+            self.failed = set()
+            self.attempted = 0
+            self.last_evaluated = 0
+
+    def rank(self, key, version=None):
+        return int(hashlib.sha1(f"{version or self.version}:{key}".encode('utf-8')).hexdigest()[:8], 16) / 0x100000000
+
+    def admitted(self, key):
+        return self.state == 'complete' or self.rank(key) < self.waves[self.wave]
+
+    def version_for(self, key, store_id, reported_version, now=None):
+        # The version to put in this terminal's /update reply
+        now = now if now is not None else time.time()
+        with self.lock:
+            if reported_version == self.version:
+                self.updated_at.setdefault(key, now)
+                self.in_flight.get(store_id, {}).pop(key, None)
+                return self.version
+            store_in_flight = self.in_flight.setdefault(store_id, {})
+            if key in store_in_flight:
+                return self.version
+            if self.state == 'paused' or key in self.failed or not self.admitted(key):
+                return reported_version
+            if len(store_in_flight) >= self.max_downloads_per_store:
+                return reported_version
+            store_in_flight[key] = now
+            self.attempted += 1
+            return self.version
+
+    def evaluate(self, now=None, statuses=None):
+        # Called on every /update; does the actual work at most every evaluate_interval seconds.
+        # statuses: registry.statuses(), if the caller has already read them
+        now = now if now is not None else time.time()
+        with self.lock:
+            if self.state != 'rolling' or now - self.last_evaluated < self.evaluate_interval:
+                return
+            self.last_evaluated = now
+            for store_in_flight in self.in_flight.values():
+                for key, handed_at in list(store_in_flight.items()):
+                    if now - handed_at > self.download_timeout:
+                        del store_in_flight[key]
+                        self.failed.add(key)
+            wave_done = not any(self.in_flight.values())
+            for key, status in statuses if statuses is not None else self.registry.statuses():
+                updated_at = self.updated_at.get(key)
+                connected = status is Status.CONNECTED
+                if updated_at is not None and not connected and now - updated_at < self.soak_time:
+                    self.failed.add(key)  # Came back on the new version but dropped off again
+                if connected and self.admitted(key) and key not in self.failed:
+                    if updated_at is None or now - updated_at < self.soak_time:
+                        wave_done = False
+            if self.attempted and len(self.failed) > self.max_failure_ratio * self.attempted:
+                self.state = 'paused'
+                self.pause_reason = f"{len(self.failed)} of {self.attempted} terminals did not come back healthy on {self.version}"
+                return
+            if wave_done:
+                self.wave += 1
+                if self.wave == len(self.waves):
+                    self.state = 'complete'
+                    self.wave -= 1
+
+    def pause(self, reason='paused by operator'):
+        with self.lock:
+            self.state = 'paused'
+            self.pause_reason = reason
+
+    def resume(self):
+        # Failed terminals get another chance once an operator resumes
+        with self.lock:
+            if self.state == 'paused':
+                self.state = 'rolling'
+                self.pause_reason = None
+                self.failed.clear()
+                self.attempted = len(self.updated_at)
+
+    def export(self):
+        # Everything needed to carry on after a restart, JSON-serializable
+        with self.lock:
+            return {
+                'version': self.version,
+                'wave': self.wave,
+                'state': self.state,
+                'pause_reason': self.pause_reason,
+                'in_flight': {store: dict(keys) for store, keys in self.in_flight.items() if keys},
+                'updated_at': dict(self.updated_at),
+                'failed': sorted(self.failed),
+                'attempted': self.attempted,
+            }
+
+    def restore(self, saved):
+        # Picks up a rollout saved by export, in whatever state it was (rolling, paused or complete)
+        with self.lock:
+            self.version = saved['version']
+            self.wave = min(saved['wave'], len(self.waves) - 1)
+            self.state = saved['state']
+            self.pause_reason = saved['pause_reason']
+            self.in_flight = {store: dict(keys) for store, keys in saved['in_flight'].items()}
+            self.updated_at = dict(saved['updated_at'])
+            self.failed = set(saved['failed'])
+            self.attempted = saved['attempted']
+            self.last_evaluated = 0
+
+    def status(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'state': self.state,
+                'pause_reason': self.pause_reason,
+                'wave': self.wave,
+                'fraction': self.waves[self.wave],
+                'waves': list(self.waves),
+                'in_flight': {store: sorted(keys) for store, keys in self.in_flight.items() if keys},
+                'updated': len(self.updated_at),
+                'failed': sorted(self.failed),
+                'attempted': self.attempted,
+            }
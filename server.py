@@ -1,67 +1,245 @@
 import os
+# SERVER_ASYNC=gevent serves every route and socket from one gevent event loop instead of an OS
+# thread per connection. The standard library must be patched before anything else imports it.
+async_mode = os.environ.get('SERVER_ASYNC', 'threading')
+if async_mode == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
 import requests
-from flask import Flask, render_template, jsonify, request, redirect, url_for, session, send_file
-from flask_socketio import SocketIO, emit
-from threading import Thread
+from flask import Flask, render_template, jsonify, request, redirect, url_for, session, send_file, make_response, Response, g
+from flask_socketio import SocketIO, emit, join_room
+from threading import Thread, Lock, Event
 import time
+import hashlib
+import gzip
+import shutil
 import json
 import logging
+import socket
+import signal
 from functools import wraps
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.serving import make_server
+from werkzeug.utils import secure_filename
+from registry import TerminalRegistry, Status, terminal_key
+from heartbeats import HeartbeatMonitor
+from broadcast import Broadcaster
+from logstore import LogStore
+from rollout import RolloutController
+from deltapatch import make_patch, worthwhile
+from statestore import StateStore
+from cluster import Broker, Bus, BusManager, SharedRegistry, SharedRolloutController
+from metrics import Metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'default_secret_key')
-socketio = SocketIO(app)
+
+# Multi-process mode (SERVER_WORKERS > 1): the workers share the listening socket and the terminal
+# registry (a SQLite file), and Socket.IO events travel between them over a local message bus.
+# The parent process runs the broker and everything that must happen once: heartbeat expiry,
+# dashboard broadcasts, log writing and state snapshots. Clients must use the websocket transport.
+server_workers = int(os.environ.get('SERVER_WORKERS', '1'))
+if server_workers > 1 and async_mode != 'threading':
+    raise SystemExit("SERVER_WORKERS > 1 only works with SERVER_ASYNC=threading")
+bus_address = os.environ.get('BUS_ADDRESS', '127.0.0.1:5670')
+bus = Bus(bus_address, app.config['SECRET_KEY'].encode('utf-8')) if server_workers > 1 else None
+cluster_role = None  # 'master' or 'worker' once the processes are started
+socketio = SocketIO(app, async_mode=async_mode, client_manager=BusManager(bus)) if bus else SocketIO(app, async_mode=async_mode)
 
 # Dummy credentials
 USER_CREDENTIALS = {
     'admin': 'A5348513'
 }
 
-# Global dictionaries to store terminal status and expected terminals
-expected_terminals = {}
-connected_terminals = {}
+# Prometheus metrics at /metrics; SERVER_METRICS=0 turns off the endpoint and the instrumentation.
+# In multi-process mode the parent serves the whole cluster's metrics on METRICS_PORT instead.
+metrics = Metrics(enabled=os.environ.get('SERVER_METRICS', '1') != '0')
+metrics_port = int(os.environ.get('METRICS_PORT', '9100'))
+metrics_interval = 1  # seconds between a worker's metric exports to the parent
+worker_metrics = {}  # Parent: worker pid -> its last metrics export
+metrics.histogram('http_request_seconds', "Time to handle an HTTP request", ('endpoint',))
+metrics.counter('http_responses_total', "HTTP responses by endpoint and status code", ('endpoint', 'code'))
+metrics.histogram('snapshot_seconds', "Time to build the combined terminal view", ('format',))
+metrics.histogram('emit_seconds', "Time for socketio.emit to hand a message to its recipients", ('event',))
+metrics.histogram('emit_payload_bytes', "Size of broadcast messages", ('event',), buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+metrics.histogram('heartbeat_gap_seconds', "Time between two heartbeats of a terminal", buckets=(1, 2, 5, 7.5, 10, 15, 20, 30, 60, 120))
+metrics.histogram('heartbeat_expiry_lag_seconds', "How late a silent terminal was marked disconnected after its deadline")
+metrics.histogram('heartbeat_expire_seconds', "Time to mark a batch of silent terminals disconnected")
+metrics.histogram('log_write_seconds', "Time to write and index a batch of log entries")
+metrics.histogram('log_batch_entries', "Log entries per write", buckets=(1, 2, 5, 10, 50, 100, 500, 1000))
+
+# Expected terminals and live terminal status, merged into the view served to dashboards
 heartbeat_timeout = 20  # seconds
+if bus:
+    registry = SharedRegistry(os.environ.get('SHARED_STATE_DB', 'shared_state.db'), expire_after=heartbeat_timeout)
+else:
+    registry = TerminalRegistry()
+STATUS_FIELDS = ('ip', 'isp', 'status', 'app_status', 'memory_usage', 'version')  # Fields a terminal may report
 log_file = 'server_logs.txt'
+log_store = LogStore(log_file, metrics=metrics)  # Appends to log_file from its own thread and indexes it for /logs
+log_queue_full = False  # Workers: the parent's log queue is full, so refuse logs (the parent says when it flips)
 terminal_exe_path = 'terminal.exe'
 terminal_version = '1.0'  # Versioning for the Terminal executable
+# Hands terminal_version out in waves instead of to the whole fleet at once (one rollout for all workers)
+rollout = SharedRolloutController(registry, terminal_version) if bus else RolloutController(registry, terminal_version)
+update_manifest_cache = {}  # Hash of terminal.exe, recomputed only when the file changes
+update_manifest_lock = Lock()
+releases_dir = 'releases'  # Every deployed terminal.exe, kept so we can build delta patches from it
+update_patches = {}  # from_version -> delta patch to terminal_version, filled in as patches get built
+broadcast_window = float(os.environ.get('BROADCAST_WINDOW', '0.25'))  # seconds
+server_port = int(os.environ.get('SERVER_PORT', '80'))
+max_batch_bytes = 16 * 1024 * 1024  # Largest /update/batch or /logs/batch body, after gunzipping
+# Last known fleet and expected list, restored (marked stale) when the server restarts
+state_store = StateStore(os.environ.get('STATE_DB', 'server_state.db'), registry, rollout)
+
+# Socket.IO rooms: status goes to dashboards only, commands only to the terminal (or store) they target
+DASHBOARD_ROOM = 'dashboards'
+
+def terminal_room(store_id, terminal_id):
+    return f"terminal:{store_id},{terminal_id}"
+
+def store_room(store_id):
+    return f"store:{store_id}"
+
+# Changes are merged over broadcast_window and sent to dashboards as sequenced terminal_changed events
+broadcaster = Broadcaster(socketio, registry.view, window=broadcast_window, room=DASHBOARD_ROOM, metrics=metrics)
 
-# Load expected terminals from a file (expected_terminals.json)
+# Load expected terminals from a file (expected_terminals.json), or the list last posted to
+# /load_expected_terminals if that is newer than the file
 def load_expected_terminals():
-    global expected_terminals
+    expected, saved_at = state_store.load_expected()
     try:
-        with open('expected_terminals.json') as f:
-            expected_terminals = json.load(f)
+        if expected is None or os.path.getmtime('expected_terminals.json') > saved_at:
+            with open('expected_terminals.json') as f:
+                expected = json.load(f)
     except FileNotFoundError:
         print("expected_terminals.json not found")
+    if expected is not None:
+        registry.load_expected(expected)
 
-def combine_terminals(expected, connected):
-    combined = {}
-    for store, terminals in expected.items():
-        for terminal in terminals:
-            key = f"{store},{terminal}"
-            if key in connected:
-                combined[key] = connected[key]
-            else:
-                combined[key] = {'ip': 'N/A', 'isp': 'N/A', 'status': 'disconnected', 'app_status': 'Not running', 'memory_usage': 'N/A'}
-    for key, value in connected.items():
-        if key not in combined:
-            combined[key] = value
-    return combined
+def restore_state():
+    # Terminals that were connected get a fresh deadline; if they don't report within the
+    # heartbeat timeout they are marked disconnected like any other silent terminal
+    started = time.perf_counter()
+    restored = registry.restore(state_store.load_records())
+    for key in restored:
+        if registry.get(key).status is Status.CONNECTED:
+            heartbeat_monitor.beat(key)
+    logging.info(f"Restored {len(restored)} terminals in {(time.perf_counter() - started) * 1000:.1f} ms")
+    saved_rollout = state_store.load_rollout()
+    if saved_rollout is not None:
+        restore_rollout(saved_rollout)
 
-def monitor_heartbeats():
-    while True:
-        current_time = time.time()
-        for key, info in list(connected_terminals.items()):
-            if current_time - info['last_heartbeat'] > heartbeat_timeout:
-                if info['status'] != 'disconnected':
-                    connected_terminals[key]['status'] = 'disconnected'
-                    logging.info(f"Terminal {key} marked as disconnected")
-                    combined_terminals = combine_terminals(expected_terminals, connected_terminals)
-                    socketio.emit('update_status', combined_terminals)
-        time.sleep(heartbeat_timeout)
+def restore_rollout(saved):
+    # Carry on with the rollout that was running (or paused, or finished) when the server stopped
+    global terminal_version
+    with update_manifest_lock:
+        terminal_version = saved['version']
+    rollout.restore(saved)
+    logging.info(f"Restored the rollout of version {saved['version']}: {saved['state']}, wave {saved['wave'] + 1}")
+
+def deliver_snapshot(sid, since=None):
+    # Replay the missed changes if they are still in the history, otherwise resync with a full snapshot.
+    # Read the sequence before the view so the snapshot holds at least every change up to it.
+    with broadcaster.emit_lock:
+        missed = broadcaster.changes_since(since)
+        if missed is not None:
+            for seq, changes in missed:
+                socketio.emit('terminal_changed', {'seq': seq, 'changes': changes}, to=sid)
+            return
+        started = time.perf_counter()
+        terminals = registry.snapshot()
+        built = time.perf_counter()
+        socketio.emit('status_snapshot', {'seq': broadcaster.seq, 'terminals': terminals}, to=sid)
+        metrics.observe('snapshot_seconds', built - started, ('dict',))
+        metrics.observe('emit_seconds', time.perf_counter() - built, ('status_snapshot',))
+
+def send_snapshot(since=None):
+    # Only the parent knows the broadcast sequence in multi-process mode, so workers ask it to reply
+    if cluster_role == 'worker':
+        bus.publish('snapshot', (request.sid, since))
+    else:
+        deliver_snapshot(request.sid, since)
+
+def publish_changes(changes):
+    # In multi-process mode the parent picks the changes up from the shared registry; just wake it
+    if cluster_role == 'worker':
+        bus.publish('sync')
+    elif changes:
+        broadcaster.publish(changes)
+
+def store_logs(entries):
+    # False if the log writer is backed up (or failing) and the entries were refused
+    if cluster_role == 'worker':
+        if log_queue_full:
+            return False
+        bus.publish('logs', list(entries))
+        return True
+    return log_store.write_many(entries)
+
+def logs_refused():
+    return jsonify({"message": "Log queue full, try again later"}), 503
+
+def expire_terminals(keys):
+    # Called by the heartbeat monitor with every terminal whose deadline passed together
+    changes = registry.mark_disconnected(keys)
+    for key in changes:
+        logging.info(f"Terminal {key} marked as disconnected")
+    if changes:
+        broadcaster.publish(changes)
+
+heartbeat_monitor = HeartbeatMonitor(heartbeat_timeout, expire_terminals, metrics=metrics)
+
+def collect_fleet():
+    # Terminal counts, worked out from the registry only when /metrics is scraped
+    statuses = registry.statuses()
+    expected = {terminal_key(store, terminal) for store, terminals in registry.expected.items() for terminal in terminals}
+    reported = {key for key, _ in statuses}
+    connected = sum(1 for _, status in statuses if status is Status.CONNECTED)
+    return [
+        ('terminals', 'gauge', "Terminals that have reported, by status",
+         [({'status': 'connected'}, connected), ({'status': 'disconnected'}, len(statuses) - connected)]),
+        ('expected_terminals', 'gauge', "Terminals in the expected list", [({}, len(expected))]),
+        ('unknown_terminals', 'gauge', "Terminals that reported but aren't expected", [({}, len(reported - expected))]),
+        ('missing_terminals', 'gauge', "Expected terminals that never reported", [({}, len(expected - reported))]),
+    ]
+
+def collect_background():
+    # Counters the broadcaster, log store and heartbeat monitor keep anyway. In multi-process
+    # mode these run in the parent, which is also the only process that renders collectors.
+    stats = broadcaster.stats()
+    return [
+        ('changes_published_total', 'counter', "Change sets handed to the broadcaster", [({}, stats['changes_published'])]),
+        ('changes_coalesced_total', 'counter', "Change sets merged into one already pending", [({}, stats['changes_coalesced'])]),
+        ('broadcasts_total', 'counter', "terminal_changed messages sent to dashboards", [({}, stats['messages_emitted'])]),
+        ('broadcast_pending_changes', 'gauge', "Terminal changes waiting for the next broadcast", [({}, stats['pending'])]),
+        ('log_entries_written_total', 'counter', "Log entries written to disk", [({}, log_store.entries_written)]),
+        ('log_bytes_written_total', 'counter', "Bytes of log records written to disk", [({}, log_store.bytes_written)]),
+        ('log_queue_entries', 'gauge', "Log entries waiting for the writer", [({}, log_store.queue.qsize())]),
+        ('log_entries_dropped_total', 'counter', "Log entries refused with the queue full or lost to a failed write", [({}, log_store.entries_dropped)]),
+        ('heartbeat_tracked_terminals', 'gauge', "Terminals with a heartbeat deadline", [({}, len(heartbeat_monitor.deadlines))]),
+    ]
+
+metrics.collector(collect_fleet)
+metrics.collector(collect_background)
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('http_request_seconds', time.perf_counter() - g.request_started, (endpoint,))
+    metrics.inc('http_responses_total', 1, (endpoint, str(response.status_code)))
+    return response
+
+# Only hooked in when enabled, so turning metrics off leaves requests exactly as they were
+if metrics.enabled:
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
 
 def authenticate(f):
     @wraps(f)
@@ -94,37 +272,85 @@ def logout():
 @app.route('/status')
 @authenticate
 def status():
-    combined_terminals = combine_terminals(expected_terminals, connected_terminals)
-    return render_template('index.html', combined_terminals=combined_terminals)
+    return render_template('index.html')
+
+@app.route('/dashboard_bench')
+@authenticate
+def dashboard_bench():
+    # Replays a recorded (/status?record) or generated update stream through the status table
+    return render_template('dashboard_bench.html')
 
 @app.route('/api/status', methods=['GET'])
 @authenticate
 def get_status():
-    combined_terminals = combine_terminals(expected_terminals, connected_terminals)
-    return jsonify(combined_terminals)
+    started = time.perf_counter()
+    version, body = registry.snapshot_json()
+    metrics.observe('snapshot_seconds', time.perf_counter() - started, ('json',))
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    response.set_etag(registry.etag(version))
+    return response.make_conditional(request)
 
 @app.route('/update', methods=['POST'])
 def update_status():
+    # Terminals send every field when something changed and only their ids as a keep-alive;
+    # whatever fields are present are merged into the existing record
     data = request.json
     store_id = data.get('store_id')
     terminal_id = data.get('terminal_id')
-    status = data.get('status')
-    ip = data.get('ip')
-    isp = data.get('isp')
-    app_status = data.get('app_status', 'Not running')  # Default to 'Not running' if the key is missing
-    memory_usage = data.get('memory_usage', 'N/A')
-    key = f"{store_id},{terminal_id}"
-    connected_terminals[key] = {
-        'ip': ip,
-        'isp': isp,
-        'status': status,
-        'last_heartbeat': time.time(),
-        'app_status': app_status,
-        'memory_usage': memory_usage
-    }
-    combined_terminals = combine_terminals(expected_terminals, connected_terminals)
-    socketio.emit('update_status', combined_terminals)
-    return jsonify({"message": "Status updated"}), 200
+    fields = {field: data[field] for field in STATUS_FIELDS if field in data}
+    fields.setdefault('status', 'connected')
+    fields['last_heartbeat'] = time.time()
+    key = terminal_key(store_id, terminal_id)
+    known = registry.get(key) is not None
+    if cluster_role == 'worker':
+        registry.note_beat(key, fields['last_heartbeat'])  # Sent on to the parent by forward_beats
+    else:
+        heartbeat_monitor.beat(key)
+    record, changes = registry.report(store_id, terminal_id, fields)
+    if changes:
+        publish_changes(changes)
+    version = rollout.version_for(record.key, record.store_id, record.version)
+    if cluster_role != 'worker':
+        rollout.evaluate()  # In multi-process mode the parent does it in sync_workers
+    # The reply carries the version this terminal should run (per the rollout) so terminals don't
+    # need a separate /check_update poll, and the heartbeat timeout so they can pace their keep-alives
+    return jsonify({
+        "message": "Status updated",
+        "version": version,
+        "heartbeat_timeout": heartbeat_timeout,
+        # A keep-alive for a terminal we have no record of (e.g. after a restart): ask for everything
+        "full_status": not known and not all(field in data for field in STATUS_FIELDS)
+    }), 200
+
+def request_json():
+    # Terminals gzip the backlog they send after an outage (Content-Encoding: gzip). Anyone can
+    # post here, so the body is inflated a chunk at a time and refused (413) past max_batch_bytes.
+    try:
+        if request.content_encoding == 'gzip':
+            with gzip.GzipFile(fileobj=request.stream) as body:
+                data = body.read(max_batch_bytes + 1)
+        else:
+            data = request.stream.read(max_batch_bytes + 1)
+        if len(data) > max_batch_bytes:
+            raise RequestEntityTooLarge()
+        return json.loads(data)
+    except (OSError, EOFError, ValueError) as e:
+        raise BadRequest(f"Invalid batch: {e}")
+
+@app.route('/update/batch', methods=['POST'])
+def save_status_batch():
+    # Status samples a terminal queued while it couldn't reach us. By the time they arrive its
+    # heartbeats have reported the live state again, so they only go to its log as history.
+    samples = request_json().get('samples', [])
+    if not store_logs((sample.get('store_id'), sample.get('terminal_id'), format_status_sample(sample), sample.get('sampled_at')) for sample in samples):
+        return logs_refused()
+    return jsonify({"message": "Samples saved", "count": len(samples)}), 200
+
+def format_status_sample(sample):
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sample.get('sampled_at', time.time())))
+    details = ', '.join(f"{field}={sample[field]}" for field in STATUS_FIELDS + ('logon_status',) if sample.get(field) is not None)
+    return f"{timestamp} - Status (sent late): {details}\n"
 
 @app.route('/log', methods=['POST'])
 def save_log():
@@ -132,59 +358,464 @@ def save_log():
     store_id = data.get('store_id')
     terminal_id = data.get('terminal_id')
     log_entry = data.get('log_entry')
-    with open(log_file, 'a') as log:
-        log.write(f"Store: {store_id}, Terminal: {terminal_id} - {log_entry}")
+    if not store_logs([(store_id, terminal_id, log_entry, None)]):
+        return logs_refused()
     return jsonify({"message": "Log saved"}), 200
 
+@app.route('/logs/batch', methods=['POST'])
+def save_logs_batch():
+    # Same fields as /log, one dict per entry, plus created_at: when the terminal logged it
+    entries = request_json().get('entries', [])
+    if not store_logs((entry.get('store_id'), entry.get('terminal_id'), entry.get('log_entry'), entry.get('created_at')) for entry in entries):
+        return logs_refused()
+    return jsonify({"message": "Logs saved", "count": len(entries)}), 200
+
 @app.route('/logs', methods=['GET'])
 @authenticate
 def get_logs():
-    with open(log_file, 'r') as log:
-        logs = log.readlines()
-    return jsonify(logs)
+    # Streams matching records as NDJSON, oldest first. Filters: store, terminal (needs store),
+    # since/until (unix time). Pages hold up to `limit` records; pass the X-Next-Cursor header
+    # back as `cursor` to get the next one.
+    store_id = request.args.get('store')
+    terminal_id = request.args.get('terminal')
+    if terminal_id is not None and store_id is None:
+        return jsonify({"message": "terminal filter needs a store"}), 400
+    try:
+        since = request.args.get('since', type=float)
+        until = request.args.get('until', type=float)
+        limit = min(max(request.args.get('limit', 500, type=int), 1), 5000)
+        files, next_cursor = log_store.query(store_id, terminal_id, since, until, request.args.get('cursor'), limit)
+    except ValueError:
+        return jsonify({"message": "Invalid cursor"}), 400
+    response = Response(log_store.stream(files), mimetype='application/x-ndjson')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @app.route('/load_expected_terminals', methods=['POST'])
 @authenticate
 def load_expected_terminals_api():
-    global expected_terminals
-    expected_terminals = request.json
+    changes = registry.load_expected(request.json)
+    state_store.save_expected(request.json)
+    if changes:
+        publish_changes(changes)
     return jsonify(success=True)
 
+@app.route('/api/broadcast_stats', methods=['GET'])
+@authenticate
+def get_broadcast_stats():
+    return jsonify(broadcaster.stats())
+
+@app.route('/rollout', methods=['GET'])
+@authenticate
+def get_rollout():
+    return jsonify(rollout.status())
+
+@app.route('/rollout/start', methods=['POST'])
+@authenticate
+def start_rollout():
+    # Call after replacing terminal.exe with the build for the given version
+    version = request.json['version']
+    start_release(version)
+    if cluster_role == 'worker':
+        bus.publish('release', version)  # The parent archives it and builds the patches
+    else:
+        publish_release(version)
+    state_store.save_rollout()
+    logging.info(f"Started rollout of terminal version {version}")
+    return jsonify(rollout.status())
+
+def start_release(version):
+    set_release(version)
+    rollout.start(version)
+
+def set_release(version):
+    global terminal_version
+    with update_manifest_lock:
+        terminal_version = version
+        update_patches.clear()
+
+@app.route('/rollout/pause', methods=['POST'])
+@authenticate
+def pause_rollout():
+    rollout.pause()
+    state_store.save_rollout()
+    return jsonify(rollout.status())
+
+@app.route('/rollout/resume', methods=['POST'])
+@authenticate
+def resume_rollout():
+    rollout.resume()
+    state_store.save_rollout()
+    return jsonify(rollout.status())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.enabled:
+        return jsonify({"message": "Metrics are disabled"}), 404
+    # A worker only has its own share of the counters; scraping it would jump between workers
+    if cluster_role == 'worker':
+        return jsonify({"message": f"Metrics are served by the parent process on port {metrics_port}"}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/check_update', methods=['GET'])
 def check_update():
     return jsonify({'version': terminal_version})
 
+def get_update_manifest():
+    # Relative paths are resolved like send_file does, against the app's root
+    exe_path = os.path.join(app.root_path, terminal_exe_path)
+    stat = os.stat(exe_path)
+    with update_manifest_lock:
+        if update_manifest_cache.get('stat') != (stat.st_mtime_ns, stat.st_size):
+            sha256 = hashlib.sha256()
+            with open(exe_path, 'rb') as exe:
+                for chunk in iter(lambda: exe.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+            update_manifest_cache['stat'] = (stat.st_mtime_ns, stat.st_size)
+            update_manifest_cache['sha256'] = sha256.hexdigest()
+        return {
+            'version': terminal_version,
+            'sha256': update_manifest_cache['sha256'],
+            'size': stat.st_size,
+            'url': url_for('download_update'),
+            'patches': {
+                from_version: {'url': url_for('download_patch', from_version=from_version), 'sha256': patch['sha256'], 'size': patch['size']}
+                for from_version, patch in update_patches.items()
+            }
+        }
+
+def release_path(version):
+    return os.path.join(app.root_path, releases_dir, f"terminal-{secure_filename(version)}.exe")
+
+def patch_path(from_version, to_version):
+    return os.path.join(app.root_path, releases_dir, 'patches', f"{secure_filename(from_version)}-{secure_filename(to_version)}.patch")
+
+def archive_release(version):
+    path = release_path(version)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(os.path.join(app.root_path, terminal_exe_path), path)
+
+def build_update_patches(version):
+    # Runs in the background after a release is archived: diffs every older archived release
+    # against it, reusing patches already on disk, and publishes each one in the manifest
+    try:
+        with open(release_path(version), 'rb') as f:
+            target = f.read()
+        for name in sorted(os.listdir(os.path.join(app.root_path, releases_dir))):
+            if not (name.startswith('terminal-') and name.endswith('.exe')) or name == os.path.basename(release_path(version)):
+                continue
+            from_version = name[len('terminal-'):-len('.exe')]
+            path = patch_path(from_version, version)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    patch = f.read()
+            else:
+                started = time.time()
+                with open(os.path.join(app.root_path, releases_dir, name), 'rb') as f:
+                    patch = run_cpu_bound(make_patch, f.read(), target)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f"{path}.tmp", 'wb') as f:
+                    f.write(patch)
+                os.replace(f"{path}.tmp", path)
+                logging.info(f"Built update patch {from_version} -> {version}: {len(patch)} of {len(target)} bytes in {time.time() - started:.1f}s")
+            if not worthwhile(len(patch), len(target)):
+                logging.info(f"Not offering the update patch {from_version} -> {version}: {len(patch)} of {len(target)} bytes saves too little")
+                continue
+            with update_manifest_lock:
+                if version == terminal_version:
+                    update_patches[from_version] = {'path': path, 'sha256': hashlib.sha256(patch).hexdigest(), 'size': len(patch)}
+            if cluster_role == 'master':
+                publish_release_state()
+    except Exception as e:
+        logging.error(f"Error building update patches for {version}: {e}")
+
+def run_cpu_bound(function, *args):
+    # Under gevent a long computation would stall every connection, so it runs on a native thread
+    if async_mode == 'gevent':
+        return gevent.get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+def run_server():
+    if async_mode != 'gevent':
+        # Werkzeug is what threading mode has always run on; SERVER_ASYNC=gevent is the production-grade option
+        socketio.run(app, host='0.0.0.0', port=server_port, allow_unsafe_werkzeug=True)
+        return
+    from gevent import pywsgi
+
+    class NoDelayHandler(pywsgi.WSGIHandler):
+        # pywsgi writes a response's headers and body separately, so with Nagle's algorithm on, every
+        # keep-alive request (terminals reuse their connection) waits ~40 ms for the client's delayed ACK
+        def handle(self):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            super().handle()
+
+    socketio.run(app, host='0.0.0.0', port=server_port, handler_class=NoDelayHandler)
+
+def publish_release(version):
+    try:
+        archive_release(version)
+    except FileNotFoundError:
+        return
+    Thread(target=build_update_patches, args=(version,), daemon=True).start()
+
+@app.route('/update_manifest', methods=['GET'])
+def update_manifest():
+    try:
+        return jsonify(get_update_manifest())
+    except FileNotFoundError:
+        return jsonify({"message": "No update available"}), 404
+
+@app.route('/download_patch/<from_version>', methods=['GET'])
+def download_patch(from_version):
+    patch = update_patches.get(from_version)
+    if patch is None:
+        return jsonify({"message": "No patch from that version"}), 404
+    return send_file(patch['path'], as_attachment=True, etag=patch['sha256'], conditional=True)
+
 @app.route('/download_update', methods=['GET'])
 def download_update():
-    return send_file(terminal_exe_path, as_attachment=True)
+    # The content hash is the ETag, so agents can resume with Range + If-Range and never
+    # splice bytes from two different builds together
+    try:
+        manifest = get_update_manifest()
+    except FileNotFoundError:
+        return jsonify({"message": "No update available"}), 404
+    return send_file(terminal_exe_path, as_attachment=True, etag=manifest['sha256'], conditional=True)
 
 @socketio.on('connect')
-@authenticate
-def handle_connect():
-    emit('update_status', combine_terminals(expected_terminals, connected_terminals))
+def handle_connect(auth=None):
+    # Terminals identify themselves in the connect auth payload and only join their own rooms
+    if auth and auth.get('store_id') is not None:
+        join_room(terminal_room(auth['store_id'], auth.get('terminal_id')))
+        join_room(store_room(auth['store_id']))
+        return
+    join_room(DASHBOARD_ROOM)
+    if 'logged_in' in session:
+        send_snapshot()
+
+def command_target(data):
+    # "store,terminal" targets one terminal, "store,*" every terminal of the store
+    store_id, _, terminal_id = data.rpartition(',')
+    if terminal_id == '*':
+        return store_room(store_id), store_id, terminal_id
+    return terminal_room(store_id, terminal_id), store_id, terminal_id
+
+@socketio.on('request_snapshot')
+def handle_request_snapshot(data=None):
+    send_snapshot((data or {}).get('since'))
 
 @socketio.on('reboot_terminal')
 @authenticate
 def handle_reboot_terminal(data):
-    store_id, terminal_id = data.split(',')
+    room, store_id, terminal_id = command_target(data)
     logging.info(f"Received reboot command for {store_id}-{terminal_id}")
-    emit('reboot_command', {'store_id': store_id, 'terminal_id': terminal_id}, broadcast=True)
+    emit('reboot_command', {'store_id': store_id, 'terminal_id': terminal_id}, to=room)
 
 @socketio.on('perform_speedtest')
 @authenticate
 def handle_perform_speedtest(data):
-    store_id, terminal_id = data.split(',')
+    room, store_id, terminal_id = command_target(data)
     logging.info(f"Received speedtest command for {store_id}-{terminal_id}")
-    emit('speedtest_command', {'store_id': store_id, 'terminal_id': terminal_id}, broadcast=True)
+    emit('speedtest_command', {'store_id': store_id, 'terminal_id': terminal_id}, to=room)
 
 @socketio.on('speedtest_results')
 def handle_speedtest_results(data):
     logging.info(f"Received speedtest results: {data}")
-    socketio.emit('speedtest_results', data)
+    socketio.emit('speedtest_results', data, to=DASHBOARD_ROOM)
+
+def publish_release_state():
+    # Tells workers which version is current and which patches to it are ready
+    with update_manifest_lock:
+        bus.publish('release_state', (terminal_version, dict(update_patches)))
+
+def apply_release_state(state):
+    version, patches = state
+    with update_manifest_lock:
+        if version == terminal_version:
+            update_patches.update(patches)
+
+def forward_beats():
+    # Worker: heartbeats go to the parent in one message per broadcast window instead of
+    # each keep-alive writing to the shared registry
+    while True:
+        time.sleep(broadcast_window)
+        beats = registry.take_beats()
+        if beats:
+            bus.publish('beats', beats)
+
+def forward_metrics():
+    # Worker: its counters and histograms go to the parent, which adds them up for /metrics
+    while True:
+        time.sleep(metrics_interval)
+        bus.publish('metrics', (os.getpid(), metrics.export()))
+
+def serve_cluster_metrics(environ, start_response):
+    # Parent: its own metrics plus the workers' last exports. A worker that exited keeps its
+    # last export, so the totals never go down.
+    if environ.get('PATH_INFO') == '/metrics':
+        response = Response(metrics.render(list(worker_metrics.values())), mimetype='text/plain; version=0.0.4')
+    else:
+        response = Response('Not found\n', status=404, mimetype='text/plain')
+    return response(environ, start_response)
+
+def set_log_queue_full(full):
+    global log_queue_full
+    log_queue_full = full
+
+def run_worker(listener):
+    global cluster_role
+    cluster_role = 'worker'
+    bus.subscribe('log_queue_full', set_log_queue_full)
+    bus.subscribe('release', set_release)  # The rollout itself is shared; the worker that got /rollout/start started it
+    bus.subscribe('release_state', apply_release_state)
+    bus.publish('hello')
+    Thread(target=forward_beats, daemon=True).start()
+    if metrics.enabled:
+        Thread(target=forward_metrics, daemon=True).start()
+    server = make_server(*listener.getsockname()[:2], app, threaded=True, fd=listener.fileno())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def sync_workers(wake, stopped):
+    # Parent process: turns what the workers wrote to the shared registry into dashboard
+    # broadcasts, moves the shared rollout on and tells workers when the log queue fills or drains
+    while not stopped.is_set():
+        wake.wait(broadcast_window)
+        wake.clear()
+        try:
+            changes = registry.sync()
+            if changes:
+                broadcaster.publish(changes)
+            rollout.evaluate()
+            # Full until it has drained to 90%, so workers don't flap on every entry
+            full = log_store.queue.qsize() >= log_store.queue.maxsize * (0.9 if log_queue_full else 1)
+            if full != log_queue_full:
+                set_log_queue_full(full)
+                bus.publish('log_queue_full', full)
+        except Exception as e:
+            logging.error(f"Error syncing with workers: {e}")
+
+def receive_beats(beats, wake):
+    # Parent: heartbeats forwarded by a worker. A keep-alive the worker took as a no-op can have
+    # raced with the terminal being marked disconnected; report it connected again, and let
+    # sync_workers broadcast that.
+    revived = False
+    for key, last_heartbeat in beats:
+        heartbeat_monitor.beat(key, last_heartbeat)
+        record = registry.get(key)
+        if record is not None and record.status is Status.DISCONNECTED:
+            _, changes = registry.report(record.store_id, record.terminal_id, {'status': 'connected', 'last_heartbeat': last_heartbeat})
+            revived = revived or bool(changes)
+    if revived:
+        wake.set()
+
+def handle_release(version):
+    set_release(version)
+    publish_release(version)
+
+def run_cluster(host, port):
+    global cluster_role
+    cluster_role = 'master'
+    registry.reset()
+    rollout.reset()
+    load_expected_terminals()
+    restore_state()
+    registry.close()
+    listener = socket.create_server((host, port), backlog=1024)
+    broker = Broker(bus_address, app.config['SECRET_KEY'].encode('utf-8'))
+    # Fork before starting any thread, so no worker inherits a lock held by one
+    workers = []
+    for _ in range(server_workers):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(listener)
+            os._exit(0)
+        workers.append(pid)
+    listener.close()
+    logging.info(f"Started {len(workers)} workers on {host}:{port}")
+    registry.auto_sync = False  # Changes found by sync_workers must be broadcast, not swallowed by reads
+
+    wake = Event()
+    stopped = Event()
+    threads = [Thread(target=broker.run, daemon=True), Thread(target=heartbeat_monitor.run), Thread(target=broadcaster.run),
+               Thread(target=log_store.run), Thread(target=state_store.run), Thread(target=sync_workers, args=(wake, stopped))]
+    for thread in threads:
+        thread.start()
+    bus.subscribe('sync', lambda _: wake.set())
+    bus.subscribe('beats', lambda beats: receive_beats(beats, wake))
+    bus.subscribe('snapshot', lambda request: deliver_snapshot(*request))
+    bus.subscribe('logs', log_store.write_many)
+    bus.subscribe('release', handle_release)
+    bus.subscribe('hello', lambda _: publish_release_state())
+    if metrics.enabled:
+        bus.subscribe('metrics', lambda export: worker_metrics.__setitem__(*export))
+        metrics_server = make_server(host, metrics_port, serve_cluster_metrics, threaded=True)
+        Thread(target=metrics_server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on {host}:{metrics_port}")
+    publish_release(terminal_version)
+
+    def stop_workers(signum, frame):
+        stopped.set()
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.remove(pid)
+        if not stopped.is_set():
+            logging.error(f"Worker {pid} exited with status {status}")
+    stopped.set()
+    wake.set()
+    heartbeat_monitor.stop()
+    broadcaster.stop()
+    log_store.stop()
+    state_store.stop()
+    broker.stop()
+    for thread in threads[1:]:
+        thread.join()
 
 if __name__ == '__main__':
+    if server_workers > 1:
+        run_cluster('0.0.0.0', server_port)
+        raise SystemExit
     load_expected_terminals()
-    heartbeat_thread = Thread(target=monitor_heartbeats)
+    restore_state()
+    publish_release(terminal_version)
+    heartbeat_thread = Thread(target=heartbeat_monitor.run)
     heartbeat_thread.start()
-    socketio.run(app, host='0.0.0.0', port=80)
+    broadcast_thread = Thread(target=broadcaster.run)
+    broadcast_thread.start()
+    log_thread = Thread(target=log_store.run)
+    log_thread.start()
+    state_thread = Thread(target=state_store.run)
+    state_thread.start()
+
+    # systemd or docker stop: leave run_server the way Ctrl-C does, so the state still gets saved
+    if async_mode == 'gevent':
+        main = gevent.getcurrent()
+        gevent.signal_handler(signal.SIGTERM, main.throw, KeyboardInterrupt)
+    else:
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        run_server()
+    except KeyboardInterrupt:
+        pass  # Werkzeug handles it itself; under gevent it comes out of run_server
+    heartbeat_monitor.stop()
+    broadcaster.stop()
+    log_store.stop()
+    state_store.stop()
     heartbeat_thread.join()
+    broadcast_thread.join()
+    log_thread.join()
+    state_thread.join()
@@ -0,0 +1,90 @@
+import json
+import logging
+import sqlite3
+import time
+from threading import Event
+
+
+class StateStore:
+    # Keeps a copy of the registry in a SQLite database in WAL mode so a restarted server can show
+    # the last known fleet straight away instead of every terminal as disconnected. The terminal
+    # records and the rollout are saved every interval seconds (only if something changed) and
+    # once more on shutdown; the expected list is saved whenever it is posted to
+    # /load_expected_terminals, and the rollout right away when an operator changes it.
+    def __init__(self, path, registry, rollout=None, interval=30):
+        self.path = path
+        self.registry = registry
+        self.rollout = rollout
+        self.interval = interval
+        self.saved_version = None
+        self.saved_rollout = None
+        self.stopped = Event()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS terminals (key TEXT PRIMARY KEY, store_id TEXT, terminal_id TEXT, record TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS expected (id INTEGER PRIMARY KEY CHECK (id = 1), saved_at REAL, data TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS rollout (id INTEGER PRIMARY KEY CHECK (id = 1), saved_at REAL, data TEXT)')
+        return connection
+
+    def load_expected(self):
+        # Returns (expected list, time it was saved), or (None, None) if none was ever posted
+        with self.connect() as connection:
+            row = connection.execute('SELECT data, saved_at FROM expected WHERE id = 1').fetchone()
+        connection.close()
+        return (json.loads(row[0]), row[1]) if row else (None, None)
+
+    def save_expected(self, expected):
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO expected (id, saved_at, data) VALUES (1, ?, ?)', (time.time(), json.dumps(expected)))
+        connection.close()
+
+    def load_rollout(self):
+        # The rollout as of the last save (RolloutController.export), or None
+        with self.connect() as connection:
+            row = connection.execute('SELECT data FROM rollout WHERE id = 1').fetchone()
+        connection.close()
+        return json.loads(row[0]) if row else None
+
+    def save_rollout(self):
+        data = json.dumps(self.rollout.export(), sort_keys=True)
+        if data == self.saved_rollout:
+            return
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO rollout (id, saved_at, data) VALUES (1, ?, ?)', (time.time(), data))
+        connection.close()
+        self.saved_rollout = data
+
+    def load_records(self):
+        # [(store_id, terminal_id, serialized record)] as of the last save
+        with self.connect() as connection:
+            rows = connection.execute('SELECT store_id, terminal_id, record FROM terminals').fetchall()
+        connection.close()
+        return [(store_id, terminal_id, json.loads(record)) for store_id, terminal_id, record in rows]
+
+    def save(self):
+        if self.rollout is not None:
+            self.save_rollout()
+        version = self.registry.version
+        if version == self.saved_version:
+            return
+        records = self.registry.export()
+        with self.connect() as connection:
+            connection.execute('DELETE FROM terminals')
+            connection.executemany('INSERT INTO terminals (key, store_id, terminal_id, record) VALUES (?, ?, ?, ?)',
+                                   [(f"{store_id},{terminal_id}", store_id, terminal_id, json.dumps(record)) for store_id, terminal_id, record in records])
+        connection.close()
+        self.saved_version = version
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save()
+            except sqlite3.Error as e:
+                logging.error(f"Error saving state: {e}")
+        self.save()
+
+    def stop(self):
+        self.stopped.set()
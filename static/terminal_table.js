@@ -0,0 +1,203 @@
+// Terminal status table for the dashboard. Rows are keyed by "store,terminal" and remember what
+// they show, so a change only rewrites the cells that differ. Only the rows in (or near) the
+// viewport exist in the DOM; two spacer rows keep the scrollbar the height of the whole fleet.
+// State changes are applied straight away but drawn at most once per animation frame.
+class TerminalTable {
+    constructor(container, tableBody, options = {}) {
+        this.container = container;  // The scrolling element around the table
+        this.tableBody = tableBody;
+        this.columns = 7;
+        this.rowHeight = options.rowHeight || 49;  // Re-measured from the first real row
+        this.overscan = options.overscan || 10;
+        this.onSelect = options.onSelect || function() {};
+        this.terminals = new Map();  // key -> info
+        this.order = [];  // Keys in display order
+        this.rows = new Map();  // key -> rendered <tr>
+        this.pool = [];  // Rows scrolled out of view, reused for the next ones that scroll in
+        this.dirty = new Set();
+        this.windowChanged = false;
+        this.frameRequested = false;
+        this.selectedKey = null;
+        this.stats = {frames: 0, renderMs: 0, maxRenderMs: 0, cellsPatched: 0, rowsCreated: 0};
+
+        this.topSpacer = this.createSpacer();
+        this.bottomSpacer = this.createSpacer();
+        tableBody.textContent = '';
+        tableBody.appendChild(this.topSpacer);
+        tableBody.appendChild(this.bottomSpacer);
+
+        container.addEventListener('scroll', () => this.invalidate());
+        window.addEventListener('resize', () => this.invalidate());
+        // One handler for every row, so rows can be recycled without rebinding anything
+        tableBody.addEventListener('click', event => {
+            const row = event.target.closest('tr[data-key]');
+            if (row) {
+                this.select(row.dataset.key);
+            }
+        });
+    }
+
+    createSpacer() {
+        const row = document.createElement('tr');
+        row.className = 'spacer';
+        const cell = document.createElement('td');
+        cell.colSpan = this.columns;
+        row.appendChild(cell);
+        return row;
+    }
+
+    createRow() {
+        const row = document.createElement('tr');
+        for (let i = 0; i < this.columns; i++) {
+            row.appendChild(document.createElement('td'));
+        }
+        row.values = new Array(this.columns).fill(null);
+        row.statusClass = null;
+        this.stats.rowsCreated++;
+        return row;
+    }
+
+    // Replaces the whole state, e.g. from a status_snapshot
+    setAll(terminals) {
+        this.terminals = new Map(Object.entries(terminals));
+        this.order = Array.from(this.terminals.keys());
+        this.invalidate();
+    }
+
+    // Applies one terminal_changed batch; null removes a terminal
+    applyChanges(changes) {
+        for (const [key, info] of Object.entries(changes)) {
+            if (info === null) {
+                if (this.terminals.delete(key)) {
+                    this.order.splice(this.order.indexOf(key), 1);
+                    this.windowChanged = true;
+                }
+            } else {
+                if (!this.terminals.has(key)) {
+                    this.order.push(key);
+                    this.windowChanged = true;
+                }
+                this.terminals.set(key, info);
+                this.dirty.add(key);
+            }
+        }
+        this.schedule();
+    }
+
+    invalidate() {
+        this.windowChanged = true;
+        this.schedule();
+    }
+
+    schedule() {
+        if (!this.frameRequested) {
+            this.frameRequested = true;
+            requestAnimationFrame(() => this.render());
+        }
+    }
+
+    render() {
+        const started = performance.now();
+        this.frameRequested = false;
+        if (this.windowChanged) {
+            this.renderWindow();
+        } else {
+            for (const key of this.dirty) {
+                const row = this.rows.get(key);
+                if (row) {
+                    this.patchRow(row, key);
+                }
+            }
+        }
+        this.dirty.clear();
+        this.windowChanged = false;
+        const elapsed = performance.now() - started;
+        this.stats.frames++;
+        this.stats.renderMs += elapsed;
+        this.stats.maxRenderMs = Math.max(this.stats.maxRenderMs, elapsed);
+    }
+
+    renderWindow() {
+        const total = this.order.length;
+        const scrollTop = this.container.scrollTop;
+        const first = Math.max(0, Math.floor(scrollTop / this.rowHeight) - this.overscan);
+        const last = Math.min(total, Math.ceil((scrollTop + this.container.clientHeight) / this.rowHeight) + this.overscan);
+        const visible = this.order.slice(first, last);
+        const wanted = new Set(visible);
+
+        for (const [key, row] of this.rows) {
+            if (!wanted.has(key)) {
+                row.remove();
+                this.rows.delete(key);
+                this.pool.push(row);
+            }
+        }
+        let previous = this.topSpacer;
+        for (const key of visible) {
+            let row = this.rows.get(key);
+            if (!row) {
+                row = this.pool.pop() || this.createRow();
+                this.rows.set(key, row);
+            }
+            this.patchRow(row, key);
+            // Only move rows that aren't already in place
+            if (previous.nextSibling !== row) {
+                this.tableBody.insertBefore(row, previous.nextSibling);
+            }
+            previous = row;
+        }
+        this.topSpacer.style.height = `${first * this.rowHeight}px`;
+        this.bottomSpacer.style.height = `${(total - last) * this.rowHeight}px`;
+
+        // Spacer heights assume every row is as tall as the first one drawn
+        if (visible.length && this.rows.get(visible[0]).offsetHeight && this.rows.get(visible[0]).offsetHeight !== this.rowHeight) {
+            this.rowHeight = this.rows.get(visible[0]).offsetHeight;
+            this.invalidate();
+        }
+    }
+
+    patchRow(row, key) {
+        const info = this.terminals.get(key);
+        const [store, terminal] = key.split(',');
+        const connected = info.status === 'connected';
+        const values = [
+            store,
+            terminal,
+            info.ip,
+            info.isp,
+            (connected ? 'Online' : 'Offline') + (info.stale ? ' (stale)' : ''),
+            info.app_status,
+            info.memory_usage
+        ];
+        const cells = row.cells;
+        for (let i = 0; i < values.length; i++) {
+            if (row.values[i] !== values[i]) {
+                cells[i].textContent = values[i];
+                row.values[i] = values[i];
+                this.stats.cellsPatched++;
+            }
+        }
+        // Stale rows are the last known state from before a server restart
+        const statusClass = (connected ? 'connected' : 'disconnected') + (info.stale ? ' stale' : '') + (key === this.selectedKey ? ' selected' : '');
+        if (row.statusClass !== statusClass) {
+            row.className = statusClass;
+            cells[4].className = connected ? 'status-connected' : 'status-disconnected';
+            row.statusClass = statusClass;
+        }
+        if (row.dataset.key !== key) {
+            row.dataset.key = key;
+        }
+    }
+
+    select(key) {
+        const previous = this.selectedKey;
+        this.selectedKey = key;
+        for (const changed of [previous, key]) {
+            const row = changed && this.rows.get(changed);
+            if (row) {
+                this.patchRow(row, changed);
+            }
+        }
+        this.onSelect(key);
+    }
+}
@@ -0,0 +1,99 @@
+import argparse
+import json
+import random
+import time
+from threading import Thread, Event, Lock
+from registry import TerminalRegistry
+
+# Hammers a TerminalRegistry from many threads at once: terminals reporting, the heartbeat
+# monitor expiring them, dashboards reading snapshots and the expected list being reloaded.
+# Every report writes the same counter into ip and isp, so a reader that sees a record half
+# updated (or a snapshot that blows up mid-iteration) is caught. Exits non-zero on any failure.
+# Usage: python stress_registry.py [--stores 200] [--terminals 10] [--seconds 10] [--shards 16]
+
+
+def run(stores, terminals, seconds, shard_count, writers, readers):
+    registry = TerminalRegistry(shard_count=shard_count)
+    stop = Event()
+    errors = []
+    counts_lock = Lock()
+    counts = {'reports': 0, 'expirations': 0, 'snapshots': 0, 'reloads': 0}
+
+    def expected_list():
+        # A random subset of the fleet, plus a store nobody reports for
+        expected = {f"Store{s}": [str(t) for t in range(terminals)] for s in range(stores) if random.random() < 0.8}
+        expected['Ghost'] = ['1', '2']
+        return expected
+
+    def check(terminals_view):
+        for key, record in terminals_view.items():
+            if record['ip'] != 'N/A' and record['ip'] != record['isp']:
+                raise AssertionError(f"Torn record {key}: {record}")
+
+    def guarded(work, counter):
+        def loop():
+            done = 0
+            try:
+                while not stop.is_set():
+                    work()
+                    done += 1
+            except Exception as e:
+                errors.append(f"{counter}: {e!r}")
+                stop.set()
+            with counts_lock:
+                counts[counter] += done
+        return loop
+
+    def report():
+        store = f"Store{random.randrange(stores + 20)}"  # Some stores aren't expected
+        value = str(random.random())
+        registry.report(store, str(random.randrange(terminals)), {
+            'ip': value, 'isp': value, 'status': 'connected', 'last_heartbeat': time.time(),
+            'app_status': random.choice(('Running', 'Not running')), 'memory_usage': random.random() * 100, 'version': '1.0'
+        })
+
+    def expire():
+        registry.mark_disconnected([f"Store{random.randrange(stores)},{random.randrange(terminals)}" for _ in range(20)])
+
+    def read():
+        check(registry.snapshot())
+        _, body = registry.snapshot_json()
+        check(json.loads(body))
+        registry.statuses()
+
+    def reload():
+        registry.load_expected(expected_list())
+        time.sleep(0.05)
+
+    registry.load_expected(expected_list())
+    threads = [Thread(target=guarded(report, 'reports')) for _ in range(writers)]
+    threads += [Thread(target=guarded(read, 'snapshots')) for _ in range(readers)]
+    threads += [Thread(target=guarded(expire, 'expirations')), Thread(target=guarded(reload, 'reloads'))]
+    for thread in threads:
+        thread.start()
+    stop.wait(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # Once everything is quiet the cached JSON must match a fresh snapshot exactly
+    _, body = registry.snapshot_json()
+    if json.loads(body) != registry.snapshot():
+        errors.append("snapshot_json is out of date with the registry")
+    return counts, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stress test the terminal registry")
+    parser.add_argument('--stores', type=int, default=200)
+    parser.add_argument('--terminals', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--readers', type=int, default=4)
+    args = parser.parse_args()
+    counts, errors = run(args.stores, args.terminals, args.seconds, args.shards, args.writers, args.readers)
+    print(f"{args.shards} shards, {args.seconds} s: " + ', '.join(f"{count} {name}" for name, count in counts.items()))
+    for error in errors:
+        print(error)
+    raise SystemExit(1 if errors else 0)
@@ -1,5 +1,10 @@
+import asyncio
 import requests
 import time
+import json
+import gzip
+import random
+import sqlite3
 import logging
 import psutil
 import socketio
@@ -7,12 +12,39 @@ import os
 import speedtest
 import sys
 import subprocess
+import hashlib
+from deltapatch import apply_patch
+from threading import Lock
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
 SERVER_URL = "http://intranet.ipsdash.com"
 CONFIG_PATH = 'config.txt'
+LOCK_SCREEN_PROCESS = 'LogonUI.exe'  # Only running while Windows is locked
+HTTP_TIMEOUT = (5, 15)  # (connect, read) seconds, so a stalled server can't hang the loop
+DEFAULT_HEARTBEAT_INTERVAL = 10  # seconds, until the server tells us its heartbeat timeout
+MIN_HEARTBEAT_INTERVAL = 5
+MAX_HEARTBEAT_INTERVAL = 60
+CURRENT_EXE_PATH = 'terminal.exe'  # The build we're running, base for delta patches
+UPDATE_PATH = 'terminal_new.exe'
+PATCHED_UPDATE_PATH = 'terminal_new.exe.patched'
+PARTIAL_UPDATE_PATH = 'terminal_new.exe.part'  # Kept between attempts so downloads can resume
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PROBE_TIMEOUT = 5  # seconds a status probe may take before the heartbeat goes out with its last value
+OUTBOX_PATH = 'outbox.db'  # Status samples and log entries not sent yet
+OUTBOX_MAX_ENTRIES = 20000
+OUTBOX_MAX_AGE = 3 * 24 * 3600  # seconds
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_FLUSH_INTERVAL = 5  # seconds a log entry may wait for others to share its batch
+DRAIN_SPREAD = 60  # seconds over which terminals spread their backlogs once the server is back
+BACKOFF_BASE = 2  # seconds, doubled after each failed send
+BACKOFF_MAX = 300
+
+# One keep-alive session shared by every request to the server
+http_session = requests.Session()
+http_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4))
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4))
 
 def read_config(file_path):
     config = {}
@@ -38,7 +70,7 @@ def write_config(file_path, config):
 
 def get_ip_info():
     try:
-        response = requests.get("http://ipinfo.io/json")
+        response = http_session.get("http://ipinfo.io/json", timeout=HTTP_TIMEOUT)
         data = response.json()
         ip = data.get('ip', 'Unknown')
         isp = data.get('org', 'Unknown')
@@ -47,19 +79,73 @@ def get_ip_info():
         logging.error(f"Error fetching IP info: {e}")
         return "Unknown", "Unknown"
 
-def is_app_running(app_name):
-    for process in psutil.process_iter(['pid', 'name']):
-        if process.info['name'] == app_name:
-            return True
-    return False
+class ProcessProbe:
+    # Finds all watched process names in a single pass over the process table and caches one PID
+    # per name. Later polls only check that the cached PIDs still exist with the same name and
+    # create time. A full scan happens when a cached PID disappears. While a watched name has no
+    # running process, each poll lists the PIDs (cheap) and only looks at processes started since
+    # the last look, so a process that starts is found on the next poll; a full rescan then only
+    # happens every rescan_interval seconds.
+    def __init__(self, names, rescan_interval=30):
+        self.names = set(names)
+        self.rescan_interval = rescan_interval
+        self.cached = {}
+        self.known_pids = set()
+        self.last_scan = None
+        self.lock = Lock()
+
+    def scan(self):
+        found = {}
+        pids = set()
+        for process in psutil.process_iter(['pid', 'name', 'create_time']):
+            pids.add(process.info['pid'])
+            name = process.info['name']
+            create_time = process.info['create_time']
+            if name in self.names and create_time is not None:
+                # Keep the oldest process per name, it is the least likely to come and go
+                if name not in found or create_time < found[name][1]:
+                    found[name] = (process.info['pid'], create_time)
+        self.cached = found
+        self.known_pids = pids
+        self.last_scan = time.monotonic()
+
+    def scan_new(self):
+        # Looks only at processes that weren't there on the last look
+        pids = set(psutil.pids())
+        for pid in pids - self.known_pids:
+            try:
+                process = psutil.Process(pid)
+                name = process.name()
+                if name in self.names and name not in self.cached:
+                    self.cached[name] = (pid, process.create_time())
+            except psutil.Error:
+                pass
+        self.known_pids = pids
+
+    def is_alive(self, name, pid, create_time):
+        try:
+            process = psutil.Process(pid)
+            return process.name() == name and process.create_time() == create_time
+        except psutil.Error:
+            return False
+
+    def poll(self):
+        # Returns the set of watched names that currently have a running process
+        with self.lock:
+            if self.last_scan is None:
+                self.scan()
+            elif not all(self.is_alive(name, pid, create_time) for name, (pid, create_time) in self.cached.items()):
+                self.scan()
+            elif len(self.cached) < len(self.names):
+                self.scan_new()
+                if len(self.cached) < len(self.names) and time.monotonic() - self.last_scan >= self.rescan_interval:
+                    self.scan()
+            return set(self.cached)
 
 def get_memory_usage():
     memory = psutil.virtual_memory()
     return memory.percent
 
-def is_windows_locked():
-    return is_app_running('LogonUI.exe')
-
 def perform_speedtest():
     try:
         st = speedtest.Speedtest()
@@ -73,21 +159,43 @@ def perform_speedtest():
         logging.error(f"Error performing speedtest: {e}")
         return None, None
 
-def log_change(event, details, store_id, terminal_id):
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    log_entry = f"{timestamp} - {event}: {details}\n"
-    try:
-        response = requests.post(f"{SERVER_URL}/log", json={
-            'store_id': store_id,
-            'terminal_id': terminal_id,
-            'log_entry': log_entry
-        })
-        if response.status_code != 200:
-            logging.error(f"Failed to send log to server: {response.status_code}")
-    except Exception as e:
-        logging.error(f"Error sending log to server: {e}")
+class Outbox:
+    # Status samples and log entries waiting to be sent, kept in a SQLite database in WAL mode so
+    # they survive a dropped link and a restart. It holds at most max_entries (the oldest are
+    # dropped first) and nothing older than max_age seconds. Only used from the agent's loop thread.
+    def __init__(self, path, max_entries=OUTBOX_MAX_ENTRIES, max_age=OUTBOX_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, created_at REAL, entry TEXT)')
+
+    def add(self, kind, entry):
+        with self.connection:
+            cursor = self.connection.execute('INSERT INTO outbox (kind, created_at, entry) VALUES (?, ?, ?)', (kind, time.time(), json.dumps(entry)))
+            # Ids only grow, so everything max_entries or more below the newest is over the limit
+            dropped = self.connection.execute('DELETE FROM outbox WHERE id <= ?', (cursor.lastrowid - self.max_entries,)).rowcount
+        if dropped:
+            logging.info(f"Outbox full, dropped the {dropped} oldest entries")
+
+    def prune(self):
+        with self.connection:
+            dropped = self.connection.execute('DELETE FROM outbox WHERE created_at < ?', (time.time() - self.max_age,)).rowcount
+        if dropped:
+            logging.info(f"Dropped {dropped} outbox entries older than {self.max_age} s")
+
+    def peek(self, kind, limit):
+        # [(id, entry)], oldest first
+        rows = self.connection.execute('SELECT id, entry FROM outbox WHERE kind = ? ORDER BY id LIMIT ?', (kind, limit)).fetchall()
+        return [(id, json.loads(entry)) for id, entry in rows]
+
+    def remove(self, ids):
+        with self.connection:
+            self.connection.executemany('DELETE FROM outbox WHERE id = ?', [(id,) for id in ids])
 
-def send_status(store_id, terminal_id, status, ip, isp, app_status, memory_usage, logon_status, download_speed=None, upload_speed=None):
+def send_status(store_id, terminal_id, status, ip, isp, app_status, memory_usage, logon_status, download_speed=None, upload_speed=None, version=None):
+    # Returns the server's reply, which also carries the current terminal version
     url = f"{SERVER_URL}/update"
     try:
         data = {
@@ -100,36 +208,130 @@ def send_status(store_id, terminal_id, status, ip, isp, app_status, memory_usage
             "memory_usage": memory_usage,
             "logon_status": logon_status,
             "download_speed": download_speed,
-            "upload_speed": upload_speed
+            "upload_speed": upload_speed,
+            "version": version
         }
-        response = requests.post(url, json=data)
+        response = http_session.post(url, json=data, timeout=HTTP_TIMEOUT)
         logging.info(f"Status update response: {response.status_code}")
+        if response.status_code == 200:
+            return response.json()
     except Exception as e:
         logging.error(f"Error: {e}")
+    return None
 
-def check_for_updates(current_version):
+def send_batch(path, payload):
+    # gzip: a backlog is mostly the same keys and ids over and over
     try:
-        response = requests.get(f"{SERVER_URL}/check_update")
-        data = response.json()
-        latest_version = data['version']
-        if latest_version != current_version:
-            logging.info(f"New version available: {latest_version}")
-            return latest_version
+        response = http_session.post(f"{SERVER_URL}{path}", data=gzip.compress(json.dumps(payload).encode()), timeout=HTTP_TIMEOUT,
+                                     headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+        if response.status_code == 200:
+            return True
+        logging.error(f"Failed to send {path}: {response.status_code}")
+    except Exception as e:
+        logging.error(f"Error sending {path}: {e}")
+    return False
+
+def send_keepalive(store_id, terminal_id):
+    # Nothing changed since the last full status, just tell the server we're still here
+    try:
+        response = http_session.post(f"{SERVER_URL}/update", json={
+            'store_id': store_id,
+            'terminal_id': terminal_id
+        }, timeout=HTTP_TIMEOUT)
+        if response.status_code == 200:
+            return response.json()
+        logging.error(f"Keep-alive response: {response.status_code}")
     except Exception as e:
-        logging.error(f"Error checking for updates: {e}")
+        logging.error(f"Error sending keep-alive: {e}")
     return None
 
-def download_update():
+def heartbeat_interval(reply, interval):
+    # Beat three times per server heartbeat timeout so one lost request doesn't flag us as disconnected
+    timeout = reply.get('heartbeat_timeout') if reply else None
+    if not timeout:
+        return interval
+    return min(max(timeout / 3, MIN_HEARTBEAT_INTERVAL), MAX_HEARTBEAT_INTERVAL)
+
+def check_for_updates(reply, current_version):
+    # The /update reply tells us the latest version, no separate /check_update poll needed
+    latest_version = reply.get('version') if reply else None
+    if latest_version and latest_version != current_version:
+        logging.info(f"New version available: {latest_version}")
+        return latest_version
+    return None
+
+def fetch_update_manifest():
+    # Version, SHA-256 and size of the build the server is handing out
     try:
-        response = requests.get(f"{SERVER_URL}/download_update")
-        with open('terminal_new.exe', 'wb') as file:
-            file.write(response.content)
+        response = http_session.get(f"{SERVER_URL}/update_manifest", timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        logging.error(f"Error fetching update manifest: {e}")
+    return None
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def download_update(manifest):
+    # Streams the build to PARTIAL_UPDATE_PATH, resuming an interrupted download with a Range
+    # request, and only moves it to UPDATE_PATH once size and hash match the manifest
+    try:
+        offset = os.path.getsize(PARTIAL_UPDATE_PATH) if os.path.exists(PARTIAL_UPDATE_PATH) else 0
+        if offset >= manifest['size']:
+            offset = 0
+        headers = {}
+        if offset:
+            # If-Range makes the server send the whole file instead if the build changed meanwhile
+            headers = {'Range': f"bytes={offset}-", 'If-Range': f'"{manifest["sha256"]}"'}
+        url = f"{SERVER_URL}{manifest.get('url', '/download_update')}"
+        with http_session.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            if mode == 'ab':
+                logging.info(f"Resuming update download at {offset} bytes")
+            with open(PARTIAL_UPDATE_PATH, mode) as file:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+        if os.path.getsize(PARTIAL_UPDATE_PATH) != manifest['size'] or file_sha256(PARTIAL_UPDATE_PATH) != manifest['sha256']:
+            logging.error("Downloaded update does not match the manifest, discarding it")
+            os.remove(PARTIAL_UPDATE_PATH)
+            return False
+        os.replace(PARTIAL_UPDATE_PATH, UPDATE_PATH)
         logging.info("Update downloaded")
         return True
     except Exception as e:
         logging.error(f"Error downloading update: {e}")
     return False
 
+def download_patch(manifest, current_version):
+    # Rebuilds the new build from our own exe and a delta patch, if the server has one for our
+    # version. Returns False (so the caller falls back to the full download) on any mismatch.
+    patch = manifest.get('patches', {}).get(current_version)
+    if not patch or not os.path.exists(CURRENT_EXE_PATH):
+        return False
+    try:
+        response = http_session.get(f"{SERVER_URL}{patch['url']}", timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        if hashlib.sha256(response.content).hexdigest() != patch['sha256']:
+            logging.error("Downloaded patch does not match the manifest")
+            return False
+        apply_patch(CURRENT_EXE_PATH, response.content, PATCHED_UPDATE_PATH)
+        if os.path.getsize(PATCHED_UPDATE_PATH) != manifest['size'] or file_sha256(PATCHED_UPDATE_PATH) != manifest['sha256']:
+            logging.error("Patched build does not match the manifest, falling back to a full download")
+            os.remove(PATCHED_UPDATE_PATH)
+            return False
+        os.replace(PATCHED_UPDATE_PATH, UPDATE_PATH)
+        logging.info(f"Update rebuilt from a {patch['size']} byte patch")
+        return True
+    except Exception as e:
+        logging.error(f"Error applying update patch: {e}")
+    return False
+
 def apply_update():
     try:
         with open('update_and_relaunch.bat', 'w') as bat_file:
@@ -147,65 +349,261 @@ def apply_update():
         logging.error(f"Error applying update: {e}")
     return False
 
-def start_terminal(config):
-    ip, isp = get_ip_info()
-    app_name = config.get('app_name', 'example.exe')  # Replace 'example.exe' with your actual .exe file name
-    current_version = config.get('version', '0.0')
-    last_ip = ip
-    last_isp = isp
-    last_app_status = "Not running"
+class TerminalAgent:
+    # Runs the terminal on an asyncio loop. The heartbeat is its own timer and sends whatever the
+    # probes last found; probes run concurrently in worker threads with a deadline each, and one
+    # that overruns keeps its last value (and isn't started again until it returns). Long jobs
+    # (speedtest, update download) are background tasks, so nothing can hold up a heartbeat.
+    # The Socket.IO client keeps its own threads; its handlers only hand work to the loop.
+    def __init__(self, config):
+        self.config = config
+        self.store_id = config['store_id']
+        self.terminal_id = config['terminal_id']
+        self.app_name = config.get('app_name', 'example.exe')  # Replace 'example.exe' with your actual .exe file name
+        self.current_version = config.get('version', '0.0')
+        self.memory_threshold = float(config.get('memory_threshold', 5))  # percentage points
+        self.process_probe = ProcessProbe([self.app_name, LOCK_SCREEN_PROCESS], rescan_interval=float(config.get('process_rescan_interval', 30)))
+        self.interval = DEFAULT_HEARTBEAT_INTERVAL
+        # Latest probe results
+        self.ip = 'Unknown'
+        self.isp = 'Unknown'
+        self.running = set()
+        self.memory_usage = None
+        self.app_status = None
+        # What the server last received in a full status; None forces a full status on the next beat
+        self.last_sent = None
+        self.last_memory_usage = None
+        self.probes = {}  # name -> task of a probe that is still running
+        self.outbox = Outbox(OUTBOX_PATH)
+        self.link_down = False  # The last heartbeat got no reply
+        self.jobs = {}  # name -> background task
+        self.loop = None
+        self.beat_now = None
+        self.link_back = None
+        self.stopped = None
+
+        self.sio = socketio.Client(http_session=http_session)
+        self.sio.on('connect', self.on_connect)
+        self.sio.on('disconnect', self.on_disconnect)
+        self.sio.on('reboot_command', self.on_reboot_command)
+        self.sio.on('speedtest_command', self.on_speedtest_command)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.beat_now = asyncio.Event()
+        self.link_back = asyncio.Event()
+        self.stopped = asyncio.Event()
+        self.log_change("Started", f"version {self.current_version}")
+
+        await self.refresh()
+        tasks = [asyncio.create_task(loop) for loop in (self.heartbeat_loop(), self.probe_loop(), self.drain_loop(), self.connect())]
+        await self.stopped.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.to_thread(self.sio.disconnect)
+
+    async def connect(self):
+        # Identify ourselves so the server puts this connection in our terminal and store rooms
+        # Websocket only: with several server workers a polling session would hop between processes
+        # Retried until the server answers; after that the client reconnects by itself
+        while True:
+            try:
+                await asyncio.to_thread(self.sio.connect, SERVER_URL, auth={'store_id': self.store_id, 'terminal_id': self.terminal_id}, transports=['websocket'])
+                return
+            except socketio.exceptions.ConnectionError as e:
+                logging.error(f"Error connecting to server: {e}")
+                await asyncio.sleep(self.interval)
+
+    async def run_probe(self, name, probe):
+        # probe()'s result, or None if it failed or is still running after PROBE_TIMEOUT
+        task = self.probes.get(name)
+        if task is None:
+            task = self.probes[name] = asyncio.create_task(asyncio.to_thread(probe))
+            task.add_done_callback(lambda task: self.probes.pop(name, None))
+        done, _ = await asyncio.wait({task}, timeout=PROBE_TIMEOUT)
+        if not done:
+            logging.error(f"Probe {name} took longer than {PROBE_TIMEOUT} s, keeping its last value")
+            return None
+        if task.exception():
+            logging.error(f"Probe {name} failed: {task.exception()}")
+            return None
+        return task.result()
+
+    async def refresh(self):
+        # One round of probes, all at once. The IP lookup only runs until it has succeeded.
+        probes = [self.run_probe('processes', self.process_probe.poll), self.run_probe('memory', get_memory_usage)]
+        if self.ip == 'Unknown':
+            probes.append(self.run_probe('ip_info', get_ip_info))
+        running, memory_usage, *ip_info = await asyncio.gather(*probes)
+        if running is not None:
+            self.running = running
+            app_status = "Running" if self.app_name in running else "Not running"
+            if self.app_status is not None and app_status != self.app_status:
+                self.log_change("App status", f"{self.app_name} {app_status}")
+            self.app_status = app_status
+        if memory_usage is not None:
+            self.memory_usage = memory_usage
+        if ip_info and ip_info[0] is not None:
+            self.ip, self.isp = ip_info[0]
+
+    async def probe_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.refresh()
+
+    async def beat(self):
+        logon_status = LOCK_SCREEN_PROCESS in self.running
+        sent = (self.ip, self.isp, self.app_status, logon_status)
+        memory_usage = self.memory_usage
+        memory_moved = self.last_memory_usage is None or memory_usage is not None and abs(memory_usage - self.last_memory_usage) >= self.memory_threshold
+        if sent != self.last_sent or memory_moved:
+            reply = await asyncio.to_thread(send_status, self.store_id, self.terminal_id, "connected", self.ip, self.isp, self.app_status, memory_usage, logon_status, version=self.current_version)
+            if reply is None:
+                # Keep the sample for the server's history; later beats only queue what changes again
+                self.outbox.add('status', {
+                    'store_id': self.store_id,
+                    'terminal_id': self.terminal_id,
+                    'sampled_at': time.time(),
+                    'ip': self.ip,
+                    'isp': self.isp,
+                    'app_status': self.app_status,
+                    'memory_usage': memory_usage,
+                    'logon_status': logon_status,
+                    'version': self.current_version
+                })
+            self.last_sent, self.last_memory_usage = sent, memory_usage
+        else:
+            reply = await asyncio.to_thread(send_keepalive, self.store_id, self.terminal_id)
+        if reply is None:
+            self.link_down = True
+        elif self.link_down:
+            # Back after an outage: the server's copy of our status is out of date, and the backlog can go
+            logging.info("Server reachable again")
+            self.link_down = False
+            self.link_back.set()
+            self.report_now()
+        if reply and reply.get('full_status'):
+            self.last_memory_usage = None  # The server lost our record, resend everything next beat
+        self.interval = heartbeat_interval(reply, self.interval)
+        if check_for_updates(reply, self.current_version):
+            self.start_job('update', self.update)
 
-    sio = socketio.Client()
+    async def heartbeat_loop(self):
+        while True:
+            started = self.loop.time()
+            await self.beat()
+            # Sleep out the rest of the interval, unless the socket (re)connected and wants a full status now
+            try:
+                await asyncio.wait_for(self.beat_now.wait(), max(0, started + self.interval - self.loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            self.beat_now.clear()
 
-    @sio.event
-    def connect():
+    def report_now(self):
+        self.last_memory_usage = None
+        self.beat_now.set()
+
+    def log_change(self, event, details):
+        now = time.time()
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+        self.outbox.add('log', {
+            'store_id': self.store_id,
+            'terminal_id': self.terminal_id,
+            'created_at': now,  # So the server files it under when it happened, not when it arrived
+            'log_entry': f"{timestamp} - {event}: {details}\n"
+        })
+
+    async def drain(self):
+        # Sends everything queued, oldest first. False if a batch failed; it stays queued.
+        self.outbox.prune()
+        for kind, path, field in (('status', '/update/batch', 'samples'), ('log', '/logs/batch', 'entries')):
+            while rows := self.outbox.peek(kind, OUTBOX_BATCH_SIZE):
+                if not await asyncio.to_thread(send_batch, path, {field: [entry for _, entry in rows]}):
+                    return False
+                self.outbox.remove([id for id, _ in rows])
+        return True
+
+    async def drain_loop(self):
+        # Sends the outbox every OUTBOX_FLUSH_INTERVAL seconds. After a failure the next try waits a
+        # random part of a delay that doubles each time (full jitter), and once the heartbeat finds
+        # the server back after an outage the backlog waits a random part of DRAIN_SPREAD, so a
+        # region's worth of terminals coming back together doesn't hit the server all at once.
+        failures = 0
+        while True:
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** failures)) if failures else OUTBOX_FLUSH_INTERVAL
+            try:
+                await asyncio.wait_for(self.link_back.wait(), delay)
+                self.link_back.clear()
+                await asyncio.sleep(random.uniform(0, DRAIN_SPREAD))
+                failures = 0
+            except asyncio.TimeoutError:
+                pass
+            failures = 0 if await self.drain() else failures + 1
+
+    def start_job(self, name, job):
+        # Runs job() as a background task unless one with the same name is still running
+        if name in self.jobs:
+            logging.info(f"Already running {name}")
+            return
+        task = self.jobs[name] = self.loop.create_task(job())
+        task.add_done_callback(lambda task: self.job_done(name, task))
+
+    def job_done(self, name, task):
+        del self.jobs[name]
+        if not task.cancelled() and task.exception():
+            logging.error(f"Error running {name}: {task.exception()}")
+
+    async def speedtest(self):
+        download_speed, upload_speed = await asyncio.to_thread(perform_speedtest)
+        speedtest_results = {
+            'store_id': self.store_id,
+            'terminal_id': self.terminal_id,
+            'download_speed': download_speed,
+            'upload_speed': upload_speed
+        }
+        await asyncio.to_thread(self.sio.emit, 'speedtest_results', speedtest_results)
+
+    async def update(self):
+        manifest = await asyncio.to_thread(fetch_update_manifest)
+        if not manifest:
+            return
+        new_version = manifest['version']
+        if not (await asyncio.to_thread(download_patch, manifest, self.current_version) or await asyncio.to_thread(download_update, manifest)):
+            return
+        if await asyncio.to_thread(apply_update):
+            logging.info("Restarting to apply update")
+            self.log_change("Update", f"{self.current_version} -> {new_version}")
+            await self.drain()  # Whatever doesn't make it is sent by the new build
+            self.config['version'] = new_version
+            write_config(CONFIG_PATH, self.config)
+            self.stopped.set()
+
+    # Socket.IO handlers, called on the client's threads
+
+    def on_connect(self):
         logging.info("Connected to server")
-        memory_usage = get_memory_usage()
-        logon_status = is_windows_locked()
-        send_status(config['store_id'], config['terminal_id'], "connected", ip, isp, "Not running", memory_usage, logon_status)
+        self.loop.call_soon_threadsafe(self.report_now)
 
-    @sio.event
-    def disconnect():
+    def on_disconnect(self):
         logging.info("Disconnected from server")
 
-    @sio.on('reboot_command')
-    def on_reboot_command(data):
-        if data['store_id'] == config['store_id'] and data['terminal_id'] == config['terminal_id']:
-            logging.info(f"Received reboot command for {config['store_id']}-{config['terminal_id']}")
+    def is_command_for_me(self, data):
+        # The server only sends commands to our rooms; this guards against older servers that broadcast
+        return data['store_id'] == self.store_id and data['terminal_id'] in (self.terminal_id, '*')
+
+    def on_reboot_command(self, data):
+        if self.is_command_for_me(data):
+            logging.info(f"Received reboot command for {self.store_id}-{self.terminal_id}")
             os.system("shutdown /r /t 1")
 
-    @sio.on('speedtest_command')
-    def on_speedtest_command(data):
-        if data['store_id'] == config['store_id'] and data['terminal_id'] == config['terminal_id']:
-            logging.info(f"Received speedtest command for {config['store_id']}-{config['terminal_id']}")
-            download_speed, upload_speed = perform_speedtest()
-            speedtest_results = {
-                'store_id': config['store_id'],
-                'terminal_id': config['terminal_id'],
-                'download_speed': download_speed,
-                'upload_speed': upload_speed
-            }
-            sio.emit('speedtest_results', speedtest_results)
-
-    sio.connect(SERVER_URL)
-
-    while True:
-        app_status = "Running" if is_app_running(app_name) else "Not running"
-        memory_usage = get_memory_usage()
-        logon_status = is_windows_locked()
-
-        send_status(config['store_id'], config['terminal_id'], "connected", ip, isp, app_status, memory_usage, logon_status)
-
-        new_version = check_for_updates(current_version)
-        if new_version:
-            if download_update():
-                if apply_update():
-                    logging.info("Restarting to apply update")
-                    config['version'] = new_version
-                    write_config(CONFIG_PATH, config)
-                    sys.exit()
-
-        time.sleep(10)  # Send status updates periodically
+    def on_speedtest_command(self, data):
+        if self.is_command_for_me(data):
+            logging.info(f"Received speedtest command for {self.store_id}-{self.terminal_id}")
+            self.loop.call_soon_threadsafe(self.start_job, 'speedtest', self.speedtest)
+
+def start_terminal(config):
+    asyncio.run(TerminalAgent(config).run())
+    sys.exit()
 
 if __name__ == "__main__":
     config = read_config(CONFIG_PATH)
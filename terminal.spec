@@ -26,7 +26,7 @@ exe = EXE(
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
+    upx=False,  # UPX-packed builds share almost no blocks between versions, which defeats delta patches
     upx_exclude=[],
     runtime_tmpdir=None,
     console=True,
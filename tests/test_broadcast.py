@@ -0,0 +1,114 @@
+import time
+from contextlib import contextmanager
+from threading import Thread
+from broadcast import Broadcaster
+from registry import TerminalRegistry
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, message, to=None):
+        self.emitted.append((event, message, to))
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+def view(keys):
+    return {key: {'key': key} for key in keys}
+
+
+def emitted_broadcaster(count, history_size=500):
+    broadcaster = Broadcaster(FakeSocketIO(), view, history_size=history_size)
+    for seq in range(1, count + 1):
+        broadcaster.emit([f'S1,{seq}'])
+    return broadcaster
+
+
+def test_changes_since_replays_what_the_client_missed():
+    broadcaster = emitted_broadcaster(5)
+    assert [seq for seq, _ in broadcaster.changes_since(3)] == [4, 5]
+    assert broadcaster.changes_since(5) == []
+    assert [seq for seq, _ in broadcaster.changes_since(0)] == [1, 2, 3, 4, 5]
+
+
+def test_changes_since_past_the_end_of_history_needs_a_snapshot():
+    # A client ahead of us saw another server run (we restarted); replaying nothing would leave it stale
+    broadcaster = emitted_broadcaster(5)
+    assert broadcaster.changes_since(6) is None
+    assert broadcaster.changes_since(100) is None
+    assert emitted_broadcaster(0).changes_since(1) is None
+
+
+def test_changes_since_older_than_history_needs_a_snapshot():
+    broadcaster = emitted_broadcaster(10, history_size=4)
+    assert broadcaster.changes_since(5) is None
+    assert [seq for seq, _ in broadcaster.changes_since(6)] == [7, 8, 9, 10]
+    assert broadcaster.changes_since(None) is None
+
+
+@contextmanager
+def running(broadcaster, count=1):
+    # Runs the broadcast thread for the block, then until count messages went out
+    thread = Thread(target=broadcaster.run)
+    thread.start()
+    try:
+        yield
+        deadline = time.time() + 5
+        while len(broadcaster.socketio.emitted) < count and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        broadcaster.stop()
+        thread.join()
+
+
+def test_changes_within_a_window_go_out_as_one_message():
+    registry = TerminalRegistry()
+    registry.load_expected({'S1': ['1', '2']})
+    broadcaster = Broadcaster(FakeSocketIO(), registry.view, window=0.2, room='dashboards')
+    with running(broadcaster):
+        registry.report('S1', '1', {'ip': 'a', 'status': 'connected'})
+        broadcaster.publish({'S1,1': None})
+        registry.report('S1', '1', {'ip': 'b'})
+        broadcaster.publish(['S1,1', 'S1,3'])
+    [(event, message, room)] = broadcaster.socketio.emitted
+    assert (event, room, message['seq']) == ('terminal_changed', 'dashboards', 1)
+    assert message['changes'] == {'S1,1': registry.get('S1,1').to_dict(), 'S1,3': None}
+    assert message['changes']['S1,1']['ip'] == 'b'
+    assert broadcaster.stats()['changes_coalesced'] == 1
+
+
+def test_a_late_publish_cannot_leave_a_stale_entry():
+    # The expiry marks a terminal disconnected, a report reconnects it and publishes, and only
+    # then does the expiry publish: the dashboard still gets the registry's current state
+    registry = TerminalRegistry()
+    registry.report('S1', '1', {'status': 'connected'})
+    expired = registry.mark_disconnected(['S1,1'])
+    _, reconnected = registry.report('S1', '1', {'status': 'connected'})
+    broadcaster = Broadcaster(FakeSocketIO(), registry.view, window=0.05)
+    with running(broadcaster):
+        broadcaster.publish(reconnected)
+        broadcaster.publish(expired)
+    assert broadcaster.socketio.emitted[-1][1]['changes']['S1,1']['status'] == 'connected'
+
+
+def test_broadcasting_survives_a_failing_emit():
+    socketio = FakeSocketIO()
+    calls = []
+
+    def emit(event, message, to=None):
+        calls.append(message['seq'])
+        if len(calls) == 1:
+            raise OSError("connection reset")
+        socketio.emitted.append((event, message, to))
+    socketio.emit = emit
+    broadcaster = Broadcaster(socketio, view, window=0.01)
+    with running(broadcaster):
+        broadcaster.publish(['S1,1'])
+        while not calls:
+            time.sleep(0.01)
+        broadcaster.publish(['S1,2'])
+    assert calls == [1, 2]
+    assert socketio.emitted[0][1]['changes'] == {'S1,2': {'key': 'S1,2'}}
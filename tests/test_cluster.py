@@ -0,0 +1,105 @@
+from cluster import SharedRegistry, SharedRolloutController
+from rollout import RolloutController
+
+
+def shared_registry(tmp_path):
+    registry = SharedRegistry(str(tmp_path / 'shared.db'))
+    registry.reset()
+    return registry
+
+
+def shared_rollout(tmp_path, count=2, **options):
+    # One controller per worker, all on the same file; the first resets it like the parent does
+    registry = shared_registry(tmp_path)
+    for store in range(10):
+        for terminal in range(5):
+            registry.report(f'S{store}', str(terminal), {'status': 'connected', 'version': '1.0', 'last_heartbeat': 100.0})
+    options = dict(dict(waves=(0.2, 1.0), max_downloads_per_store=1, soak_time=10, evaluate_interval=0), **options)
+    rollouts = [SharedRolloutController(registry, '2.0', **options)]
+    rollouts[0].reset()
+    for _ in range(count - 1):
+        rollout = SharedRolloutController(SharedRegistry(registry.path), '2.0', **options)
+        rollout.shared = True  # Forked from the parent after reset
+        rollouts.append(rollout)
+    return rollouts
+
+
+def test_keep_alive_does_not_write_to_shared_registry(tmp_path):
+    registry = shared_registry(tmp_path)
+    registry.report('S1', '1', {'ip': '10.0.0.1', 'status': 'connected', 'last_heartbeat': 100.0})
+    registry.sync()
+    seq = registry.synced_seq
+    total_changes = registry.connection().total_changes
+    record, changes = registry.report('S1', '1', {'status': 'connected', 'last_heartbeat': 200.0})
+    assert changes == {}
+    assert record.ip == '10.0.0.1'
+    assert registry.connection().total_changes == total_changes
+    registry.sync()
+    assert registry.synced_seq == seq
+
+
+def test_real_change_is_written_and_seen_by_other_processes(tmp_path):
+    registry = shared_registry(tmp_path)
+    other = SharedRegistry(registry.path)
+    registry.report('S1', '1', {'ip': '10.0.0.1', 'status': 'connected', 'last_heartbeat': 100.0})
+    registry.sync()
+    _, changes = registry.report('S1', '1', {'ip': '10.0.0.2', 'status': 'connected', 'last_heartbeat': 200.0})
+    assert changes['S1,1']['ip'] == '10.0.0.2'
+    assert other.sync()['S1,1']['ip'] == '10.0.0.2'
+
+
+def test_take_beats_hands_over_the_latest_beat_once(tmp_path):
+    registry = shared_registry(tmp_path)
+    registry.note_beat('S1,1', 100.0)
+    registry.note_beat('S1,1', 200.0)
+    registry.note_beat('S1,2', 150.0)
+    assert sorted(registry.take_beats()) == [('S1,1', 200.0), ('S1,2', 150.0)]
+    assert registry.take_beats() == []
+
+
+def test_rollout_store_limit_holds_across_workers(tmp_path):
+    rollouts = shared_rollout(tmp_path, count=3, waves=(1.0,))
+    told = {}
+    for store in range(10):
+        for terminal in range(5):
+            for rollout in rollouts:
+                if rollout.version_for(f'S{store},{terminal}', f'S{store}', '1.0', now=100.0) == '2.0':
+                    told.setdefault(f'S{store}', set()).add(terminal)
+    assert sorted(told) == [f'S{store}' for store in range(10)]
+    assert all(len(terminals) == 1 for terminals in told.values())
+    assert rollouts[2].status()['attempted'] == 10
+
+
+def test_shared_rollout_matches_in_memory_rollout(tmp_path):
+    rollouts = shared_rollout(tmp_path)
+    local = RolloutController(rollouts[0].registry, '2.0', waves=(0.2, 1.0), max_downloads_per_store=1, soak_time=10, evaluate_interval=0)
+    keys = [(f'S{store}', f'S{store},{terminal}') for store in range(10) for terminal in range(5)]
+    reported = {}
+    now = 100.0
+    for step in range(40):
+        worker = rollouts[step % 2]
+        for store, key in keys:
+            version = reported.get(key, '1.0')
+            told = worker.version_for(key, store, version, now=now)
+            assert told == local.version_for(key, store, version, now=now)
+            if told == '2.0':
+                reported[key] = '2.0'
+        now += 6
+        rollouts[0].evaluate(now)
+        local.evaluate(now)
+        assert rollouts[1].status() == local.status()
+    assert local.status()['state'] == 'complete'
+
+
+def test_rollout_pause_and_restore_are_shared(tmp_path):
+    rollouts = shared_rollout(tmp_path, waves=(1.0,))
+    rollouts[0].version_for('S1,1', 'S1', '1.0', now=100.0)
+    rollouts[1].pause('checking')
+    assert rollouts[0].status()['state'] == 'paused'
+    assert rollouts[0].version_for('S2,1', 'S2', '1.0', now=100.0) == '1.0'
+    assert rollouts[0].version_for('S1,1', 'S1', '1.0', now=100.0) == '2.0'  # Already handed the version
+    saved = rollouts[0].export()
+    rollouts[1].start('3.0')
+    assert rollouts[0].status()['in_flight'] == {}
+    rollouts[1].restore(saved)
+    assert rollouts[0].export() == saved
@@ -0,0 +1,75 @@
+import hashlib
+import lzma
+import random
+import pytest
+from deltapatch import make_patch, apply_patch, read_header, worthwhile
+
+
+def round_trip(tmp_path, base, target):
+    (tmp_path / 'base.exe').write_bytes(base)
+    patch = make_patch(base, target)
+    apply_patch(str(tmp_path / 'base.exe'), patch, str(tmp_path / 'out.exe'))
+    assert (tmp_path / 'out.exe').read_bytes() == target
+    return patch
+
+
+def edited_build(base, rng):
+    # Inserts, deletes, overwrites and a moved chunk, like a rebuild with a few code changes
+    data = bytearray(base)
+    data[1000:1000] = rng.randbytes(300)
+    del data[20000:20700]
+    data[40000:40050] = rng.randbytes(50)
+    chunk = bytes(data[60000:64000])
+    del data[60000:64000]
+    data[5000:5000] = chunk
+    return bytes(data) + rng.randbytes(123)
+
+
+def test_round_trip_of_an_edited_build_is_small(tmp_path):
+    rng = random.Random(1)
+    base = rng.randbytes(100_000)
+    target = edited_build(base, rng)
+    patch = round_trip(tmp_path, base, target)
+    assert len(patch) < len(target) // 20
+    assert worthwhile(len(patch), len(target))
+
+
+def test_patch_between_unrelated_builds_is_not_worthwhile():
+    # Like two UPX-packed builds: no block of the target appears in the base
+    rng = random.Random(3)
+    target = rng.randbytes(100_000)
+    patch = make_patch(rng.randbytes(100_000), target)
+    assert not worthwhile(len(patch), len(target))
+
+
+@pytest.mark.parametrize('base, target', [
+    (b'', b''),
+    (b'', b'new file'),
+    (b'old file', b''),
+    (b'short', b'shorter than a block'),
+    (bytes(range(256)) * 8, bytes(range(256)) * 8),
+    (b'\x00' * 4096, b'\x00' * 4097),
+])
+def test_round_trip_edge_cases(tmp_path, base, target):
+    round_trip(tmp_path, base, target)
+
+
+def test_header_describes_both_builds():
+    base, target = b'a' * 1000, b'b' * 2000
+    assert read_header(lzma.decompress(make_patch(base, target))) == (
+        1000, hashlib.sha256(base).hexdigest(), 2000, hashlib.sha256(target).hexdigest())
+
+
+def test_patch_for_another_base_is_rejected(tmp_path):
+    rng = random.Random(2)
+    base = rng.randbytes(10_000)
+    patch = make_patch(base, base + b'more')
+    (tmp_path / 'other.exe').write_bytes(rng.randbytes(10_000))
+    with pytest.raises(ValueError):
+        apply_patch(str(tmp_path / 'other.exe'), patch, str(tmp_path / 'out.exe'))
+
+
+def test_data_that_is_not_a_patch_is_rejected(tmp_path):
+    (tmp_path / 'base.exe').write_bytes(b'base')
+    with pytest.raises(ValueError):
+        apply_patch(str(tmp_path / 'base.exe'), lzma.compress(b'not a patch'), str(tmp_path / 'out.exe'))
@@ -0,0 +1,87 @@
+import time
+from threading import Event, Thread
+from heartbeats import HeartbeatMonitor
+
+
+def test_superseded_deadline_does_not_expire():
+    monitor = HeartbeatMonitor(20, on_expired=None)
+    monitor.beat('S1,1', now=0)
+    monitor.beat('S1,1', now=10)
+    assert monitor.pop_expired(25) == []  # The entry for the first beat is skipped when popped
+    assert monitor.pop_expired(30) == ['S1,1']
+    assert monitor.deadlines == {}
+
+
+def test_expired_keys_come_out_together_in_deadline_order():
+    monitor = HeartbeatMonitor(20, on_expired=None)
+    monitor.beat('S1,2', now=5)
+    monitor.beat('S1,1', now=0)
+    monitor.beat('S1,3', now=50)
+    assert monitor.pop_expired(25) == ['S1,1', 'S1,2']
+    assert list(monitor.deadlines) == ['S1,3']
+
+
+def test_forgotten_key_never_expires():
+    monitor = HeartbeatMonitor(20, on_expired=None)
+    monitor.beat('S1,1', now=0)
+    monitor.forget('S1,1')
+    assert monitor.pop_expired(100) == []
+
+
+def test_superseded_entries_are_compacted():
+    monitor = HeartbeatMonitor(20, on_expired=None)
+    for now in range(10000):
+        monitor.beat(f'S1,{now % 10}', now=now)
+    assert len(monitor.heap) <= 4 * len(monitor.deadlines) + 64
+    assert monitor.pop_expired(10000 + 10) == ['S1,0']
+
+
+def test_run_reports_silent_terminals_and_keeps_beating_ones():
+    expired = []
+    done = Event()
+
+    def on_expired(keys):
+        expired.extend(keys)
+        done.set()
+
+    monitor = HeartbeatMonitor(0.5, on_expired)
+    thread = Thread(target=monitor.run)
+    thread.start()
+    try:
+        monitor.beat('S1,silent')
+        started = time.time()
+        monitor.beat('S1,beating')
+        while not done.wait(0.05) and time.time() - started < 5:
+            monitor.beat('S1,beating')
+        assert expired == ['S1,silent']
+        assert 'S1,beating' in monitor.deadlines
+    finally:
+        monitor.stop()
+        thread.join()
+
+
+def test_run_survives_a_failing_on_expired_and_retries():
+    calls = []
+    done = Event()
+
+    def on_expired(keys):
+        calls.append(list(keys))
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        done.set()
+
+    monitor = HeartbeatMonitor(0.05, on_expired, retry_delay=0.05)
+    thread = Thread(target=monitor.run)
+    thread.start()
+    try:
+        monitor.beat('S1,1')
+        assert done.wait(2)
+        assert calls == [['S1,1'], ['S1,1']]
+        monitor.beat('S1,2')
+        deadline = time.time() + 2
+        while len(calls) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        assert calls[2] == ['S1,2']  # Still expiring terminals after the failure
+    finally:
+        monitor.stop()
+        thread.join()
@@ -0,0 +1,10 @@
+from Intranet import StatusFeed
+
+
+def test_view_is_a_copy_the_feed_keeps_no_reference_to():
+    views = []
+    feed = StatusFeed('http://localhost', views.append, lambda changes: None, lambda state: None)
+    feed.on_status_snapshot({'seq': 1, 'terminals': {'S1,1': {'status': 'connected'}}})
+    feed.on_terminal_changed({'seq': 2, 'changes': {'S1,2': {'status': 'connected'}, 'S1,1': None}})
+    assert views == [{'S1,1': {'status': 'connected'}}]
+    assert feed.terminals == {'S1,2': {'status': 'connected'}}
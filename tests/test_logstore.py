@@ -0,0 +1,153 @@
+import json
+import os
+import time
+from threading import Thread
+from logstore import LogSegment, LogStore
+
+
+def read_page(store, **query):
+    files, cursor = store.query(**query)
+    lines = b''.join(store.stream(files)).decode().splitlines()
+    return [json.loads(line)['entry'] for line in lines], cursor
+
+
+def write(store, entries, store_id='S1', terminal_id='1', ts=1000.0):
+    store.write_batch([(ts + i, store_id, terminal_id, entry, None) for i, entry in enumerate(entries)])
+
+
+def test_bytes_written_counts_every_record(tmp_path):
+    store = LogStore(str(tmp_path / 'log.txt'))
+    store.open()
+    write(store, ['first'])
+    assert store.bytes_written == os.path.getsize(tmp_path / 'log.txt') > 0
+    write(store, ['second', 'third'])
+    assert store.bytes_written == os.path.getsize(tmp_path / 'log.txt')
+    assert store.entries_written == 3
+
+
+def test_cursor_pages_across_rotated_segments(tmp_path):
+    store = LogStore(str(tmp_path / 'log.txt'), max_bytes=300, backup_count=10)
+    store.open()
+    entries = [f"entry {i}" for i in range(20)]
+    for entry in entries:
+        write(store, [entry], store_id='S1' if entry[-1] in '02468' else 'S2')
+    assert len(store.segments) > 3
+
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = read_page(store, limit=3, cursor=cursor)
+        assert len(page) <= 3
+        seen.extend(page)
+        if cursor is None:
+            break
+    assert seen == entries
+
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = read_page(store, store_id='S2', limit=2, cursor=cursor)
+        seen.extend(page)
+        if cursor is None:
+            break
+    assert seen == [entry for entry in entries if entry[-1] not in '02468']
+
+
+def test_cursor_survives_a_rotation_between_pages(tmp_path):
+    store = LogStore(str(tmp_path / 'log.txt'), max_bytes=300, backup_count=10)
+    store.open()
+    for i in range(4):
+        write(store, [f"entry {i}"])
+    page, cursor = read_page(store, limit=2)
+    assert page == ['entry 0', 'entry 1']
+    for i in range(4, 10):
+        write(store, [f"entry {i}"])
+    rest = []
+    while cursor is not None:
+        page, cursor = read_page(store, limit=2, cursor=cursor)
+        rest.extend(page)
+    assert rest == [f"entry {i}" for i in range(2, 10)]
+
+
+def test_catch_up_indexes_unindexed_records_and_skips_a_torn_line(tmp_path):
+    path = str(tmp_path / 'log.txt')
+    store = LogStore(path)
+    store.open()
+    write(store, ['indexed'])
+    store.file.close()
+    store.index_file.close()
+    # A crash after the log write but before the index write, then one mid-line
+    with open(path, 'ab') as log:
+        log.write((json.dumps({'ts': 2000.0, 'store_id': 'S1', 'terminal_id': '1', 'entry': 'not indexed'}) + '\n').encode())
+        log.write(b'{"ts": 2001.0, "store_id": "S1", "ter')
+    torn_size = os.path.getsize(path)
+
+    segment = LogSegment.load(path, 0)
+    assert len(segment.offsets) == 2
+    assert segment.size < torn_size
+
+    reopened = LogStore(path)
+    reopened.open()
+    assert os.path.getsize(path) == segment.size  # The torn line is cut off
+    write(reopened, ['after restart'], ts=3000.0)
+    page, cursor = read_page(reopened)
+    assert page == ['indexed', 'not indexed', 'after restart']
+    assert cursor is None
+
+
+def test_entries_held_back_during_an_outage_are_filed_under_when_they_were_logged(tmp_path):
+    store = LogStore(str(tmp_path / 'log.txt'))
+    store.open()
+    write(store, ['live 1', 'live 2'], ts=5000.0)
+    # Received at 6000, logged at 1000 and 3000 while the terminal was offline
+    store.write_batch([(6000.0, 'S1', '1', 'late 1', 1000.0), (6000.0, 'S1', '1', 'late 2', 3000.0),
+                       (6000.0, 'S1', '1', 'from the future', 9000.0)])
+    assert read_page(store, until=2000.0)[0] == ['late 1']
+    assert read_page(store, since=2000.0, until=4000.0, store_id='S1')[0] == ['late 2']
+    assert read_page(store, since=5000.5, store_id='S1', terminal_id='1')[0] == ['live 2', 'from the future']
+    files, _ = store.query(until=2000.0)
+    assert json.loads(b''.join(store.stream(files)))['ts'] == 1000.0
+    store.file.close()
+    store.index_file.close()
+
+    # Both the sidecar index and a rebuild from the log keep the logged times
+    from_index = LogSegment.load(store.path, 0)
+    os.remove(f"{store.path}.idx")
+    from_log = LogSegment.load(store.path, 0)
+    for segment in (from_index, from_log):
+        assert list(segment.select(None, None, None, 2000.0, 0)) == [2]
+        assert list(segment.select('S1', None, 2000.0, 4000.0, 0)) == [3]
+
+
+def test_full_queue_refuses_the_whole_batch(tmp_path):
+    store = LogStore(str(tmp_path / 'log.txt'), max_queue=3)
+    assert store.write_many([('S1', '1', 'a', None), ('S1', '1', 'b', None)])
+    assert not store.write_many([('S1', '1', 'c', None), ('S1', '1', 'd', None)])
+    assert store.write('S1', '1', 'c')
+    assert not store.write('S1', '1', 'd')
+    assert store.queue.qsize() == 3
+    assert store.entries_dropped == 3
+
+
+def test_writer_outlives_a_failed_write(tmp_path, monkeypatch):
+    store = LogStore(str(tmp_path / 'log.txt'))
+    write_batch = store.write_batch
+    failures = []
+
+    def failing_write_batch(batch):
+        if not failures:
+            failures.append(batch)
+            store.file.close()  # Writing now raises, as it would with the disk gone
+        write_batch(batch)
+    monkeypatch.setattr(store, 'write_batch', failing_write_batch)
+    thread = Thread(target=store.run)
+    thread.start()
+    store.write('S1', '1', 'lost')
+    while not failures:
+        time.sleep(0.01)
+    store.write('S1', '1', 'kept')
+    store.stop()
+    thread.join()
+    assert store.entries_dropped == 1
+    store.open()
+    assert read_page(store)[0] == ['kept']
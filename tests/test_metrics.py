@@ -0,0 +1,40 @@
+import pickle
+from metrics import Metrics
+
+
+def make_metrics():
+    metrics = Metrics()
+    metrics.counter('responses_total', "Responses", ('code',))
+    metrics.histogram('request_seconds', "Request time", buckets=(0.1, 1))
+    metrics.collector(lambda: [('terminals', 'gauge', "Terminals", [({}, 3)])])
+    return metrics
+
+
+def test_render_adds_up_exports_from_other_processes():
+    parent, worker = make_metrics(), make_metrics()
+    parent.inc('responses_total', 1, ('200',))
+    worker.inc('responses_total', 2, ('200',))
+    worker.inc('responses_total', 1, ('500',))
+    worker.observe('request_seconds', 0.05)
+    worker.observe('request_seconds', 5)
+    parent.observe('request_seconds', 0.5)
+    export = pickle.loads(pickle.dumps(worker.export()))  # Goes over the bus
+    lines = parent.render([export]).splitlines()
+    assert 'ips_responses_total{code="200"} 3' in lines
+    assert 'ips_responses_total{code="500"} 1' in lines
+    assert 'ips_request_seconds_bucket{le="0.1"} 1' in lines
+    assert 'ips_request_seconds_bucket{le="1"} 2' in lines
+    assert 'ips_request_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'ips_request_seconds_sum 5.55' in lines
+    assert lines.count('ips_terminals 3') == 1  # Collectors run once, in the rendering process
+
+
+def test_render_leaves_the_exported_values_alone():
+    parent, worker = make_metrics(), make_metrics()
+    worker.inc('responses_total', 2, ('200',))
+    worker.observe('request_seconds', 0.05)
+    export = worker.export()
+    parent.render([export])
+    parent.render([export])
+    assert 'ips_responses_total{code="200"} 2' in parent.render([export]).splitlines()
+    assert worker.export() == export
@@ -0,0 +1,30 @@
+import json
+from registry import TerminalRegistry, TerminalRecord
+import stress_registry
+
+
+def test_heartbeat_only_update_keeps_dict_and_json_in_step():
+    record = TerminalRecord('S1', '1')
+    record.update({'ip': '10.0.0.1', 'status': 'connected', 'last_heartbeat': 100.0})
+    cached = record.to_json()
+    assert record.update({'status': 'connected', 'last_heartbeat': 200.0}) is False
+    assert record.last_heartbeat == 200.0
+    assert json.loads(record.to_json()) == record.to_dict()
+    assert record.to_json() is cached
+
+
+def test_api_status_and_snapshot_json_agree_after_keep_alives():
+    registry = TerminalRegistry()
+    registry.report('S1', '1', {'ip': '10.0.0.1', 'status': 'connected', 'last_heartbeat': 100.0})
+    registry.snapshot_json()
+    _, changes = registry.report('S1', '1', {'status': 'connected', 'last_heartbeat': 200.0})
+    assert changes == {}
+    assert json.loads(registry.snapshot_json()[1]) == registry.snapshot()
+
+
+def test_stress_run_finds_no_torn_reads():
+    # A short run of stress_registry.py, with a single shard as well as several
+    for shard_count in (1, 8):
+        counts, errors = stress_registry.run(stores=20, terminals=5, seconds=0.5, shard_count=shard_count, writers=4, readers=2)
+        assert errors == []
+        assert counts['reports'] > 0 and counts['snapshots'] > 0 and counts['expirations'] > 0
@@ -0,0 +1,124 @@
+from registry import Status, TerminalRegistry
+from rollout import RolloutController
+from statestore import StateStore
+
+STORES = [f"Store{i}" for i in range(40)]
+KEYS = [(store, str(terminal), f"{store},{terminal}") for store in STORES for terminal in range(5)]
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.status = {key: Status.CONNECTED for _, _, key in KEYS}
+
+    def statuses(self):
+        return list(self.status.items())
+
+
+def make_controller(registry=None, **options):
+    options = dict(dict(waves=(0.05, 0.25, 0.5, 1.0), max_downloads_per_store=1, download_timeout=100,
+                        soak_time=10, evaluate_interval=0), **options)
+    return RolloutController(registry or FakeRegistry(), '2.0', **options)
+
+
+def poll_all(rollout, now, reported):
+    # One /update from every terminal; returns the keys told to update
+    told = set()
+    for store, terminal, key in KEYS:
+        if rollout.version_for(key, store, reported.get(key, '1.0'), now=now) == '2.0' and reported.get(key) != '2.0':
+            told.add(key)
+    return told
+
+
+def update_wave(rollout, now, reported):
+    # Polls until every admitted terminal has updated; stores update one terminal at a time
+    while True:
+        told = poll_all(rollout, now, reported)
+        if not told:
+            return
+        reported.update((key, '2.0') for key in told)
+        poll_all(rollout, now, reported)
+
+
+def test_first_wave_only_admits_its_fraction_one_per_store():
+    rollout = make_controller()
+    told = poll_all(rollout, 0, {})
+    assert told
+    assert all(rollout.rank(key) < 0.05 for key in told)
+    stores = [key.split(',')[0] for key in told]
+    assert len(stores) == len(set(stores))
+
+
+def test_store_limit_frees_a_slot_once_the_terminal_reports_the_new_version():
+    rollout = make_controller(waves=(1.0,))
+    store, _, first = KEYS[0]
+    second = KEYS[1][2]
+    assert rollout.version_for(first, store, '1.0', now=0) == '2.0'
+    assert rollout.version_for(second, store, '1.0', now=0) == '1.0'
+    assert rollout.version_for(first, store, '1.0', now=1) == '2.0'  # Still in flight, still told
+    assert rollout.version_for(first, store, '2.0', now=2) == '2.0'
+    assert rollout.version_for(second, store, '1.0', now=2) == '2.0'
+
+
+def test_wave_opens_after_the_soak_time_and_the_rollout_completes():
+    rollout = make_controller()
+    reported = {}
+    now = 0
+    for wave in range(4):
+        assert rollout.status()['wave'] == wave
+        update_wave(rollout, now, reported)
+        rollout.evaluate(now=now + 5)
+        assert rollout.status()['state'] == 'rolling'
+        assert rollout.status()['wave'] == wave
+        now += 20
+        rollout.evaluate(now=now)
+    assert rollout.status()['state'] == 'complete'
+    assert len(reported) == len(KEYS)
+    assert rollout.status()['failed'] == []
+
+
+def test_timed_out_downloads_pause_the_rollout_until_resumed():
+    rollout = make_controller(waves=(1.0,), max_failure_ratio=0.2)
+    told = poll_all(rollout, 0, {})
+    assert len(told) == len(STORES)
+    rollout.evaluate(now=50)
+    assert rollout.status()['state'] == 'rolling'
+    rollout.evaluate(now=101)
+    status = rollout.status()
+    assert status['state'] == 'paused'
+    assert len(status['failed']) == len(STORES)
+    assert poll_all(rollout, 102, {}) == set()
+    rollout.resume()
+    assert rollout.status()['state'] == 'rolling'
+    assert poll_all(rollout, 103, {})
+
+
+def test_terminal_that_drops_off_after_updating_counts_as_failed():
+    registry = FakeRegistry()
+    rollout = make_controller(registry, waves=(1.0,), max_failure_ratio=0.5)
+    store, _, key = KEYS[0]
+    rollout.version_for(key, store, '1.0', now=0)
+    rollout.version_for(key, store, '2.0', now=1)
+    registry.status[key] = Status.DISCONNECTED
+    rollout.evaluate(now=5)
+    assert key in rollout.status()['failed']
+
+
+def test_paused_rollout_is_restored_where_it_stopped(tmp_path):
+    rollout = make_controller()
+    reported = {}
+    update_wave(rollout, 0, reported)
+    rollout.evaluate(now=30)
+    assert rollout.status()['wave'] == 1
+    poll_all(rollout, 31, reported)
+    rollout.pause('operator')
+    store = StateStore(str(tmp_path / 'state.db'), TerminalRegistry(), rollout)
+    store.save()
+
+    restored = make_controller()
+    restored.restore(StateStore(str(tmp_path / 'state.db'), TerminalRegistry()).load_rollout())
+    assert restored.status() == rollout.status()
+    assert restored.export() == rollout.export()
+    # Paused: terminals already downloading keep going, nobody new is admitted
+    in_flight = {key for keys in rollout.status()['in_flight'].values() for key in keys}
+    assert in_flight
+    assert poll_all(restored, 32, reported) == in_flight
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import time
+import pytest
+import terminal
+from terminal import Outbox, ProcessProbe, TerminalAgent
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith('linux'), reason="starts a copy of /bin/sleep")
+
+
+@pytest.fixture
+def watched_program(tmp_path):
+    # A copy of sleep under a name nothing else on the machine uses
+    path = tmp_path / f"ipsprobe{os.getpid()}"
+    shutil.copy(shutil.which('sleep'), path)
+    return path
+
+
+@linux_only
+def test_probe_finds_a_watched_process_as_soon_as_it_starts(watched_program):
+    probe = ProcessProbe([watched_program.name], rescan_interval=3600)
+    assert probe.poll() == set()
+    process = subprocess.Popen([str(watched_program), '30'])
+    try:
+        assert probe.poll() == {watched_program.name}
+    finally:
+        process.kill()
+        process.wait()
+    assert probe.poll() == set()
+
+
+@linux_only
+def test_probe_skips_the_full_scan_while_nothing_new_started(watched_program, monkeypatch):
+    probe = ProcessProbe([watched_program.name], rescan_interval=3600)
+    probe.poll()
+    scans = []
+    monkeypatch.setattr(probe, 'scan', lambda: scans.append(1))
+    for _ in range(5):
+        assert probe.poll() == set()
+    assert scans == []
+
+
+def test_outbox_drops_the_oldest_entries_past_max_entries(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox.db'), max_entries=3)
+    for n in range(5):
+        outbox.add('log', {'n': n})
+    assert [entry['n'] for _, entry in outbox.peek('log', 10)] == [2, 3, 4]
+
+
+def test_outbox_prunes_entries_older_than_max_age(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    outbox = Outbox(str(tmp_path / 'outbox.db'), max_age=60)
+    outbox.add('status', {'n': 0})
+    clock[0] += 50
+    outbox.add('status', {'n': 1})
+    clock[0] += 20
+    outbox.prune()
+    assert [entry['n'] for _, entry in outbox.peek('status', 10)] == [1]
+
+
+def test_outbox_survives_a_restart(tmp_path):
+    Outbox(str(tmp_path / 'outbox.db')).add('log', {'n': 0})
+    assert [entry for _, entry in Outbox(str(tmp_path / 'outbox.db')).peek('log', 10)] == [{'n': 0}]
+
+
+def test_drain_deletes_only_what_was_sent(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(terminal, 'OUTBOX_BATCH_SIZE', 2)
+    agent = TerminalAgent({'store_id': 'S1', 'terminal_id': '1'})
+    for n in range(3):
+        agent.outbox.add('status', {'n': n})
+    for n in range(3):
+        agent.outbox.add('log', {'n': n})
+    sent = []
+    replies = iter([True, True, False])  # The first log batch fails
+
+    def send_batch(path, payload):
+        sent.append((path, payload))
+        return next(replies)
+    monkeypatch.setattr(terminal, 'send_batch', send_batch)
+    assert asyncio.run(agent.drain()) is False
+    assert sent == [('/update/batch', {'samples': [{'n': 0}, {'n': 1}]}), ('/update/batch', {'samples': [{'n': 2}]}),
+                    ('/logs/batch', {'entries': [{'n': 0}, {'n': 1}]})]
+    assert agent.outbox.peek('status', 10) == []
+    assert [entry['n'] for _, entry in agent.outbox.peek('log', 10)] == [0, 1, 2]
+
+    monkeypatch.setattr(terminal, 'send_batch', lambda path, payload: sent.append((path, payload)) or True)
+    assert asyncio.run(agent.drain()) is True
+    assert sent[-2:] == [('/logs/batch', {'entries': [{'n': 0}, {'n': 1}]}), ('/logs/batch', {'entries': [{'n': 2}]})]
+    assert agent.outbox.peek('log', 10) == []